@@ -0,0 +1,353 @@
+import os
+import shutil
+import subprocess
+import sys
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import http.server
+import functools
+import tempfile
+
+# Benchmark harness for deploy_higurashi.py and translations/ru/deploy_higurashi.py
+#
+# Generates a fake Higurashi mod repository, serves the files normally downloaded from Github from a local HTTP
+# server, runs the deploy scripts against it and reads back the per-stage timings from their build reports.
+# Results can be saved as a baseline, and later runs compared against it to find performance regressions.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEPLOY_SCRIPT = os.path.join(SCRIPT_DIR, 'deploy_higurashi.py')
+RU_DEPLOY_SCRIPT = os.path.join(SCRIPT_DIR, 'translations', 'ru', 'deploy_higurashi.py')
+
+# Data sizes to benchmark. Media files are random (incompressible), like the real .ogg/.png/.mp4 files.
+SCALES = {
+    'tiny':   {'scripts': 20,   'smallFiles': 200,    'smallFileSize': 4 * 1024,  'mediaFiles': 2,  'mediaFileSize': 1024 * 1024},
+    'small':  {'scripts': 100,  'smallFiles': 2000,   'smallFileSize': 16 * 1024, 'mediaFiles': 10, 'mediaFileSize': 4 * 1024 * 1024},
+    'medium': {'scripts': 300,  'smallFiles': 10000,  'smallFileSize': 32 * 1024, 'mediaFiles': 20, 'mediaFileSize': 16 * 1024 * 1024},
+    'large':  {'scripts': 600,  'smallFiles': 40000,  'smallFileSize': 64 * 1024, 'mediaFiles': 40, 'mediaFileSize': 64 * 1024 * 1024},
+}
+
+# Paths the deploy scripts download from, relative to https://github.com
+AVPRO_VIDEO_PATH = '07th-mod/patch-releases/releases/download/developer-v1.0/AVProVideo.dll'
+RU_TRANSLATION_PATH = '07th-mod/ui-editing-scripts/releases/download/russian_v1.0.0_all/translation.7z'
+
+STUB_SCRIPT_COMPILER = '''#!{python}
+# Stand-in for HigurashiScriptCompiler.exe: "compiles" each script by copying it, then writes the status file
+import os, sys
+src, dest = sys.argv[1], sys.argv[2]
+count = 0
+for dirPath, dirNames, fileNames in os.walk(src):
+    for fileName in fileNames:
+        relDir = os.path.relpath(dirPath, src)
+        os.makedirs(os.path.join(dest, relDir), exist_ok=True)
+        with open(os.path.join(dirPath, fileName), 'rb') as f:
+            data = f.read()
+        with open(os.path.join(dest, relDir, os.path.splitext(fileName)[0] + '.mg'), 'wb') as f:
+            f.write(data)
+        count += 1
+with open('higu_script_compile_status.txt', 'w') as f:
+    f.write(f'Compile OK ({{count}} scripts)')
+'''
+
+
+def writeRandomFile(path, size, rng: random.Random):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunkSize = min(remaining, 1024 * 1024)
+            f.write(rng.getrandbits(chunkSize * 8).to_bytes(chunkSize, 'little'))
+            remaining -= chunkSize
+
+
+def writeScriptFile(path, size, rng: random.Random):
+    # Scripts are text, so they compress well like the real ones
+    words = ['OutputLine(NULL,', '"', 'NULL,', 'Line_WaitForInput);', 'PlaySE(4,', 'DrawScene(', 'Wait(', '1000);', 'if', 'void', 'main()', '{', '}']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        written = 0
+        while written < size:
+            line = ' '.join(rng.choice(words) for _ in range(12)) + '\n'
+            f.write(line)
+            written += len(line)
+
+
+def generateFakeRepo(root, scale, seed=0):
+    """Create a fake chapter repository in root. Returns the total size of the generated files in bytes."""
+    rng = random.Random(seed)
+    config = SCALES[scale]
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+
+    for i in range(config['scripts']):
+        writeScriptFile(os.path.join(root, 'Update', f'onik_{i:03}.txt'), 20 * 1024, rng)
+
+    # Many small files spread over several folders, like the voice and sprite folders
+    for i in range(config['smallFiles']):
+        folder = ['voice', 'SE', 'CG', 'CGAlt', 'spectrum'][i % 5]
+        writeRandomFile(os.path.join(root, folder, f's{i // 500:02}', f'file_{i:05}.ogg'), config['smallFileSize'], rng)
+
+    for i in range(config['mediaFiles']):
+        writeRandomFile(os.path.join(root, 'movies', f'movie_{i:02}.mp4'), config['mediaFileSize'], rng)
+
+    for name in ['fonts.json', 'localization.json']:
+        with open(os.path.join(root, name), 'w') as f:
+            json.dump({'name': name, 'values': list(range(1000))}, f)
+
+    writeRandomFile(os.path.join(root, 'bin', 'Release', 'Assembly-CSharp.dll'), 2 * 1024 * 1024, rng)
+    with open(os.path.join(root, 'bin', 'Release', 'Assembly-CSharp.version.txt'), 'w') as f:
+        f.write('benchmark')
+
+    compilerPath = os.path.join(root, 'bin', 'ScriptCompiler', 'HigurashiScriptCompiler.exe')
+    os.makedirs(os.path.dirname(compilerPath))
+    with open(compilerPath, 'w') as f:
+        f.write(STUB_SCRIPT_COMPILER.format(python=sys.executable))
+    os.chmod(compilerPath, 0o755)
+
+    # Files which should be ignored by the deploy script
+    os.makedirs(os.path.join(root, '.git'))
+    with open(os.path.join(root, 'README.md'), 'w') as f:
+        f.write('benchmark repository')
+
+    return sum(os.path.getsize(os.path.join(dirPath, fileName)) for dirPath, _, fileNames in os.walk(root) for fileName in fileNames)
+
+
+def generateFakeRuRepo(root, scale, seed=0):
+    """Create a fake Russian translation repository in root"""
+    rng = random.Random(seed)
+    config = SCALES[scale]
+    shutil.rmtree(root, ignore_errors=True)
+    dataFolder = os.path.join(root, 'HigurashiEp01_Data')
+    for i in range(config['smallFiles']):
+        writeRandomFile(os.path.join(dataFolder, 'StreamingAssets', f's{i // 500:02}', f'file_{i:05}.ogg'), config['smallFileSize'], rng)
+    for i in range(config['mediaFiles']):
+        writeRandomFile(os.path.join(dataFolder, 'StreamingAssets', 'movies', f'movie_{i:02}.mp4'), config['mediaFileSize'], rng)
+    writeRandomFile(os.path.join(dataFolder, 'sharedassets0.assets'), 1024 * 1024, rng)
+    os.makedirs(os.path.join(root, 'release'))
+
+
+def generateTranslationArchive(sevenZipPath, serveFolder, seed=0):
+    """Create a fake translation.7z in serveFolder, with translated UI files for each chapter"""
+    rng = random.Random(seed)
+    translationRoot = tempfile.mkdtemp(prefix='higurashi-bench-translation-')
+    try:
+        for episode in range(1, 9):
+            translatedDataFolder = os.path.join(translationRoot, 'output', 'translation', f'HigurashiEp{episode:02}_Data')
+            for i in range(5):
+                writeRandomFile(os.path.join(translatedDataFolder, f'sharedassets{i}.assets'), 512 * 1024, rng)
+
+        archivePath = os.path.join(serveFolder, RU_TRANSLATION_PATH)
+        os.makedirs(os.path.dirname(archivePath), exist_ok=True)
+        if os.path.exists(archivePath):
+            os.remove(archivePath)
+        subprocess.check_call([sevenZipPath, 'a', archivePath, 'output'], cwd=translationRoot, stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(translationRoot, ignore_errors=True)
+
+
+class LocalDownloadServer:
+    """Serves serveFolder over HTTP on a random local port, standing in for https://github.com"""
+    def __init__(self, serveFolder, handlerClass=None):
+        handler = functools.partial(handlerClass or QuietRequestHandler, directory=serveFolder)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves files like Github's release downloads, including single range requests ('Range: bytes=start-end')"""
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', '').strip())
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start > end:
+            self.send_error(416)
+            return
+
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('Last-Modified', self.date_time_string(int(os.path.getmtime(path))))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end + 1 - start
+            while remaining > 0:
+                data = f.read(min(remaining, 1024 * 1024))
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+def runDeployScript(scriptPath, scriptArgs, repoRoot, reportPath, mirrorURL, cacheDir):
+    """Run a deploy script in repoRoot, returning the total wall time and the wall time of each stage"""
+    # The Github Actions output goes outside repoRoot, as files in the repository end up in the archive
+    with tempfile.TemporaryDirectory(prefix='higurashi-bench-output-') as outputFolder:
+        env = dict(os.environ, HIGURASHI_DOWNLOAD_MIRROR=mirrorURL, HIGURASHI_CACHE_DIR=cacheDir, GITHUB_OUTPUT=os.path.join(outputFolder, 'github-output.txt'))
+        startTime = time.perf_counter()
+        completed = subprocess.run([sys.executable, scriptPath] + scriptArgs, cwd=repoRoot, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        totalSeconds = time.perf_counter() - startTime
+    if completed.returncode != 0:
+        print(completed.stdout.decode('utf-8', errors='replace'))
+        raise Exception(f"ERROR: {scriptPath} {scriptArgs} failed with retcode {completed.returncode}")
+
+    stageSeconds = {}
+    with open(os.path.join(repoRoot, reportPath)) as f:
+        report = json.load(f)
+    for chapterReport in report['chapters'].values():
+        for stage in chapterReport['stages']:
+            stageSeconds[stage['name']] = stageSeconds.get(stage['name'], 0) + stage['wallSeconds']
+
+    stageSeconds['total'] = totalSeconds
+    return stageSeconds
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def benchmarkScenario(name, repeats, runOnce):
+    """Call runOnce() 'repeats' times, and return the median time of each stage. The first run uses a cold cache."""
+    runs = [runOnce(cold=(i == 0)) for i in range(repeats)]
+    stageNames = sorted(set(stage for run in runs for stage in run))
+    result = {
+        'cold': runs[0],
+        'median': dict((stage, median([run.get(stage, 0) for run in runs])) for stage in stageNames),
+    }
+    print(f" - {name}: " + ', '.join(f'{stage}: {seconds:.2f}s' for stage, seconds in result['median'].items()))
+    return result
+
+
+def compareWithBaseline(results, baseline, threshold):
+    """Print the change of each stage against the baseline. Returns a list of regressions larger than threshold."""
+    regressions = []
+    print(f"\n>>> Comparison with baseline (regression threshold {threshold * 100:.0f}%):")
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            print(f" - {scenario}: not in baseline")
+            continue
+        for stage, seconds in result['median'].items():
+            baselineSeconds = baseline[scenario]['median'].get(stage)
+            if baselineSeconds is None:
+                continue
+            # Ignore tiny stages, where the noise is larger than the change
+            change = (seconds - baselineSeconds) / baselineSeconds if baselineSeconds > 0.05 else 0
+            marker = ''
+            if change > threshold:
+                marker = ' <-- REGRESSION'
+                regressions.append(f'{scenario}/{stage}')
+            print(f" - {scenario}/{stage}: {baselineSeconds:.2f}s -> {seconds:.2f}s ({change * 100:+.0f}%){marker}")
+
+    return regressions
+
+
+def findSevenZip():
+    for path in ['7za', '7z']:
+        if shutil.which(path):
+            return path
+    return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmarks the Higurashi deploy scripts against generated repositories, fully offline.')
+    argparser.add_argument('--scales', default='tiny,small', help=f'Comma separated list of data sizes to benchmark: {", ".join(SCALES)} (default: tiny,small)')
+    argparser.add_argument('--repeats', type=int, default=3, help='Number of times to run each scenario. The first run always starts with a cold cache. (default: 3)')
+    argparser.add_argument('--work-dir', dest='workDir', default=None, help='Folder to generate the fake repositories in (default: a temporary folder)')
+    argparser.add_argument('--output', default='benchmark_results.json', help='Where to save the results (default: benchmark_results.json)')
+    argparser.add_argument('--baseline', default=None, help='Results of a previous run to compare against')
+    argparser.add_argument('--threshold', type=float, default=0.2, help='Slowdown compared to the baseline which counts as a regression (default: 0.2 = 20%%)')
+    argparser.add_argument('--skip-ru', dest='skipRu', action='store_true', help='Skip the Russian translation pipeline')
+    argparser.add_argument('--deploy-args', dest='deployArgs', default='', help='Extra arguments passed to deploy_higurashi.py, eg. "--zip-workers 4"')
+    args = argparser.parse_args()
+
+    workDir = args.workDir or tempfile.mkdtemp(prefix='higurashi-bench-')
+    serveFolder = os.path.join(workDir, 'serve')
+    avproPath = os.path.join(serveFolder, AVPRO_VIDEO_PATH)
+    writeRandomFile(avproPath, 1024 * 1024, random.Random(1))
+
+    sevenZipPath = findSevenZip()
+    if not args.skipRu and sevenZipPath is None:
+        print("Warning: 7z not found - skipping the Russian translation pipeline")
+
+    results = {}
+    with LocalDownloadServer(serveFolder) as server:
+        for scale in args.scales.split(','):
+            repoRoot = os.path.join(workDir, f'repo-{scale}')
+            print(f"\n>>> Generating '{scale}' repository in {repoRoot}...")
+            totalBytes = generateFakeRepo(repoRoot, scale)
+            print(f"Generated {totalBytes / 1024 / 1024:.1f} MB")
+
+            cacheDir = os.path.join(workDir, f'cache-{scale}')
+
+            def runMain(cold):
+                if cold:
+                    shutil.rmtree(cacheDir, ignore_errors=True)
+                # --force, as otherwise the archive would not be rebuilt on the warm runs
+                return runDeployScript(DEPLOY_SCRIPT, ['onikakushi', '--force'] + args.deployArgs.split(), repoRoot, 'output/build-report.json', server.url, cacheDir)
+
+            print(f">>> Benchmarking deploy_higurashi.py ({scale})")
+            results[f'main-{scale}'] = benchmarkScenario(f'main-{scale}', args.repeats, runMain)
+
+            if args.skipRu or sevenZipPath is None:
+                continue
+
+            ruRepoRoot = os.path.join(workDir, f'ru-repo-{scale}')
+            ruCacheDir = os.path.join(workDir, f'ru-cache-{scale}')
+            generateTranslationArchive(sevenZipPath, serveFolder)
+
+            def runRu(cold):
+                # The Russian script may modify the repository, so regenerate it each run
+                generateFakeRuRepo(ruRepoRoot, scale)
+                if cold:
+                    shutil.rmtree(ruCacheDir, ignore_errors=True)
+                return runDeployScript(RU_DEPLOY_SCRIPT, [], ruRepoRoot, 'release/build-report.json', server.url, ruCacheDir)
+
+            print(f">>> Benchmarking translations/ru/deploy_higurashi.py ({scale})")
+            results[f'ru-{scale}'] = benchmarkScenario(f'ru-{scale}', args.repeats, runRu)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {args.output}")
+
+    if args.workDir is None:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareWithBaseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nERROR: {len(regressions)} stages regressed: {regressions}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
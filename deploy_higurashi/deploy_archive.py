@@ -0,0 +1,571 @@
+"""Reading and writing .zip and .7z archives, and overlaying archive contents on folders"""
+
+import os
+import shutil
+import subprocess
+import time
+import hashlib
+import concurrent.futures
+import json
+import tempfile
+import zipfile
+import zlib
+import collections
+from typing import Dict, List, Optional
+
+from deploy_common import (
+    call, CompressionPolicy, findWorkingExecutablePath, Globals, isWindows, LinkingCopier, sha256File, tryRemoveTree,
+    waitForProcess,
+)
+
+
+def startHashingFiles(view, executor: concurrent.futures.Executor):
+    #type: (LayeredFileView, concurrent.futures.Executor) -> List[tuple]
+    """
+    Start hashing every file of the view which is on disk on the executor, so the files are hashed while 7z is reading
+    them. Returns a list of (archivePath, size, future), where the future's result is the SHA-256 of the file.
+    Files streamed from an archive are hashed while they are being streamed - see LayeredFileView.streamArchiveFiles().
+    """
+    files = []
+    for file in view.diskFiles():
+        files.append((file.archivePath, file.size, executor.submit(sha256File, file.diskPath())))
+    return files
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# One member of an archive. 'name' always uses '/' as the separator, and 'crc' is None if the archive doesn't list it.
+ArchiveMember = collections.namedtuple('ArchiveMember', ['name', 'size', 'isDir', 'crc'])
+
+
+def getExecutableSignature(executable):
+    """Returns the resolved path, size and modification time of an executable on the PATH, or None if it isn't found"""
+    path = shutil.which(executable)
+    if path is None:
+        return None
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+def getSevenZipExecutable():
+    """
+    Returns the 7z executable to use ('7za' or '7z'). Probing each executable with '-h' is slow, so the result is
+    cached in the cache dir along with the signature of the executable, and only probed again when a different or
+    updated 7z is found on the PATH. The executable is only looked up the first time an archive needs it.
+    """
+    if Globals.SEVEN_ZIP_EXECUTABLE is not None:
+        return Globals.SEVEN_ZIP_EXECUTABLE
+
+    cachePath = os.path.join(Globals.CACHE_DIR, 'tool_paths.json')
+    try:
+        with open(cachePath, 'r') as f:
+            cached = json.load(f).get('7z')
+    except (OSError, ValueError):
+        cached = None
+
+    if cached is not None and getExecutableSignature(cached['executable']) == cached['signature']:
+        Globals.SEVEN_ZIP_EXECUTABLE = cached['executable']
+        return Globals.SEVEN_ZIP_EXECUTABLE
+
+    executable = findWorkingExecutablePath(["7za", "7z"], ['-h'])
+    if executable is None:
+        raise ArchiveError("ERROR: 7z was not found - please install 7-Zip and make sure '7za' or '7z' is on the PATH")
+
+    os.makedirs(Globals.CACHE_DIR, exist_ok=True)
+    tempCachePath = f'{cachePath}.{os.getpid()}.part'
+    with open(tempCachePath, 'w') as f:
+        json.dump({'7z': {'executable': executable, 'signature': getExecutableSignature(executable)}}, f)
+    os.replace(tempCachePath, cachePath)
+
+    Globals.SEVEN_ZIP_EXECUTABLE = executable
+    return executable
+
+
+def isArchiveMemberUnder(name, prefix):
+    """prefix is a folder, a list of folders, or None for every member"""
+    if isinstance(prefix, (list, tuple)):
+        return any(isArchiveMemberUnder(name, folder) for folder in prefix)
+    return not prefix or name == prefix or name.startswith(prefix.rstrip('/') + '/')
+
+
+def getMemberRelPath(archivePath, name, prefix, stripPrefix):
+    """The path of a member relative to where it is extracted, refusing paths which would escape that folder"""
+    relPath = name[len(prefix.rstrip('/')) + 1:] if stripPrefix and prefix else name
+    if not relPath or relPath.startswith('/') or '..' in relPath.split('/'):
+        raise ArchiveError(f"ERROR: Refusing to use {name} from {archivePath}, as it would be outside of the output folder")
+    return relPath
+
+
+class HashingReader:
+    """File object wrapper which computes the SHA-256 of everything read through it"""
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class LayeredFile(collections.namedtuple('LayeredFile', ['archivePath', 'size', 'root', 'archive', 'member'])):
+    """
+    One file of a LayeredFileView. Files on disk are at 'archivePath' inside the 'root' folder, and 'archive' and
+    'member' are None. Files in an archive are read from 'member' of 'archive', and 'root' is None.
+    """
+    def diskPath(self):
+        return os.path.join(self.root, *self.archivePath.split('/'))
+
+
+class LayeredFileView:
+    """
+    The files which go in an archive, as layers of files from folders on disk and from other archives. A file in a
+    later layer overrides the file with the same archive path in earlier layers, like an overlay filesystem, so
+    eg. a translation can replace files of the repository without moving or overwriting anything on disk. The
+    view is only an index: the files are read when the archive is created.
+    """
+    def __init__(self):
+        self.files: Dict[str, LayeredFile] = {}
+        self.emptyFolders: List[LayeredFile] = []
+        self.overridden: List[str] = []
+        self.archiveLayers: List[tuple] = []
+        # SHA-256 of the files streamed out of archives, see streamArchiveFiles()
+        self.sha256: Dict[str, str] = {}
+
+    def _add(self, file: LayeredFile):
+        if file.archivePath in self.files:
+            self.overridden.append(file.archivePath)
+        self.files[file.archivePath] = file
+
+    def addFolder(self, folder, root='.'):
+        """
+        Add every file in the folder at 'folder' inside 'root', with their path relative to root as the archive path.
+        Returns the number of files added.
+        """
+        count = 0
+        for dirPath, dirNames, fileNames in os.walk(os.path.join(root, folder)):
+            dirNames.sort()
+            relFolder = os.path.relpath(dirPath, root).replace(os.sep, '/')
+            if not dirNames and not fileNames:
+                self.emptyFolders.append(LayeredFile(relFolder, 0, root, None, None))
+            for fileName in sorted(fileNames):
+                self._add(LayeredFile(f'{relFolder}/{fileName}', os.path.getsize(os.path.join(dirPath, fileName)), root, None, None))
+                count += 1
+        return count
+
+    def addArchive(self, archive, prefix, archiveFolder):
+        #type: (ArchiveBackend, str, str) -> int
+        """Add the files under the prefix folder of archive, placing them in archiveFolder instead. Returns the number of files added."""
+        count = 0
+        for member in archive.listMembers():
+            if member.isDir or not isArchiveMemberUnder(member.name, prefix):
+                continue
+            relPath = getMemberRelPath(archive.path, member.name, prefix, stripPrefix=True)
+            self._add(LayeredFile(f'{archiveFolder}/{relPath}', member.size, None, archive, member))
+            count += 1
+        self.archiveLayers.append((archive, prefix))
+        return count
+
+    def diskFiles(self):
+        return [file for file in self.files.values() if file.archive is None]
+
+    def archiveFiles(self):
+        return [file for file in self.files.values() if file.archive is not None]
+
+    def streamArchiveFiles(self):
+        """
+        Yields (LayeredFile, fileObject) for each file of the view which is in an archive, streaming each archive layer
+        once (see ArchiveBackend.iterMembers()). Members which were overridden by a later layer are skipped. The SHA-256
+        of each file is recorded in self.sha256.
+        """
+        for archive, prefix in self.archiveLayers:
+            wanted = dict((file.member.name, file) for file in self.archiveFiles() if file.archive is archive)
+            for member, f in archive.iterMembers(prefix):
+                file = wanted.get(member.name)
+                if file is None:
+                    continue
+                reader = HashingReader(f)
+                yield file, reader
+                while reader.read(1024 * 1024):
+                    pass
+                self.sha256[file.archivePath] = reader.sha256.hexdigest()
+
+    def materialize(self, folder, copyFunction):
+        """
+        Place every file of the view in folder, for tools which can only read files from a single folder on disk, and
+        return a view of the copies. Files on disk are placed with copyFunction (eg. a LinkingCopier), and files in an
+        archive are streamed out of it.
+        """
+        view = LayeredFileView()
+        view.overridden = list(self.overridden)
+        for emptyFolder in self.emptyFolders:
+            os.makedirs(os.path.join(folder, *emptyFolder.archivePath.split('/')), exist_ok=True)
+            view.emptyFolders.append(LayeredFile(emptyFolder.archivePath, 0, folder, None, None))
+
+        def getOutputPath(file):
+            copiedFile = LayeredFile(file.archivePath, file.size, folder, None, None)
+            view.files[file.archivePath] = copiedFile
+            os.makedirs(os.path.dirname(copiedFile.diskPath()), exist_ok=True)
+            return copiedFile.diskPath()
+
+        for file in self.diskFiles():
+            copyFunction(file.diskPath(), getOutputPath(file))
+        for file, f in self.streamArchiveFiles():
+            with open(getOutputPath(file), 'wb') as outputFile:
+                shutil.copyfileobj(f, outputFile, 1024 * 1024)
+            Globals.METRICS.add(bytesWritten=file.size, files=1)
+        view.sha256 = self.sha256
+        return view
+
+    def roots(self):
+        """The folders on disk which the files of the view are read from"""
+        return set(file.root for file in list(self.files.values()) + self.emptyFolders if file.archive is None)
+
+    def folders(self):
+        """Every folder containing a file of the view, and the empty folders"""
+        folders = set(file.archivePath for file in self.emptyFolders)
+        for archivePath in self.files:
+            parts = archivePath.split('/')[:-1]
+            for i in range(1, len(parts) + 1):
+                folders.add('/'.join(parts[:i]))
+        return sorted(folders)
+
+
+class ArchiveBackend:
+    """
+    Reads and creates one kind of archive. Members are streamed straight out of the archive, so a build can use them
+    as sources without extracting the archive to a temporary folder first. Use openArchive() to get the backend
+    for an archive path.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, outputPath, view: LayeredFileView, policy: Optional[CompressionPolicy] = None):
+        """Create an archive at outputPath containing the files of the view, returning the backend for it"""
+        raise NotImplementedError()
+
+    def listMembers(self):
+        #type: () -> List[ArchiveMember]
+        raise NotImplementedError()
+
+    def iterMembers(self, prefix=None):
+        """
+        Yields (ArchiveMember, fileObject) for each file under the prefix folder (or under any of a list of folders, or
+        every file if prefix is None), in archive order. Each fileObject can only be read until the next member is requested.
+        The CRC of each member is checked once it has been read.
+        """
+        raise NotImplementedError()
+
+    def test(self):
+        """Decompress every member, checking its CRC, without writing anything to disk"""
+        for member, f in self.iterMembers():
+            while f.read(1024 * 1024):
+                pass
+            Globals.METRICS.add(bytesRead=member.size)
+
+    def extract(self, outputDir, prefix=None, stripPrefix=False):
+        """
+        Extract the files under the prefix folder to outputDir, overwriting existing files, and return their paths.
+        If stripPrefix is True, the prefix folder itself is not created in outputDir.
+        """
+        outputPaths = []
+        for member, f in self.iterMembers(prefix):
+            relPath = getMemberRelPath(self.path, member.name, prefix, stripPrefix)
+            outputPath = os.path.join(outputDir, *relPath.split('/'))
+            os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+            tempOutputPath = outputPath + '.part'
+            try:
+                with open(tempOutputPath, 'wb') as outputFile:
+                    shutil.copyfileobj(f, outputFile, 1024 * 1024)
+            except BaseException:
+                tryRemoveTree(tempOutputPath)
+                raise
+            os.replace(tempOutputPath, outputPath)
+            Globals.METRICS.add(bytesWritten=member.size, files=1)
+            outputPaths.append(outputPath)
+        return outputPaths
+
+
+class ZipBackend(ArchiveBackend):
+    """Archive backend for zips, using Python's zipfile module"""
+    @classmethod
+    def create(cls, outputPath, view: LayeredFileView, policy: Optional[CompressionPolicy] = None):
+        """Files in an archive layer of the view are streamed straight into the zip, without being extracted first"""
+        tryRemoveTree(outputPath)
+        os.makedirs(os.path.dirname(os.path.abspath(outputPath)), exist_ok=True)
+        tempOutputPath = outputPath + '.part'
+
+        def getLevel(path, fileSize):
+            level = None
+            if policy is not None:
+                level = policy.levelForExtension(path, fileSize)
+                if level is None:
+                    # Streamed files can't be sampled before they are compressed
+                    level = policy.sampleLevel(policy.readSample(path, fileSize)) if os.path.exists(path) else policy.defaultLevel
+            return level
+
+        try:
+            with zipfile.ZipFile(tempOutputPath, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+                for folder in view.folders():
+                    zinfo = zipfile.ZipInfo(folder + '/', time.localtime()[:6])
+                    zinfo.external_attr = (0o40775 << 16) | 0x10
+                    zf.writestr(zinfo, b'')
+
+                for file in view.diskFiles():
+                    level = getLevel(file.diskPath(), file.size)
+                    if level == CompressionPolicy.STORE:
+                        zf.write(file.diskPath(), file.archivePath, compress_type=zipfile.ZIP_STORED)
+                    else:
+                        zf.write(file.diskPath(), file.archivePath, compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+
+                for file, f in view.streamArchiveFiles():
+                    level = getLevel(file.archivePath, file.size)
+                    # Entries opened by name use the zip's current compression settings
+                    zf.compression = zipfile.ZIP_STORED if level == CompressionPolicy.STORE else zipfile.ZIP_DEFLATED
+                    zf.compresslevel = level
+                    with zf.open(file.archivePath, 'w', force_zip64=file.size >= zipfile.ZIP64_LIMIT) as outputFile:
+                        shutil.copyfileobj(f, outputFile, 1024 * 1024)
+                    Globals.METRICS.add(bytesRead=file.size)
+        except BaseException:
+            tryRemoveTree(tempOutputPath)
+            raise
+
+        os.replace(tempOutputPath, outputPath)
+        return cls(outputPath)
+
+    def listMembers(self):
+        with zipfile.ZipFile(self.path, 'r') as zf:
+            return [ArchiveMember(zinfo.filename.rstrip('/'), zinfo.file_size, zinfo.is_dir(), zinfo.CRC) for zinfo in zf.infolist()]
+
+    def iterMembers(self, prefix=None):
+        with zipfile.ZipFile(self.path, 'r') as zf:
+            for zinfo in zf.infolist():
+                if zinfo.is_dir() or not isArchiveMemberUnder(zinfo.filename, prefix):
+                    continue
+                # ZipExtFile checks the CRC once the whole member has been read
+                with zf.open(zinfo, 'r') as f:
+                    yield ArchiveMember(zinfo.filename, zinfo.file_size, False, zinfo.CRC), f
+
+
+class SevenZipMemberStream:
+    """File object reading one member out of the concatenated output of '7z x -so', checking its CRC once fully read"""
+    def __init__(self, stream, member: ArchiveMember):
+        self.stream = stream
+        self.member = member
+        self.remaining = member.size
+        self.crc = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+
+        data = self.stream.read(size)
+        if not data:
+            raise ArchiveError(f"ERROR: 7z output ended {self.remaining} bytes before the end of {self.member.name}")
+        self.remaining -= len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        if self.remaining == 0 and self.member.crc is not None and self.crc != self.member.crc:
+            raise ArchiveError(f"ERROR: {self.member.name} has CRC {self.crc:08X}, but the archive says {self.member.crc:08X}")
+        return data
+
+    def skip(self):
+        while self.read(1024 * 1024):
+            pass
+
+
+class SevenZipBackend(ArchiveBackend):
+    """Archive backend for 7z archives (and any other format 7z supports), running the 7z executable"""
+    def __init__(self, path):
+        super().__init__(path)
+        self._members = None
+
+    @staticmethod
+    def defaultArgs():
+        """The 7z arguments used for the whole archive"""
+        if Globals.SEVEN_ZIP_ARGS is not None:
+            return list(Globals.SEVEN_ZIP_ARGS)
+        return ["-md=512m"]
+
+    @staticmethod
+    def splitStoredFiles(view: LayeredFileView, policy: Optional[CompressionPolicy]):
+        """
+        Returns the archive paths of the view's files which the policy compresses, and of those it stores (level STORE).
+        Files with an unknown extension are sampled, like ParallelZipWriter does, so they must be on disk.
+        """
+        compressedPaths = []
+        storedPaths = []
+        for archivePath, file in sorted(view.files.items()):
+            level = policy.levelForExtension(archivePath, file.size) if policy is not None else None
+            if policy is not None and level is None:
+                level = policy.sampleLevel(policy.readSample(file.diskPath(), file.size))
+            (storedPaths if level == CompressionPolicy.STORE else compressedPaths).append(archivePath)
+        return compressedPaths, storedPaths
+
+    @classmethod
+    def create(cls, outputPath, view: LayeredFileView, policy: Optional[CompressionPolicy] = None):
+        """
+        7z can only add files from one folder on disk, so if the view has archive layers or several folders, its files
+        are first placed in a scratch folder next to the output archive: files on disk are hardlinked (see
+        LinkingCopier), and only the files of archive layers are streamed into it. The files of earlier layers which
+        were overridden are never read.
+
+        The files the policy compresses are added with the settings of defaultArgs() by one '7z a' call. If the policy
+        stores some files, they are added without compression ('-m0=Copy') by a second call, which copies the already
+        compressed files into the new archive without compressing them again.
+        """
+        tryRemoveTree(outputPath)
+        outputPath = os.path.abspath(outputPath)
+        os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+        scratchFolder = tempfile.mkdtemp(prefix='.layers-', dir=os.path.dirname(outputPath))
+        listPath = outputPath + '.filelist.txt'
+        try:
+            roots = view.roots()
+            if view.archiveFiles() or len(roots) > 1:
+                copier = LinkingCopier()
+                print(f"Placing {len(view.files)} files from {len(roots)} folders and {len(view.archiveLayers)} archive layers in {scratchFolder}")
+                view = view.materialize(scratchFolder, copier)
+                print(f"Placed the files from folders with {copier.summary() or 'nothing'}")
+                roots = view.roots()
+
+            root = roots.pop() if roots else '.'
+            compressedPaths, storedPaths = cls.splitStoredFiles(view, policy)
+            # Only empty folders need to be listed, as 7z creates the others itself
+            groups = [
+                (compressedPaths + [folder.archivePath for folder in view.emptyFolders], cls.defaultArgs()),
+                (storedPaths, ['-m0=Copy']),
+            ]
+            groups = [group for group in groups if group[0]] or groups[:1]
+            for paths, args in groups:
+                with open(listPath, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(paths) + '\n')
+                print(f"Adding {len(paths)} paths to {outputPath} with {' '.join(args)}")
+                call([getSevenZipExecutable(), "a"] + args + ["-scsUTF-8", outputPath, f'@{listPath}'], cwd=root)
+        finally:
+            tryRemoveTree(listPath)
+            tryRemoveTree(scratchFolder)
+
+        return cls(outputPath)
+
+    def listMembers(self):
+        """Lists the members with '7z l -slt'. The list is only read once per backend."""
+        if self._members is not None:
+            return self._members
+
+        with tempfile.TemporaryFile() as f:
+            call([getSevenZipExecutable(), "l", "-slt", "-sccUTF-8", self.path], stdout=f)
+            f.seek(0)
+            lines = f.read().decode('utf-8').splitlines()
+
+        # The members are listed after a '----------' line, as blocks of 'Key = Value' lines separated by blank lines
+        members = []
+
+        def addMember(properties):
+            if properties and 'Path' in properties:
+                isDir = properties.get('Folder') == '+' or 'D' in properties.get('Attributes', '')
+                crc = properties.get('CRC')
+                members.append(ArchiveMember(properties['Path'].replace('\\', '/'), int(properties.get('Size') or 0), isDir, int(crc, 16) if crc else None))
+
+        properties = None
+        for line in lines:
+            if line == '----------':
+                properties = {}
+            elif properties is None:
+                continue
+            elif line.strip() == '':
+                addMember(properties)
+                properties = {}
+            else:
+                key, _, value = line.partition(' = ')
+                properties[key] = value
+        addMember(properties)
+
+        self._members = members
+        return members
+
+    def iterMembers(self, prefix=None):
+        """
+        Streams the members with a single '7z x -so' process, which writes the selected files one after the other,
+        in archive order. The output is split back into files using the sizes from listMembers().
+        """
+        members = [member for member in self.listMembers() if not member.isDir and isArchiveMemberUnder(member.name, prefix)]
+        if not members:
+            return
+
+        # Select the members by their exact path, so that 7z can't match files with the same name in other folders
+        listFile, listPath = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(listFile, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(member.name for member in members) + '\n')
+
+        args = [getSevenZipExecutable(), "x", "-so", "-y", "-r-", "-scsUTF-8", self.path, f'@{listPath}']
+        print(f"running: {args}")
+        startTime = time.perf_counter()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, shell=isWindows())
+        completed = False
+        try:
+            for member in members:
+                stream = SevenZipMemberStream(process.stdout, member)
+                yield member, stream
+                stream.skip()
+            if process.stdout.read(1):
+                raise ArchiveError(f"ERROR: 7z wrote more data than the members listed in {self.path}")
+            completed = True
+        finally:
+            if not completed:
+                # The caller stopped early or a member was corrupt, so the rest of the output isn't needed
+                process.kill()
+            process.stdout.close()
+            retcode, cpuSeconds = waitForProcess(process)
+            Globals.METRICS.addSubprocess(os.path.basename(args[0]), time.perf_counter() - startTime, retcode, cpuSeconds)
+            tryRemoveTree(listPath)
+
+        if retcode != 0:
+            raise ArchiveError(f"ERROR: Extracting from {self.path} with 7z failed with retcode {retcode}")
+
+    def test(self):
+        # 7z tests the archive faster than streaming every member through Python
+        call([getSevenZipExecutable(), "t", self.path])
+
+
+def getArchiveBackendClass(path):
+    """Zips are handled by Python's zipfile module, and every other archive format by 7z"""
+    return ZipBackend if path.lower().endswith('.zip') else SevenZipBackend
+
+
+def openArchive(path):
+    #type: (str) -> ArchiveBackend
+    return getArchiveBackendClass(path)(path)
+
+
+def verifyArchiveContents(archive: ArchiveBackend, view: LayeredFileView):
+    """
+    Check that an archive contains exactly the files of the view, with the same sizes, and test the CRC of every member
+    (decompressing the archive without extracting it). Raises an exception describing every problem found.
+    """
+    expectedFiles = dict((file.archivePath, file.size) for file in view.files.values())
+
+    archiveFiles = dict((member.name, member.size) for member in archive.listMembers() if not member.isDir)
+
+    errors = []
+    for path in sorted(set(expectedFiles) - set(archiveFiles)):
+        errors.append(f"{path}: missing from the archive")
+    for path in sorted(set(archiveFiles) - set(expectedFiles)):
+        errors.append(f"{path}: in the archive, but not part of the build")
+    for path in sorted(set(archiveFiles) & set(expectedFiles)):
+        if archiveFiles[path] != expectedFiles[path]:
+            errors.append(f"{path}: is {archiveFiles[path]} bytes in the archive, but {expectedFiles[path]} bytes on disk")
+
+    try:
+        archive.test()
+    except Exception as e:
+        errors.append(f"Testing the archive found a corrupt member: {e}")
+
+    if errors:
+        raise Exception(f"ERROR: Verification of {archive.path} failed with {len(errors)} problems:\n" + '\n'.join(f' - {error}' for error in errors))
+
+    print(f"Verified {len(archiveFiles)} files in {archive.path}")
@@ -0,0 +1,682 @@
+"""The stages which build the release archive of one chapter"""
+
+import os
+import stat
+import shutil
+import string
+import glob
+import hashlib
+import posixpath
+import json
+import collections
+import time
+
+from deploy_common import (
+    call, ChapterInfo, CompressionPolicy, copyFileCounted, getManifestPath, Globals, LinkingCopier, loadCompressionProfile,
+    sha256File, tryRemoveTree,
+)
+from deploy_download import download
+from deploy_workspace import (
+    BackgroundRemover, fileEntryFromPath, FileIndex, listFilesRecursive, removeTreeInBackground, Workspace,
+)
+from deploy_zip import (
+    getBaselineZipPaths, getVolumeIndexFiles, getVolumeIndexPath, verifyZipArchive, verifyZipVolumes, writeZipArchive,
+    writeZipVolumes, ZIP_CHUNK_SIZE,
+)
+from deploy_tasks import BuildTask, TaskGraph
+
+
+class ScriptCompileCache:
+    """
+    Caches the output of HigurashiScriptCompiler.exe for each script in the 'Update' folder.
+
+    Each script is keyed by the hash of the script compiler folder, the script's path and the script's contents, and
+    its entry holds the compiled outputs of the script (see matchScriptOutputs()).
+    When the total size of the entries exceeds maxSizeBytes, evict() removes the least recently used entries.
+    """
+    def __init__(self, cacheDir, compilerFolder, maxSizeBytes):
+        self.cacheDir = cacheDir
+        self.compilerFolder = compilerFolder
+        self.maxSizeBytes = maxSizeBytes
+        self.compilerHash = None
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def _getCompilerHash(self):
+        # Only hashed once a script is looked up, as evict() doesn't need it
+        if self.compilerHash is None:
+            h = hashlib.sha256()
+            for relPath in listFilesRecursive(self.compilerFolder):
+                h.update(relPath.encode('utf-8'))
+                h.update(sha256File(os.path.join(self.compilerFolder, relPath)).encode('utf-8'))
+            self.compilerHash = h.hexdigest()
+        return self.compilerHash
+
+    def scriptKey(self, scriptFolder, relPath):
+        h = hashlib.sha256()
+        h.update(self._getCompilerHash().encode('utf-8'))
+        h.update(relPath.encode('utf-8'))
+        h.update(sha256File(os.path.join(scriptFolder, relPath)).encode('utf-8'))
+        return h.hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self.cacheDir, key)
+
+    def contains(self, key):
+        # An empty entry (stored by older versions for a script with no outputs) is treated as missing
+        entryPath = self._entryPath(key)
+        return os.path.isdir(entryPath) and len(os.listdir(entryPath)) > 0
+
+    def restore(self, key, destFolder, copyFunction=copyFileCounted):
+        """Copy the cached outputs for key into destFolder. Returns their paths relative to destFolder, or None if key is not in the cache."""
+        entryPath = self._entryPath(key)
+        if not self.contains(key):
+            return None
+
+        # Update the modification time, which is used to evict the least recently used entries
+        os.utime(entryPath)
+        shutil.copytree(entryPath, destFolder, copy_function=copyFunction, dirs_exist_ok=True)
+        return listFilesRecursive(entryPath)
+
+    def store(self, key, outputFolder, outputRelPaths):
+        """Add the files outputRelPaths (relative to outputFolder) to the cache under key"""
+        entryPath = self._entryPath(key)
+        tempEntryPath = f'{entryPath}.{os.getpid()}.tmp'
+        tryRemoveTree(tempEntryPath)
+        os.makedirs(tempEntryPath)
+        for relPath in outputRelPaths:
+            destPath = os.path.join(tempEntryPath, relPath)
+            os.makedirs(os.path.dirname(destPath), exist_ok=True)
+            copyFileCounted(os.path.join(outputFolder, relPath), destPath)
+
+        try:
+            os.replace(tempEntryPath, entryPath)
+        except OSError:
+            # Another build stored the same entry first
+            tryRemoveTree(tempEntryPath)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in maxSizeBytes"""
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            entryPath = self._entryPath(name)
+            try:
+                mtime = os.stat(entryPath).st_mtime
+                size = sum(os.path.getsize(os.path.join(entryPath, relPath)) for relPath in listFilesRecursive(entryPath))
+            except FileNotFoundError:
+                continue
+            # Leftovers from a build which crashed while storing an entry
+            if name.endswith('.tmp'):
+                if time.time() - mtime > 24 * 60 * 60:
+                    tryRemoveTree(entryPath)
+                continue
+            entries.append((mtime, size, entryPath))
+
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entryPath in sorted(entries):
+            if totalSize <= self.maxSizeBytes:
+                break
+            tryRemoveTree(entryPath)
+            totalSize -= size
+
+
+def getScriptCompileCache():
+    return ScriptCompileCache(os.path.join(Globals.CACHE_DIR, 'compiled_scripts'), os.path.abspath('bin/ScriptCompiler'), Globals.COMPILE_CACHE_SIZE_BYTES)
+
+
+def scriptOutputKey(relPath):
+    """Strips the last extension from a path relative to 'Update' or 'CompiledUpdateScripts', eg. 'sub/onik_001.txt' -> 'sub/onik_001'"""
+    return posixpath.splitext(relPath)[0]
+
+
+def matchScriptOutputs(scriptRelPaths, outputRelPaths):
+    """
+    Returns script -> the list of its compiled outputs, for each script in scriptRelPaths (relative to 'Update').
+    An output (relative to CompiledUpdateScripts) belongs to the script with the same scriptOutputKey(), eg.
+    'onik_001.txt' -> 'onik_001.mg'. If no script matches exactly, the key is compared ignoring case, as long as that
+    only matches one script. Outputs which match no script are left out.
+    """
+    scriptsByKey = collections.defaultdict(list)
+    scriptsByLowerKey = collections.defaultdict(list)
+    for relPath in scriptRelPaths:
+        scriptsByKey[scriptOutputKey(relPath)].append(relPath)
+        scriptsByLowerKey[scriptOutputKey(relPath).lower()].append(relPath)
+
+    outputsByScript = dict((relPath, []) for relPath in scriptRelPaths)
+    for outputRelPath in outputRelPaths:
+        key = scriptOutputKey(outputRelPath)
+        scripts = scriptsByKey.get(key) or scriptsByLowerKey.get(key.lower(), [])
+        if len(scripts) > 1:
+            raise Exception(f"Script Compile Failed: can't tell which of the scripts {scripts} compiled to {outputRelPath}")
+        if scripts:
+            outputsByScript[scripts[0]].append(outputRelPath)
+
+    return outputsByScript
+
+
+def compileScripts(chapter: ChapterInfo, workspace: Workspace, scriptRelPaths=None):
+    """
+    Compiles scripts for the given chapter. If scriptRelPaths (relative to 'Update') is given, only those scripts are
+    compiled. Returns the paths of the compiled outputs of the scripts, relative to CompiledUpdateScripts.
+
+    Expects:
+        - HigurashiScriptCompiler.exe placed adjacent to this script (built from the current chapter's engine code)
+        - Associated DLLs (Antlr3.Runtime.dll, System.Core.dll (might not be required, but include to be safe))
+    """
+    scriptCompilerPath = os.path.abspath('bin/ScriptCompiler/HigurashiScriptCompiler.exe')
+
+    if not os.path.exists(scriptCompilerPath):
+        raise Exception(f"Missing {scriptCompilerPath} - if running script manually, you must put it there yourself!")
+
+    baseFolderName = workspace.baseFolder(chapter)
+
+    print(f"\n\n>> Compiling [{chapter.name}] scripts...")
+
+    # - Define the folder where the update scripts are stored, and where they will be compiled to
+    compileSrcFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/Update')
+    compileDestFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts')
+    tryRemoveTree(compileSrcFolder)
+    tryRemoveTree(compileDestFolder)
+    os.makedirs(compileSrcFolder, exist_ok=True)
+    os.makedirs(compileDestFolder, exist_ok=True)
+
+    # - Look up each script in the compile cache. Only scripts which are not in the cache are compiled.
+    if scriptRelPaths is None:
+        scriptRelPaths = listFilesRecursive('Update')
+    compileCache = None
+    if Globals.USE_COMPILE_CACHE:
+        compileCache = getScriptCompileCache()
+
+    scriptKeys = {}
+    cachedScripts = []
+    scriptsToCompile = []
+    for relPath in scriptRelPaths:
+        if compileCache is not None:
+            scriptKeys[relPath] = compileCache.scriptKey('Update', relPath)
+            if compileCache.contains(scriptKeys[relPath]):
+                cachedScripts.append(relPath)
+                continue
+        scriptsToCompile.append(relPath)
+
+    print(f"{len(cachedScripts)} scripts unchanged (using compile cache), {len(scriptsToCompile)} scripts to compile")
+
+    # - Copy the scripts to be compiled to the base folder, so the game can find it
+    for relPath in scriptsToCompile:
+        destPath = os.path.join(compileSrcFolder, relPath)
+        os.makedirs(os.path.dirname(destPath), exist_ok=True)
+        copyFileCounted(os.path.join('Update', relPath), destPath)
+
+    outputsByScript = {}
+    if scriptsToCompile:
+        runScriptCompiler(scriptCompilerPath, compileSrcFolder, compileDestFolder, workspace)
+        outputsByScript = matchScriptOutputs(scriptsToCompile, listFilesRecursive(compileDestFolder))
+
+        # - Add the newly compiled scripts to the compile cache. A script without outputs is not cached, so it is
+        #   compiled again by the next build rather than restored as nothing.
+        for relPath in scriptsToCompile:
+            if not outputsByScript[relPath]:
+                print(f"WARNING: {relPath} produced no compiled output, so it was not added to the compile cache")
+            elif compileCache is not None:
+                compileCache.store(scriptKeys[relPath], compileDestFolder, outputsByScript[relPath])
+
+    # - Copy the newly compiled scripts to the expected final build dir, and fill in the outputs of the unchanged
+    #   scripts straight from the compile cache (with a persistent staging folder, only files which changed are copied)
+    finalCompiledFolder = f'{workspace.dataFolder(chapter.dataFolderName)}/StreamingAssets/CompiledUpdateScripts'
+    shutil.copytree(compileDestFolder, finalCompiledFolder, copy_function=workspace.copyFile, dirs_exist_ok=True)
+    for relPath in cachedScripts:
+        outputsByScript[relPath] = compileCache.restore(scriptKeys[relPath], finalCompiledFolder, workspace.copyFile)
+        if outputsByScript[relPath] is None:
+            raise Exception(f"Script Compile Failed: compile cache entry for {relPath} disappeared during the build")
+
+    # Clean up
+    removeTreeInBackground(baseFolderName)
+
+    return [outputRelPath for outputs in outputsByScript.values() for outputRelPath in outputs]
+
+
+SCRIPT_COMPILE_STATUS_FILE_NAME = 'higu_script_compile_status.txt'
+
+
+def runScriptCompiler(scriptCompilerPath, compileSrcFolder, compileDestFolder, workspace: Workspace):
+
+    # - Remove status file if it exists (the compiler writes it to its working directory)
+    os.makedirs(workspace.root, exist_ok=True)
+    statusFilePath = os.path.join(workspace.root, SCRIPT_COMPILE_STATUS_FILE_NAME)
+    if os.path.exists(statusFilePath):
+        os.remove(statusFilePath)
+
+    # Make sure script compiler is executable
+    st = os.stat(scriptCompilerPath)
+    os.chmod(scriptCompilerPath, st.st_mode | stat.S_IEXEC)
+
+    # - Run the game with 'quitaftercompile' as argument
+    # Note: generated artifacts currently exclude the 'bin' folder
+    call([scriptCompilerPath, compileSrcFolder, compileDestFolder], cwd=workspace.root)
+
+    # - Check compile status file
+    if not os.path.exists(statusFilePath):
+        raise Exception("Script Compile Failed: Script compilation status file not found")
+
+    with open(statusFilePath, "r") as f:
+        status = f.read().strip()
+        print(f'Game Script Compile Result: {status}')
+        if not status.startswith("Compile OK"):
+            raise Exception(f"Script Compile Failed: Script compilation status indicated status {status}")
+
+    os.remove(statusFilePath)
+
+
+def prepareFiles(dllFolderName, dataFolderName, workspace: Workspace):
+    dataFolder = workspace.dataFolder(dataFolderName)
+    workspace.makeDirs(f'{dataFolder}/StreamingAssets')
+    workspace.makeDirs(f'{dataFolder}/Managed')
+    workspace.makeDirs(f'{dataFolder}/Plugins')
+
+
+# The deploy script and its modules, which are downloaded into the root of the repository being built
+DEPLOY_SCRIPT_FILES = [
+    'deploy_higurashi.py',
+    'deploy_common.py',
+    'deploy_download.py',
+    'deploy_archive.py',
+    'deploy_workspace.py',
+    'deploy_zip.py',
+    'deploy_tasks.py',
+    'deploy_chapter.py',
+    'deploy_plan.py',
+    'deploy_watch.py',
+    'deploy_tune.py',
+]
+
+
+def getIgnoredRepoPaths(dataFolderName, rootJSONFiles, scratchNames=()):
+    """
+    The top level files and folders in the repository that should not be copied to the StreamingAssets folder.
+    scratchNames are files and folders which other stages of the build may create in the repository at the same time.
+    """
+    # Case is ignored for these paths!
+    return [
+        '.git',
+        '.github',
+        '.gitignore',
+        '.gitconfig',
+        'readme.md',
+        '__pycache__',
+        'dev',
+        'temp',
+        'output',
+        'src',
+        'bin',
+        'dll',
+        BackgroundRemover.TRASH_FOLDER_NAME,
+        dataFolderName
+    ] + DEPLOY_SCRIPT_FILES + rootJSONFiles + list(scratchNames)
+
+
+def downloadVideoPlugin(dataFolderName, workspace: Workspace):
+    print("Downloading video plugin...")
+    tempVideoDLLPath = f'{workspace.dataFolder(dataFolderName)}/Plugins/AVProVideo.dll'
+    if workspace.staging is None:
+        download('https://github.com/07th-mod/patch-releases/releases/download/developer-v1.0/AVProVideo.dll', tempVideoDLLPath)
+        return
+
+    # The downloaded copy is always new, so it is compared with the staged plugin by its contents
+    downloadPath = tempVideoDLLPath + '.download'
+    try:
+        download('https://github.com/07th-mod/patch-releases/releases/download/developer-v1.0/AVProVideo.dll', downloadPath)
+        workspace.copyFile(downloadPath, tempVideoDLLPath, byContents=True)
+    finally:
+        tryRemoveTree(downloadPath)
+
+
+def getExtraPatchFiles(rootJSONFiles):
+    """The files outside of the repository's StreamingAssets files which go in the data folder, as (sourcePath, dataFolderRelPath)"""
+    # Note: The modded DLL must be generated in a previous build step
+    extraFiles = [('bin/Release/Assembly-CSharp.dll', 'Managed/Assembly-CSharp.dll')]
+    if os.path.exists('bin/Release/Assembly-CSharp.version.txt'):
+        extraFiles.append(('bin/Release/Assembly-CSharp.version.txt', 'Managed/Assembly-CSharp.version.txt'))
+    else:
+        print("Warning: Failed to copy DLL version information file 'Assembly-CSharp.version.txt'")
+
+    # All top level .json files go in the data folder
+    extraFiles.extend((jsonFilePath, os.path.basename(jsonFilePath)) for jsonFilePath in rootJSONFiles)
+    return extraFiles
+
+
+def buildPatch(dataFolderName, workspace: Workspace, stage=False, stageMode='copy', scratchNames=()):
+    """
+    Collects the files from the repository that make up the patch, returning a list of (FileEntry, archivePath)
+    mappings. Use collectPatchFiles() to combine them with the files generated during the build.
+
+    Files are read directly from the repository when the archive is written, unless 'stage' is True, in which case
+    they are first copied into the workspace's temp folder (using reflinks or hardlinks instead of copies, depending
+    on stageMode - see LinkingCopier), and an empty list is returned.
+    """
+    dataFolder = workspace.dataFolder(dataFolderName)
+
+    rootJSONFiles = glob.glob('*.json')
+
+    # Except for certain ignored files, everything in the current directory goes in the 'Higurashi_Ep0X/StreamingAssets' folder
+    source_folder = '.'
+    repoIndex = FileIndex(source_folder, getIgnoredRepoPaths(dataFolderName, rootJSONFiles, scratchNames))
+    print(f"Indexed {len(repoIndex.entries)} files and folders ({repoIndex.totalSize()} bytes) for the StreamingAssets folder, ignoring the following paths:")
+    for ignoredPath in repoIndex.ignored:
+        print(f' - Ignored [{ignoredPath}]')
+
+    extraFiles = getExtraPatchFiles(rootJSONFiles)
+
+    if stage:
+        for sourcePath, dataFolderRelPath in extraFiles:
+            print(f"Copying {sourcePath} to data folder...")
+            workspace.copyFile(sourcePath, f'{dataFolder}/{dataFolderRelPath}')
+
+        print(f"Staging files in StreamingAssets folder (mode: {stageMode})...")
+        copier = LinkingCopier(stageMode)
+        repoIndex.copyTo(f'{dataFolder}/StreamingAssets', lambda src, dst: workspace.copyFile(src, dst, copier), workspace.makeDirs)
+        print(f"Staged files using: {copier.summary()}")
+
+        return []
+
+    mappings = repoIndex.toMappings(f'{dataFolderName}/StreamingAssets')
+    for sourcePath, dataFolderRelPath in extraFiles:
+        mappings.append((fileEntryFromPath(sourcePath, dataFolderRelPath), f'{dataFolderName}/{dataFolderRelPath}'))
+
+    return mappings
+
+
+def collectPatchFiles(dataFolderName, workspace: Workspace, patchMappings):
+    """
+    Combine the files generated in the workspace's temp folder (compiled scripts, downloaded video plugin and any
+    staged files) with the mappings from buildPatch(), returning the (FileEntry, archivePath) mappings for makeArchive().
+    Folders are only listed once.
+    """
+    if workspace.staging is not None:
+        # Remove staged files which weren't produced by this build (eg. deleted scripts or repository files)
+        workspace.staging.prune(workspace.dataFolder(dataFolderName))
+        print(f"Staging folder synced: {workspace.staging.summary()}")
+        Globals.METRICS.annotate(staging=dict(workspace.staging.counts))
+
+    mappings = FileIndex(workspace.dataFolder(dataFolderName)).toMappings(dataFolderName) + patchMappings
+
+    uniqueMappings = {}
+    for entry, archivePath in mappings:
+        if archivePath in uniqueMappings and not archivePath.endswith('/'):
+            raise Exception(f"ERROR: {archivePath} would be added to the archive twice (from {uniqueMappings[archivePath].path} and {entry.path})")
+        uniqueMappings.setdefault(archivePath, entry)
+
+    # Recorded so that --plan can scale the time of earlier builds to the size of the next one
+    Globals.METRICS.annotate(inputFiles=sum(1 for entry in uniqueMappings.values() if not entry.isDir), inputBytes=sum(entry.size for entry in uniqueMappings.values()))
+    return [(entry, archivePath) for archivePath, entry in uniqueMappings.items()]
+
+
+def getArchiveBaseName(chapterName):
+    # Turns the first letter of the chapter name into uppercase for consistency when uploading a release
+    upperChapter = string.capwords(chapterName, '-')
+
+    # Console arcs archive name is different from chapter name
+    if chapterName == 'console':
+        upperChapter = 'ConsoleArcs'
+
+    return f'output/{upperChapter}.Voice.and.Graphics.Patch'
+
+
+def removeStaleReleaseFiles(archivePath, keepPaths):
+    """Remove the single zip, volumes and index of an earlier build of archivePath which aren't in keepPaths"""
+    base, extension = os.path.splitext(archivePath)
+    stalePaths = [archivePath, getVolumeIndexPath(archivePath)] + glob.glob(glob.escape(base) + '.vol*' + extension)
+    for path in stalePaths:
+        if os.path.abspath(path) not in keepPaths:
+            tryRemoveTree(path)
+            tryRemoveTree(getManifestPath(path))
+
+
+# The compression settings of a chapter's archive. 'profile' is the profile stored by --tune, if it is used.
+ArchiveSettings = collections.namedtuple('ArchiveSettings', ['policy', 'chunkSize', 'workers', 'profile'])
+
+
+def getArchiveSettings(chapter: ChapterInfo, args, concurrentBuilds=1):
+    """
+    The archive settings of the chapter: the settings stored by --tune, unless the command line chooses a policy.
+    Unless --zip-workers is given, the threads are shared between the chapters built at the same time.
+    """
+    profile = None
+    if not (args.uniformCompression or args.compressionPolicy is not None or args.noCompressionProfile or args.tune):
+        profile = loadCompressionProfile('zip', chapter.name)
+
+    workers = args.zipWorkers
+    if workers is None:
+        workers = profile['settings']['workers'] if profile is not None else os.cpu_count() or 1
+        workers = max(1, workers // concurrentBuilds)
+    if profile is None:
+        return ArchiveSettings(Globals.COMPRESSION_POLICY, ZIP_CHUNK_SIZE, workers, None)
+
+    settings = profile['settings']
+    return ArchiveSettings(CompressionPolicy.forProfile(settings['method'], settings['level']), settings['chunkSizeMB'] * 1024 * 1024, workers, profile)
+
+
+def getArchiveOptions(settings: ArchiveSettings):
+    """Everything besides the files which changes the bytes of the archive. The number of workers doesn't."""
+    options = {'policy': settings.policy.toDict(), 'chunkSize': settings.chunkSize}
+    if settings.profile is not None:
+        options['profile'] = dict((key, value) for key, value in settings.profile['settings'].items() if key != 'workers')
+    return json.dumps(options, sort_keys=True)
+
+
+def makeArchive(chapterName, mappings, settings: ArchiveSettings, baselinePaths=(), maxVolumeBytes=None):
+    """
+    Write the release zip of a chapter and return its path. If maxVolumeBytes is given, the release is split into
+    volumes instead (see writeZipVolumes()), and the path of the volume index is returned.
+    """
+    os.makedirs('output', exist_ok=True)
+    outputPath = os.path.abspath(getArchiveBaseName(chapterName) + '.zip')
+    print(f"Writing {len(mappings)} entries to {outputPath} using {settings.workers or os.cpu_count()} threads")
+    if maxVolumeBytes is None:
+        releasePath = writeZipArchive(mappings, outputPath, settings.workers, baselinePaths, settings.policy, settings.chunkSize)
+        keepPaths = [releasePath]
+    else:
+        releasePath = writeZipVolumes(mappings, outputPath, maxVolumeBytes, settings.workers, baselinePaths, settings.policy, settings.chunkSize)
+        keepPaths = [releasePath] + [os.path.abspath(path) for path in getVolumeIndexFiles(releasePath)]
+
+    # Only done once the new release is written, as the baseline may be the previous release
+    removeStaleReleaseFiles(outputPath, keepPaths)
+    return releasePath
+
+
+def getChapterList():
+    return [
+        ChapterInfo("onikakushi",       1, "https://github.com/07th-mod/patch-releases/releases/download/onikakushi-v1.0/Onikakushi-UI_5.2.2f1_win.7z"),
+        ChapterInfo("watanagashi",      2, "https://github.com/07th-mod/patch-releases/releases/download/watanagashi-v1.0/Watanagashi-UI_5.2.2f1_win.7z"),
+        ChapterInfo("tatarigoroshi",    3, "https://github.com/07th-mod/patch-releases/releases/download/tatarigoroshi-v1.0/Tatarigoroshi-UI_5.4.0f1_win.7z"),
+        ChapterInfo("himatsubushi",     4, "https://github.com/07th-mod/patch-releases/releases/download/himatsubushi-v1.0/Himatsubushi-UI_5.4.1f1_win.7z"),
+        ChapterInfo("console",          4, "https://github.com/07th-mod/patch-releases/releases/download/himatsubushi-v1.0/Himatsubushi-UI_5.4.1f1_win.7z", baseName="himatsubushi", dllFolderName="consolearcs"), # Console uses same base archive as Himatsubushi
+        ChapterInfo("meakashi",         5, "https://github.com/07th-mod/patch-releases/releases/download/meakashi-v1.0/Meakashi-UI_5.5.3p3_win.7z"),
+        ChapterInfo("tsumihoroboshi",   6, "https://github.com/07th-mod/patch-releases/releases/download/tsumihoroboshi-v1.0/Tsumihoroboshi-UI_5.5.3p3_win.7z"),
+        ChapterInfo("minagoroshi",      7, "https://github.com/07th-mod/patch-releases/releases/download/minagoroshi-v1.0/Minagoroshi-UI_5.6.7f1_win.7z"),
+        ChapterInfo("matsuribayashi",   8, "https://github.com/07th-mod/patch-releases/releases/download/matsuribayashi-v1.0/Matsuribayashi-UI_2017.2.5_win.7z"),
+        ChapterInfo("rei",              9, "https://github.com/07th-mod/patch-releases/releases/download/rei-v1.0/Rei-UI_2019.4.3_win.7z"),
+        # TODO: Remove UI files from https://07th-mod.com/misc/script_building/hou_base.7z archive, and use mod UI file
+        ChapterInfo("hou",             10, None), #"Hou-UI_2019.4.3_win.7z") # Skip Hou UI for now
+    ]
+
+
+def resolveChapter(chapterName, chapterDict):
+    chapter = chapterDict.get(chapterName)
+
+    # Add special case for chapters where the repo name doesn't match the chapter name
+    if chapter is None:
+        if chapterName.lower() == 'higurashi-rei':
+            print(f"Converting chapter argument '{chapterName}' to 'rei'")
+            chapter = chapterDict.get('rei')
+
+    if chapter is None:
+        if chapterName.lower() == 'hou-plus':
+            print(f"Converting chapter argument '{chapterName}' to 'hou'")
+            chapter = chapterDict.get('hou')
+
+    if chapter is None:
+        if chapterName.lower() == 'higurashi-console-arcs':
+            print(f"Converting chapter argument '{chapterName}' to 'console'")
+            chapter = chapterDict.get('console')
+
+    if chapter is None:
+        raise Exception(f"Error: Unknown Chapter '{chapterName}' Selected\n\n{help}")
+
+    return chapter
+
+
+def fingerprintMappings(mappings, workspace: Workspace, extra=''):
+    """
+    Fingerprint the files that will be written to the archive. Repository files are identified by their size and
+    modification time. Files in the workspace's temp folder are rewritten on every build, so their contents are hashed,
+    unless the temp folder is a persistent staging folder, where unchanged files keep their modification time.
+    """
+    h = hashlib.sha256(extra.encode('utf-8'))
+    tempDir = os.path.abspath(workspace.tempDir) + os.sep
+    hashTempFiles = workspace.staging is None or workspace.staging.checksum
+    for entry, archivePath in sorted(mappings, key=lambda mapping: mapping[1]):
+        h.update(archivePath.encode('utf-8'))
+        if entry.isDir:
+            continue
+        if hashTempFiles and os.path.abspath(entry.path).startswith(tempDir):
+            h.update(sha256File(entry.path).encode('utf-8'))
+        else:
+            h.update(f'{entry.size}:{entry.mtime}'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def getCompileScratchNames(chapter: ChapterInfo, workspace: Workspace):
+    """compileScripts runs at the same time as buildPatch, so its scratch files must not be indexed"""
+    return [os.path.basename(workspace.baseFolder(chapter)), SCRIPT_COMPILE_STATUS_FILE_NAME]
+
+
+def getStageStatePath(chapter: ChapterInfo):
+    """Where the TaskGraph of buildChapter() keeps its fingerprints, which are stored per repository and chapter"""
+    repoHash = hashlib.sha256(os.path.abspath('.').encode('utf-8')).hexdigest()[:16]
+    return os.path.join(Globals.CACHE_DIR, 'stage_state', f'{repoHash}-{chapter.name}.json')
+
+
+def buildChapter(chapter: ChapterInfo, workspace: Workspace, args, concurrentBuilds=1):
+    """
+    Build the archive for a chapter, while concurrentBuilds chapters are being built at the same time. Returns the path
+    of the release and the (FileEntry, archivePath) mappings it was built from. The stages run as a TaskGraph:
+
+        prepareFiles --+--> compileScripts ------+
+                       +--> downloadPlugin ------+--> collectPatchFiles --> makeArchive --> verifyArchive --> cleanup
+                       +--> buildPatch ----------+
+
+    Only makeArchive and verifyArchive have fingerprints. The stages before them write into the temp folder, which
+    prepareFiles clears on every build, so they always run: they stay cheap on an unchanged repository through their
+    own caches (the compile cache, the download cache and the staging sync or FileIndex), and their results are what
+    the makeArchive fingerprint is computed from.
+    """
+    print(f">>> Building chapter {chapter.name}")
+    baselinePaths = []
+    if args.baselineArchive is not None:
+        # In a multi-chapter build, the baseline argument is a folder containing the previous release of each chapter
+        baselinePath = args.baselineArchive
+        if os.path.isdir(baselinePath):
+            baselinePath = os.path.join(baselinePath, os.path.basename(getArchiveBaseName(chapter.name)) + '.zip')
+
+        baselinePaths = getBaselineZipPaths(baselinePath)
+        if not baselinePaths:
+            print(f"Warning: Baseline archive {baselinePath} (or its volumes) not found - all files will be compressed")
+
+    archivePath = os.path.abspath(getArchiveBaseName(chapter.name) + '.zip')
+    archiveSettings = getArchiveSettings(chapter, args, concurrentBuilds)
+    archiveOptions = getArchiveOptions(archiveSettings)
+    maxVolumeBytes = None
+    releasePath = archivePath
+    releaseFiles = [archivePath, getManifestPath(archivePath)]
+    if args.volumeSizeMB is not None:
+        maxVolumeBytes = args.volumeSizeMB * 1024 * 1024
+        archiveOptions += f':volumes={maxVolumeBytes}'
+        releasePath = getVolumeIndexPath(archivePath)
+        # The volumes of the last build are taken from its index. If the index is missing, the archive is always rebuilt.
+        releaseFiles = [releasePath] + getVolumeIndexFiles(releasePath)
+
+    graph = TaskGraph(getStageStatePath(chapter), force=args.force)
+
+    def prepare():
+        workspace.clearTemp()
+        prepareFiles(chapter.dllFolderName, chapter.dataFolderName, workspace)
+
+    def compile(_):
+        if not args.noCompile:
+            compileScripts(chapter, workspace)
+
+    def cleanup(_):
+        print(">>> Cleaning up the mess")
+        workspace.clearTemp()
+
+    graph.add(BuildTask('prepareFiles', prepare))
+    graph.add(BuildTask('compileScripts', compile, ['prepareFiles']))
+    graph.add(BuildTask('downloadPlugin', lambda _: downloadVideoPlugin(chapter.dataFolderName, workspace), ['prepareFiles']))
+    graph.add(BuildTask('buildPatch', lambda _: buildPatch(chapter.dataFolderName, workspace, stage=args.stage, stageMode=args.stageMode, scratchNames=getCompileScratchNames(chapter, workspace)), ['prepareFiles']))
+    graph.add(BuildTask('collectPatchFiles', lambda _, __, patchMappings: collectPatchFiles(chapter.dataFolderName, workspace, patchMappings), ['compileScripts', 'downloadPlugin', 'buildPatch']))
+    graph.add(BuildTask('makeArchive',
+                        lambda mappings: makeArchive(chapter.name, mappings, archiveSettings, baselinePaths, maxVolumeBytes),
+                        ['collectPatchFiles'],
+                        fingerprint=lambda mappings: fingerprintMappings(mappings, workspace, archiveOptions),
+                        outputs=releaseFiles,
+                        skippedResult=releasePath))
+    def verify(mappings, releasePath):
+        try:
+            if maxVolumeBytes is None:
+                verifyZipArchive(releasePath, mappings, archiveSettings.workers)
+            else:
+                verifyZipVolumes(releasePath, mappings, archiveSettings.workers)
+        except Exception:
+            # Remove the bad archive, so it can't be released by mistake and is rebuilt by the next build
+            for path in [releasePath, getManifestPath(releasePath)] + getVolumeIndexFiles(releasePath):
+                tryRemoveTree(path)
+            raise
+
+    def verifyFingerprint(mappings, releasePath):
+        signature = archiveOptions
+        for path in [releasePath] + getVolumeIndexFiles(releasePath):
+            try:
+                st = os.stat(path)
+                signature += f':{st.st_size}:{st.st_mtime_ns}'
+            except FileNotFoundError:
+                # Verifying reports the missing file
+                signature += ':missing'
+        return fingerprintMappings(mappings, workspace, signature)
+
+    if not args.noVerify:
+        graph.add(BuildTask('verifyArchive', verify, ['collectPatchFiles', 'makeArchive'], fingerprint=verifyFingerprint, outputs=[releasePath]))
+
+    graph.add(BuildTask('cleanup', cleanup, ['makeArchive'] if args.noVerify else ['verifyArchive']))
+
+    results = graph.run()
+    return results['makeArchive'], results['collectPatchFiles']
+
+
+def getRepoFileArchivePath(chapter: ChapterInfo, path, extraFiles, ignoredNames):
+    """
+    The archive path of a repository file (relative to the repository root) using the same rules as buildPatch(), or
+    None if it doesn't go in the archive. extraFiles is from getExtraPatchFiles(), and ignoredNames from getIgnoredRepoPaths().
+    """
+    path = os.path.normpath(path)
+    for sourcePath, dataFolderRelPath in extraFiles:
+        if os.path.normpath(sourcePath) == path:
+            return f'{chapter.dataFolderName}/{dataFolderRelPath}'
+
+    parts = path.split(os.sep)
+    if os.path.normcase(parts[0]).lower() in set(os.path.normcase(name).lower() for name in ignoredNames):
+        return None
+    return f'{chapter.dataFolderName}/StreamingAssets/' + '/'.join(parts)
+
+
+def getRepoMappings(chapter: ChapterInfo):
+    """
+    The (FileEntry, archivePath) mappings of the repository files which go in the chapter's archive, using the same
+    rules as buildPatch(), without copying anything. Returns the FileIndex of the repository and the mappings.
+    """
+    rootJSONFiles = glob.glob('*.json')
+    repoIndex = FileIndex('.', getIgnoredRepoPaths(chapter.dataFolderName, rootJSONFiles, getCompileScratchNames(chapter, Workspace('.'))))
+    mappings = repoIndex.toMappings(f'{chapter.dataFolderName}/StreamingAssets')
+    for sourcePath, dataFolderRelPath in getExtraPatchFiles(rootJSONFiles):
+        if not os.path.exists(sourcePath):
+            print(f"Warning: {sourcePath} does not exist - the build will fail")
+            continue
+        mappings.append((fileEntryFromPath(sourcePath, dataFolderRelPath), f'{chapter.dataFolderName}/{dataFolderRelPath}'))
+    return repoIndex, mappings
@@ -0,0 +1,644 @@
+"""Shared helpers of the deploy scripts: global settings, build metrics, file helpers and compression policies"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+import hashlib
+import json
+import zlib
+import threading
+import random
+import contextlib
+from typing import List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Only for the annotations of Globals, as these modules import this one
+    from deploy_download import DownloadCache, Downloader
+    from deploy_workspace import BackgroundRemover
+    from deploy_zip import CompressedBlobStore
+
+
+class Globals:
+    SEVEN_ZIP_EXECUTABLE = None
+    # Root folder for all persistent build caches (downloads, compiled scripts etc.)
+    CACHE_DIR = os.environ.get('HIGURASHI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'higurashi_release'))
+    DOWNLOAD_CACHE: 'Optional[DownloadCache]' = None
+    DOWNLOADER: 'Downloader' = None
+    BLOB_STORE: 'Optional[CompressedBlobStore]' = None
+    COMPRESSION_POLICY: 'CompressionPolicy' = None
+    METRICS: 'BuildMetrics' = None
+    TREE_REMOVER: 'BackgroundRemover' = None
+    USE_COMPILE_CACHE = True
+    COMPILE_CACHE_SIZE_BYTES = 512 * 1024 * 1024
+    # 7z arguments chosen by --tune, used instead of the default '-md=512m' for files which are compressed
+    SEVEN_ZIP_ARGS: Optional[List[str]] = None
+
+
+def findWorkingExecutablePath(executable_paths, flags):
+	#type: (List[str], List[str]) -> str
+	"""
+	Try to execute each path in executable_paths to see which one can be called and returns exit code 0
+	The 'flags' argument is any extra flags required to make the executable return 0 exit code
+	:param executable_paths: a list [] of possible executable paths (eg. "./7za", "7z")
+	:param flags: a list [] of any extra flags like "-h" required to make the executable have a 0 exit code
+	:return: the path of the valid executable, or None if no valid executables found
+	"""
+	with open(os.devnull, 'w') as os_devnull:
+		for path in executable_paths:
+			try:
+				if subprocess.call([path] + flags, stdout=os_devnull, stderr=os_devnull) == 0:
+					return path
+			except:
+				pass
+
+	return None
+
+
+def isWindows():
+    return sys.platform == "win32"
+
+
+class BuildMetrics:
+    """
+    Records the wall time, CPU time, bytes read and written, number of files and subprocess durations of each stage
+    of the build. Stages can be nested - counters are added to the innermost stage running on the current thread.
+    Threads which aren't running a stage (eg. compression workers) add to the most recently started stage.
+    Stages can run at the same time on different threads, in which case their CPU times overlap. The CPU time of
+    subprocesses is measured for each subprocess (see waitForProcess()), and childCpuSeconds is the total of the
+    subprocesses the stage itself ran, so it doesn't include the subprocesses of stages running at the same time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.perf_counter()
+        self.stages = []
+        self.activeStages = []
+        self.threadState = threading.local()
+
+    def _threadStack(self):
+        if not hasattr(self.threadState, 'stack'):
+            self.threadState.stack = []
+        return self.threadState.stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        threadStack = self._threadStack()
+        with self.lock:
+            record = {
+                'name': name,
+                'parent': threadStack[-1]['name'] if threadStack else None,
+                'startSeconds': time.perf_counter() - self.startTime,
+                'wallSeconds': 0,
+                'cpuSeconds': 0,
+                'childCpuSeconds': 0,
+                'bytesRead': 0,
+                'bytesWritten': 0,
+                'files': 0,
+                'dedupedBytes': 0,
+                'subprocesses': [],
+            }
+            self.stages.append(record)
+            self.activeStages.append(record)
+            threadStack.append(record)
+
+        startWall = time.perf_counter()
+        startCPU = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wallSeconds'] = time.perf_counter() - startWall
+            record['cpuSeconds'] = time.process_time() - startCPU
+            with self.lock:
+                self.activeStages.remove(record)
+                threadStack.remove(record)
+
+    def _currentStage(self):
+        threadStack = self._threadStack()
+        if threadStack:
+            return threadStack[-1]
+        return self.activeStages[-1] if self.activeStages else None
+
+    def add(self, bytesRead=0, bytesWritten=0, files=0, dedupedBytes=0):
+        with self.lock:
+            record = self._currentStage()
+            if record is None:
+                return
+            record['bytesRead'] += bytesRead
+            record['bytesWritten'] += bytesWritten
+            record['files'] += files
+            record['dedupedBytes'] += dedupedBytes
+
+    def annotate(self, **values):
+        """Add extra values (which must be JSON serializable) to the current stage's record"""
+        with self.lock:
+            record = self._currentStage()
+            if record is not None:
+                record.update(values)
+
+    def addSubprocess(self, name, seconds, retcode, cpuSeconds=None):
+        """Record a subprocess. cpuSeconds is None where it can't be measured (on Windows)."""
+        with self.lock:
+            record = self._currentStage()
+            if record is not None:
+                record['subprocesses'].append({'name': name, 'seconds': seconds, 'retcode': retcode, 'cpuSeconds': cpuSeconds})
+                record['childCpuSeconds'] += cpuSeconds or 0
+
+    def toDict(self):
+        topLevelStages = [stage for stage in self.stages if stage['parent'] is None]
+        return {
+            'stages': self.stages,
+            # Stages may overlap, so the total is the time from the first stage starting to the last one finishing
+            'totalWallSeconds': max((stage['startSeconds'] + stage['wallSeconds'] for stage in topLevelStages), default=0) - min((stage['startSeconds'] for stage in topLevelStages), default=0),
+            # The CPU time of nested stages is part of their parent's, but each subprocess is only recorded in one stage
+            'totalCpuSeconds': sum(stage['cpuSeconds'] for stage in topLevelStages) + sum(stage['childCpuSeconds'] for stage in self.stages),
+            'dedupedBytes': sum(stage['dedupedBytes'] for stage in self.stages),
+        }
+
+
+Globals.METRICS = BuildMetrics()
+
+
+def writeBuildReport(reportPath, chapterReports):
+    """
+    Write the metrics of each chapter (chapter name -> BuildMetrics.toDict()) as a JSON report.
+    Returns a short summary of the wall time of each stage, for use as a Github Actions output.
+    """
+    os.makedirs(os.path.dirname(reportPath), exist_ok=True)
+    # Bytes which were not compressed again, because the same file was already compressed for this or another chapter
+    dedupedBytes = sum(report.get('dedupedBytes', 0) for report in chapterReports.values())
+    with open(reportPath, 'w') as f:
+        json.dump({'createdAt': time.time(), 'dedupedBytes': dedupedBytes, 'chapters': chapterReports}, f, indent=2)
+
+    summary = {}
+    for chapterName, report in chapterReports.items():
+        stageSeconds = {}
+        for stage in report['stages']:
+            stageSeconds[stage['name']] = round(stageSeconds.get(stage['name'], 0) + stage['wallSeconds'], 3)
+        summary[chapterName] = stageSeconds
+
+    print(f"\n>>> Build timings (full report in {reportPath}):")
+    for chapterName, stageSeconds in summary.items():
+        print(f" - [{chapterName}] " + ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in stageSeconds.items()))
+    if dedupedBytes > 0:
+        print(f" - Deduplicated {dedupedBytes / 1024 / 1024:.1f} MB of files which were already compressed")
+
+    return summary
+
+
+def getCompressionProfilePath():
+    return os.path.join(Globals.CACHE_DIR, 'compression_profile.json')
+
+
+def loadCompressionProfile(archiveType, name):
+    """Returns the profile stored by saveCompressionProfile() for the 'zip' or '7z' archive of a chapter, or None if there isn't one"""
+    try:
+        with open(getCompressionProfilePath(), 'r') as f:
+            profile = json.load(f).get(archiveType, {}).get(name)
+    except (OSError, ValueError, AttributeError):
+        return None
+    return profile if isinstance(profile, dict) and 'settings' in profile else None
+
+
+def saveCompressionProfile(archiveType, name, profile):
+    """Store the tuned profile for the 'zip' or '7z' archive of a chapter, keeping the profiles of other chapters"""
+    profilePath = getCompressionProfilePath()
+    try:
+        with open(profilePath, 'r') as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    # Files from older versions have a single profile for every chapter instead
+    if not isinstance(profiles.get(archiveType), dict) or 'settings' in profiles[archiveType]:
+        profiles[archiveType] = {}
+    profiles[archiveType][name] = profile
+
+    os.makedirs(os.path.dirname(profilePath), exist_ok=True)
+    tempPath = f'{profilePath}.{os.getpid()}.tmp'
+    with open(tempPath, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tempPath, profilePath)
+    return profilePath
+
+
+def removeExistingFile(path):
+    """
+    Remove path if it is an existing file. Files must be removed before being overwritten, because a staged file may be
+    a hardlink to a file in the repository, and writing to it would modify the repository too.
+    """
+    try:
+        if not os.path.isdir(path):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def copyFileCounted(src, dst):
+    """shutil.copy2() which also records the copied bytes in the build metrics. Can be used as a copytree() copy_function."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    removeExistingFile(dst)
+    result = shutil.copy2(src, dst)
+    size = os.path.getsize(src)
+    Globals.METRICS.add(bytesRead=size, bytesWritten=size, files=1)
+    return result
+
+
+def waitForProcess(process: subprocess.Popen):
+    """
+    Wait for a process to exit. Returns its return code, and the CPU time used by the process (and any children it
+    waited for), or None on Windows, where os.wait4() doesn't exist.
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+def call(args, **kwargs):
+    print(f"running: {args} kwargs: {kwargs}")
+    startTime = time.perf_counter()
+    with subprocess.Popen(args, shell=isWindows(), **kwargs) as process:  # use shell on windows
+        try:
+            retcode, cpuSeconds = waitForProcess(process)
+        except BaseException:
+            # Same as subprocess.call(), eg. on Ctrl+C
+            process.kill()
+            raise
+    # Only the executable name is recorded, to avoid leaking secrets in the build report
+    Globals.METRICS.addSubprocess(os.path.basename(str(args[0])), time.perf_counter() - startTime, retcode, cpuSeconds)
+    if retcode != 0:
+        # don't print args here to avoid leaking secrets
+        raise Exception(f"ERROR: The last call() failed with retcode {retcode}")
+
+
+def tryRemoveTree(path):
+    attempts = 5
+    for i in range(attempts):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            return
+
+        except FileNotFoundError:
+            return
+        except Exception:
+            print(f'Warning: Failed to remove "{path}" attempt {i}/{attempts}')
+            traceback.print_exc()
+
+        time.sleep(1)
+
+
+def sha256File(path, chunkSize=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ChapterInfo:
+    def __init__(self, name, episodeNumber, uiArchiveURL: str, baseName=None, dllFolderName=None):
+        self.name = name
+        self.episodeNumber = episodeNumber
+        self.dataFolderName = f'HigurashiEp{episodeNumber:02}_Data'
+        if uiArchiveURL:
+            self.uiArchiveURL = uiArchiveURL
+            self.uiArchiveName = uiArchiveURL.split('/')[-1]
+        else:
+            self.uiArchiveURL = None
+            self.uiArchiveName = None
+
+        self.baseName = baseName if baseName is not None else self.name
+        self.dllFolderName = dllFolderName if dllFolderName is not None else self.name
+
+
+def reflinkFile(src, dst):
+    """
+    Create dst as a copy-on-write clone of src. Returns False if this OS has no reflink support.
+    Raises OSError if the filesystem doesn't support it (or src and dst are on different filesystems).
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        FICLONE = 0x40049409
+        with open(src, 'rb') as srcFile, open(dst, 'wb') as dstFile:
+            try:
+                fcntl.ioctl(dstFile.fileno(), FICLONE, srcFile.fileno())
+            except OSError:
+                dstFile.close()
+                os.remove(dst)
+                raise
+        shutil.copystat(src, dst)
+        return True
+
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dst)
+        return True
+
+    return False
+
+
+class LinkingCopier:
+    """
+    A copytree() style copy_function which stages files as reflinks, hardlinks or copies ('auto' tries them in that
+    order). Hardlinks share their contents with the repository, so staged files must be removed before writing to them.
+    """
+    def __init__(self, mode='auto'):
+        self.useReflink = mode in ('auto', 'reflink')
+        self.useHardlink = mode in ('auto', 'hardlink')
+        self.counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+
+    def __call__(self, src, dst):
+        removeExistingFile(dst)
+
+        if self.useReflink:
+            try:
+                if reflinkFile(src, dst):
+                    self.counts['reflink'] += 1
+                    Globals.METRICS.add(files=1)
+                    return dst
+            except OSError:
+                pass
+            # Don't try again for every file if reflinks aren't supported here
+            self.useReflink = False
+
+        if self.useHardlink:
+            try:
+                os.link(src, dst)
+                self.counts['hardlink'] += 1
+                Globals.METRICS.add(files=1)
+                return dst
+            except OSError:
+                self.useHardlink = False
+
+        self.counts['copy'] += 1
+        return copyFileCounted(src, dst)
+
+    def summary(self):
+        return ', '.join(f'{count} {kind}' for kind, count in self.counts.items() if count)
+
+
+class CompressionPolicy:
+    """
+    Chooses the deflate level of each file by its lower case extension, where STORE (0) means no compression.
+    Large files with an unknown extension are stored if compressing a sample saves less than minSavings.
+    """
+    STORE = 0
+
+    DEFAULT_LEVELS = {
+        # Already compressed media and archives
+        '.ogg': STORE, '.mp3': STORE, '.m4a': STORE, '.png': STORE, '.jpg': STORE, '.jpeg': STORE,
+        '.mp4': STORE, '.webm': STORE, '.ogv': STORE, '.zip': STORE, '.7z': STORE, '.gz': STORE, '.unity3d': STORE,
+        # Text, scripts and code
+        '.txt': 9, '.mg': 9, '.json': 9, '.xml': 9, '.csv': 9, '.cs': 9, '.shader': 9, '.dll': 9,
+    }
+
+    def __init__(self, levels=None, defaultLevel=zlib.Z_DEFAULT_COMPRESSION, sampleThreshold=256 * 1024, sampleSize=64 * 1024, minSavings=0.05):
+        self.levels = dict(CompressionPolicy.DEFAULT_LEVELS if levels is None else levels)
+        self.defaultLevel = defaultLevel
+        self.sampleThreshold = sampleThreshold
+        self.sampleSize = sampleSize
+        self.minSavings = minSavings
+
+    @staticmethod
+    def uniform(level=zlib.Z_DEFAULT_COMPRESSION):
+        """Compress every file at the same level, without sampling"""
+        return CompressionPolicy(levels={}, defaultLevel=level, sampleThreshold=None)
+
+    @staticmethod
+    def forProfile(method, level):
+        """
+        The policy for a tuned compression profile (see tuneChapter()). The 'policy' method stores the extensions which
+        are stored by default and compresses everything else at 'level', and the 'uniform' method compresses every file.
+        """
+        if method == 'uniform':
+            return CompressionPolicy.uniform(level)
+        storedLevels = dict((extension, level) for extension, level in CompressionPolicy.DEFAULT_LEVELS.items() if level == CompressionPolicy.STORE)
+        return CompressionPolicy(storedLevels, defaultLevel=level)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a policy from a JSON file, eg. {"levels": {".ogg": 0, ".txt": 9}, "defaultLevel": 6}.
+        The levels are added to (and override) the default levels, unless "replaceDefaultLevels" is true.
+        """
+        with open(path, 'r') as f:
+            config = json.load(f)
+
+        levels = {} if config.get('replaceDefaultLevels') else dict(CompressionPolicy.DEFAULT_LEVELS)
+        for extension, level in config.get('levels', {}).items():
+            if not -1 <= level <= 9:
+                raise Exception(f"ERROR: Invalid compression level {level} for {extension} in {path}")
+            levels[extension.lower()] = level
+
+        return CompressionPolicy(
+            levels,
+            config.get('defaultLevel', zlib.Z_DEFAULT_COMPRESSION),
+            config.get('sampleThreshold', 256 * 1024),
+            config.get('sampleSize', 64 * 1024),
+            config.get('minSavings', 0.05),
+        )
+
+    def toDict(self):
+        return {
+            'levels': self.levels,
+            'defaultLevel': self.defaultLevel,
+            'sampleThreshold': self.sampleThreshold,
+            'sampleSize': self.sampleSize,
+            'minSavings': self.minSavings,
+        }
+
+    @staticmethod
+    def extension(path):
+        return os.path.splitext(path)[1].lower()
+
+    def levelForExtension(self, path, fileSize):
+        """Returns the level for the file, or None if its level should be decided by sampleLevel()"""
+        level = self.levels.get(CompressionPolicy.extension(path))
+        if level is not None:
+            return level
+        if self.sampleThreshold is None or fileSize < self.sampleThreshold:
+            return self.defaultLevel
+        return None
+
+    def sample(self, data):
+        """Returns sampleSize bytes from the middle of data"""
+        start = max(0, (len(data) - self.sampleSize) // 2)
+        return data[start:start + self.sampleSize]
+
+    def readSample(self, path, fileSize):
+        with open(path, 'rb') as f:
+            f.seek(max(0, (fileSize - self.sampleSize) // 2))
+            data = f.read(self.sampleSize)
+        Globals.METRICS.add(bytesRead=len(data))
+        return data
+
+    def sampleLevel(self, sample):
+        """Returns STORE if sample (see sample()/readSample()) barely compresses, otherwise the default level"""
+        if len(sample) == 0:
+            return self.defaultLevel
+        compressedSize = len(zlib.compress(sample, 1))
+        return CompressionPolicy.STORE if compressedSize > len(sample) * (1 - self.minSavings) else self.defaultLevel
+
+
+class CompressionSavings:
+    """
+    Estimates the CPU time saved, and the difference in size, of storing files instead of compressing them.
+    The first samplesPerExtension stored files of each extension have a sample compressed with 'compress'
+    (a function of bytes -> compressed bytes), and the result is extrapolated to every stored file of that extension.
+    """
+    def __init__(self, compress, samplesPerExtension=8):
+        self.compress = compress
+        self.samplesPerExtension = samplesPerExtension
+        self.lock = threading.Lock()
+        # extension -> [storedFiles, storedBytes, sampledBytes, sampleSeconds, sampleCompressedBytes]
+        self.extensions = {}
+
+    def addStored(self, path, fileSize, sample):
+        """Record that a file was stored. 'sample' is a callable returning a sample of the file's contents."""
+        extension = CompressionPolicy.extension(path)
+        with self.lock:
+            stats = self.extensions.setdefault(extension, [0, 0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += fileSize
+            shouldSample = stats[0] <= self.samplesPerExtension
+
+        if not shouldSample:
+            return
+
+        data = sample()
+        startTime = time.thread_time()
+        compressedSize = len(self.compress(data))
+        seconds = time.thread_time() - startTime
+        with self.lock:
+            stats[2] += len(data)
+            stats[3] += seconds
+            stats[4] += compressedSize
+
+    def toDict(self):
+        storedFiles = 0
+        storedBytes = 0
+        cpuSecondsSaved = 0
+        sizeDifference = 0
+        with self.lock:
+            for files, size, sampledBytes, sampleSeconds, sampleCompressedBytes in self.extensions.values():
+                storedFiles += files
+                storedBytes += size
+                if sampledBytes > 0:
+                    cpuSecondsSaved += sampleSeconds * size / sampledBytes
+                    sizeDifference += (sampledBytes - sampleCompressedBytes) * size / sampledBytes
+
+        return {
+            'storedFiles': storedFiles,
+            'storedBytes': storedBytes,
+            'estimatedCpuSecondsSaved': round(cpuSecondsSaved, 3),
+            'estimatedSizeDifferenceBytes': int(sizeDifference),
+        }
+
+
+def getManifestPath(archivePath):
+    return archivePath + '.manifest.json'
+
+
+def writeArchiveManifest(archivePath, entries):
+    """
+    Write the manifest of an archive next to it. The manifest lists the path, size, SHA-256 and position in the
+    archive of each file, so that clients can compare it with their installed files and only fetch changed files.
+    """
+    manifestPath = getManifestPath(archivePath)
+    tempManifestPath = manifestPath + '.part'
+    with open(tempManifestPath, 'w') as f:
+        json.dump({
+            'archive': os.path.basename(archivePath),
+            'archiveSize': os.path.getsize(archivePath),
+            'entries': entries,
+        }, f, indent=1)
+    os.replace(tempManifestPath, manifestPath)
+    return manifestPath
+
+
+def stageTuningSample(files, maxBytes, sampleFolder):
+    """
+    Copy a representative sample of at most about maxBytes of files (a list of (sourcePath, archivePath, size)) into
+    sampleFolder, at their archive paths. Each extension gets a share of maxBytes in proportion to its share of the
+    total size, which is filled with randomly chosen files (the same ones on every run), and a file larger than the
+    rest of its share is truncated. Returns the number of files and bytes in the sample.
+    """
+    byExtension = {}
+    for file in files:
+        byExtension.setdefault(os.path.splitext(file[1])[1].lower(), []).append(file)
+    totalSize = sum(size for _, _, size in files) or 1
+
+    rng = random.Random(0)
+    sampleFiles = 0
+    sampleBytes = 0
+    for extension, extensionFiles in sorted(byExtension.items()):
+        budget = maxBytes * sum(size for _, _, size in extensionFiles) / totalSize
+        extensionFiles = sorted(extensionFiles)
+        rng.shuffle(extensionFiles)
+        for sourcePath, archivePath, size in extensionFiles:
+            if budget <= 0:
+                break
+            length = min(size, int(budget) + 1)
+            outputPath = os.path.join(sampleFolder, *archivePath.split('/'))
+            os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+            with open(sourcePath, 'rb') as inputFile, open(outputPath, 'wb') as outputFile:
+                remaining = length
+                while remaining > 0:
+                    data = inputFile.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    outputFile.write(data)
+                    remaining -= len(data)
+            budget -= length
+            sampleFiles += 1
+            sampleBytes += length
+    return sampleFiles, sampleBytes
+
+
+def paretoFrontier(results):
+    """
+    Returns the results (dicts with 'seconds', 'size' and 'peakMemoryBytes') which no other result beats on every
+    measurement, sorted by time. A peak memory of None (not measurable on this platform) is not compared.
+    """
+    def measurements(result):
+        return (result['seconds'], result['size'], result['peakMemoryBytes'] or 0)
+
+    frontier = []
+    for result in results:
+        dominated = any(
+            all(a <= b for a, b in zip(measurements(other), measurements(result))) and measurements(other) != measurements(result)
+            for other in results
+        )
+        if not dominated:
+            frontier.append(result)
+    return sorted(frontier, key=measurements)
+
+
+def chooseTunedResult(frontier, sizeTolerance, maxMemoryBytes=None):
+    """
+    Choose the fastest result of the frontier whose size is within sizeTolerance (eg. 0.01 for 1%) of the smallest,
+    ignoring results which used more than maxMemoryBytes
+    """
+    candidates = [result for result in frontier if maxMemoryBytes is None or result['peakMemoryBytes'] is None or result['peakMemoryBytes'] <= maxMemoryBytes]
+    if not candidates:
+        raise Exception(f"ERROR: Every compression setting used more than {maxMemoryBytes} bytes of memory")
+    smallestSize = min(result['size'] for result in candidates)
+    candidates = [result for result in candidates if result['size'] <= smallestSize * (1 + sizeTolerance)]
+    return min(candidates, key=lambda result: (result['seconds'], result['peakMemoryBytes'] or 0))
+
+
+def printTuningResults(results, frontier, chosen):
+    print(f"\n>>> Pareto frontier of {len(results)} settings (time, size and peak memory), * = chosen:")
+    for result in frontier:
+        peakMemory = 'unknown' if result['peakMemoryBytes'] is None else f"{result['peakMemoryBytes'] / 1024 / 1024:.1f} MB"
+        settings = ', '.join(f'{name}={value}' for name, value in result['settings'].items())
+        print(f" {'*' if result is chosen else ' '} {result['seconds']:8.2f}s {result['size']:>14} bytes {peakMemory:>12}  {settings}")
@@ -0,0 +1,465 @@
+"""Downloads with retries, parallel range requests and a persistent download cache"""
+
+import os
+import shutil
+import time
+import hashlib
+import concurrent.futures
+import json
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import threading
+
+from deploy_common import Globals, removeExistingFile, sha256File, tryRemoveTree
+
+
+def applyDownloadMirror(url):
+    """
+    If the HIGURASHI_DOWNLOAD_MIRROR environment variable is set (eg. 'http://127.0.0.1:8000'), github.com URLs
+    are redirected to it. This lets a local HTTP server stand in for Github releases when testing.
+    """
+    mirror = os.environ.get('HIGURASHI_DOWNLOAD_MIRROR')
+    githubPrefix = 'https://github.com'
+    if mirror and url.startswith(githubPrefix):
+        return mirror.rstrip('/') + url[len(githubPrefix):]
+    return url
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Downloader:
+    """
+    In-process HTTP downloader. Large files are downloaded in segments over several connections if the server supports
+    range requests, interrupted downloads resume from their '.state' file, and requests are retried with backoff.
+    """
+    # HTTP status codes which are worth retrying
+    RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, connections=4, minSegmentSize=4 * 1024 * 1024, timeout=60, retries=5, backoffSeconds=1.0, chunkSize=256 * 1024):
+        self.connections = max(1, connections)
+        self.minSegmentSize = minSegmentSize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoffSeconds = backoffSeconds
+        self.chunkSize = chunkSize
+
+    def _withRetries(self, description, func):
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except urllib.error.HTTPError as e:
+                if e.code not in Downloader.RETRY_STATUS_CODES or attempt == self.retries:
+                    raise
+                error = e
+            except (urllib.error.URLError, http.client.HTTPException, OSError, DownloadError) as e:
+                if attempt == self.retries:
+                    raise
+                error = e
+
+            delay = self.backoffSeconds * (2 ** attempt)
+            print(f"Warning: {description} failed ({error}), retrying in {delay:.1f}s (attempt {attempt + 1}/{self.retries})")
+            time.sleep(delay)
+
+    def _probe(self, url, headers):
+        """
+        Send a HEAD request, returning None if the server reports the file is not modified, otherwise a dict with the
+        final URL (after redirects), size, whether range requests are supported, and the ETag/Last-Modified headers.
+        """
+        def head():
+            request = urllib.request.Request(url, headers=headers, method='HEAD')
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    size = response.headers.get('Content-Length')
+                    return {
+                        'url': response.geturl(),
+                        'size': int(size) if size is not None else None,
+                        'acceptRanges': response.headers.get('Accept-Ranges', '').lower() == 'bytes',
+                        'etag': response.headers.get('ETag'),
+                        'lastModified': response.headers.get('Last-Modified'),
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return None
+                if e.code in (403, 405, 501):
+                    # Some servers don't allow HEAD requests - download the file with a single GET request instead
+                    return {'url': url, 'size': None, 'acceptRanges': False, 'etag': None, 'lastModified': None}
+                raise
+
+        return self._withRetries(f"HEAD {url}", head)
+
+    @staticmethod
+    def _loadState(statePath, info):
+        """Returns the completed segments of a previous download of the same file, or an empty list"""
+        try:
+            with open(statePath, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+
+        if state.get('size') != info['size'] or not (info['etag'] or info['lastModified']):
+            return []
+        if state.get('etag') != info['etag'] or state.get('lastModified') != info['lastModified']:
+            return []
+        return [tuple(segment) for segment in state.get('completedSegments', [])]
+
+    @staticmethod
+    def _saveState(statePath, info, completedSegments):
+        tempPath = statePath + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump({
+                'size': info['size'],
+                'etag': info['etag'],
+                'lastModified': info['lastModified'],
+                'completedSegments': sorted(completedSegments),
+            }, f)
+        os.replace(tempPath, statePath)
+
+    def _downloadSegment(self, info, partPath, start, end):
+        """Download bytes start to end (inclusive) into the same position in partPath, resuming on retry"""
+        progress = [start]
+
+        def fetch():
+            request = urllib.request.Request(info['url'], headers={'Range': f'bytes={progress[0]}-{end}'})
+            with urllib.request.urlopen(request, timeout=self.timeout) as response, open(partPath, 'r+b') as f:
+                if response.status != 206:
+                    raise DownloadError(f"server ignored the range request (status {response.status})")
+                f.seek(progress[0])
+                while progress[0] <= end:
+                    data = response.read(min(self.chunkSize, end + 1 - progress[0]))
+                    if not data:
+                        raise DownloadError(f"connection closed after {progress[0] - start} of {end + 1 - start} bytes")
+                    f.write(data)
+                    progress[0] += len(data)
+                    Globals.METRICS.add(bytesRead=len(data))
+
+        self._withRetries(f"Download of bytes {start}-{end} of {info['url']}", fetch)
+
+    def _downloadSegments(self, info, partPath):
+        """Download the file over several connections with range requests. Returns the number of bytes downloaded."""
+        statePath = partPath + '.state'
+        completedSegments = set(Downloader._loadState(statePath, info)) if os.path.exists(partPath) else set()
+        if not completedSegments:
+            with open(partPath, 'wb') as f:
+                f.truncate(info['size'])
+
+        size = info['size']
+        segmentSize = max(self.minSegmentSize, -(-size // self.connections))
+        segments = [(start, min(start + segmentSize, size) - 1) for start in range(0, size, segmentSize)]
+        remainingSegments = [segment for segment in segments if segment not in completedSegments]
+        if completedSegments:
+            print(f"Resuming download: {len(segments) - len(remainingSegments)} of {len(segments)} segments already downloaded")
+
+        lock = threading.Lock()
+
+        def downloadSegment(segment):
+            self._downloadSegment(info, partPath, *segment)
+            with lock:
+                completedSegments.add(segment)
+                Downloader._saveState(statePath, info, completedSegments)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for _ in executor.map(downloadSegment, remainingSegments):
+                pass
+
+        tryRemoveTree(statePath)
+        return sum(end + 1 - start for start, end in remainingSegments)
+
+    def _downloadStream(self, url, partPath, headers):
+        """Download the file with a single GET request. Returns None if not modified, else the response headers."""
+        def fetch():
+            request = urllib.request.Request(url, headers=headers)
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return None
+                raise
+
+            size = 0
+            with response, open(partPath, 'wb') as f:
+                for data in iter(lambda: response.read(self.chunkSize), b''):
+                    f.write(data)
+                    size += len(data)
+                    Globals.METRICS.add(bytesRead=len(data))
+
+                expectedLength = response.headers.get('Content-Length')
+                if expectedLength is not None and int(expectedLength) != size:
+                    raise DownloadError(f"truncated (got {size} of {expectedLength} bytes)")
+
+            return response.headers
+
+        return self._withRetries(f"Download of {url}", fetch)
+
+    def downloadPart(self, url, partPath, expectedSHA256=None, headers=None):
+        """
+        Download url to partPath, which is kept along with partPath + '.state' to resume an interrupted download.
+        'headers' are sent with the first request, for example If-None-Match to revalidate a cached copy.
+        Returns None if the server reported the file is not modified, otherwise a dict with the sha256, size,
+        ETag and Last-Modified of the downloaded file.
+        """
+        headers = headers or {}
+        startTime = time.perf_counter()
+
+        info = self._probe(url, headers)
+        if info is None:
+            return None
+
+        connections = 1
+        if info['acceptRanges'] and info['size'] is not None and info['size'] > 0:
+            connections = min(self.connections, max(1, info['size'] // self.minSegmentSize))
+            bytesDownloaded = self._downloadSegments(info, partPath)
+        else:
+            responseHeaders = self._downloadStream(url, partPath, headers)
+            if responseHeaders is None:
+                return None
+            info['etag'] = responseHeaders.get('ETag')
+            info['lastModified'] = responseHeaders.get('Last-Modified')
+            bytesDownloaded = os.path.getsize(partPath)
+
+        sha256 = sha256File(partPath)
+        if expectedSHA256 is not None and sha256 != expectedSHA256.lower():
+            tryRemoveTree(partPath)
+            raise Exception(f"ERROR: {url} has sha256 {sha256} but expected {expectedSHA256}")
+
+        size = os.path.getsize(partPath)
+        seconds = time.perf_counter() - startTime
+        throughput = bytesDownloaded / max(seconds, 1e-9)
+        print(f"Downloaded {bytesDownloaded} bytes of {url} in {seconds:.2f}s ({throughput / 1024 / 1024:.1f} MB/s, {connections} connections)")
+        Globals.METRICS.annotate(downloadedBytes=bytesDownloaded, downloadBytesPerSecond=round(throughput), downloadConnections=connections)
+        return {
+            'sha256': sha256,
+            'size': size,
+            'etag': info['etag'],
+            'lastModified': info['lastModified'],
+        }
+
+    def download(self, url, outputPath, expectedSHA256=None, headers=None):
+        """Download url to outputPath, via outputPath + '.part' (see downloadPart())"""
+        partPath = outputPath + '.part'
+        result = self.downloadPart(url, partPath, expectedSHA256, headers)
+        if result is not None:
+            removeExistingFile(outputPath)
+            os.replace(partPath, outputPath)
+        return result
+
+
+Globals.DOWNLOADER = Downloader()
+
+
+class DownloadCache:
+    """
+    Persistent on-disk cache for downloaded build artifacts.
+
+    Files are stored once per content hash in 'blobs/<sha256>', and 'index.json' maps each URL to the blob it last
+    resolved to, along with the ETag/Last-Modified headers used to revalidate it on the next build.
+    When the total size of the blobs exceeds maxSizeBytes, the least recently used blobs are evicted.
+    """
+    def __init__(self, cacheDir, maxSizeBytes):
+        self.cacheDir = cacheDir
+        self.blobDir = os.path.join(cacheDir, 'blobs')
+        self.indexPath = os.path.join(cacheDir, 'index.json')
+        self.lockPath = os.path.join(cacheDir, 'index.lock')
+        self.maxSizeBytes = maxSizeBytes
+        # If False, cached files are used without asking the server whether they have changed
+        self.revalidate = True
+        os.makedirs(self.blobDir, exist_ok=True)
+
+    def _acquireLock(self, timeout=60):
+        # Simple lock file so that several builds can share one cache folder
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.close(os.open(self.lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lockPath) > timeout:
+                        print(f"Warning: Removing stale download cache lock {self.lockPath}")
+                        os.remove(self.lockPath)
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                if time.time() > deadline:
+                    raise Exception(f"ERROR: Timed out waiting for download cache lock {self.lockPath}")
+                time.sleep(0.1)
+
+    def _releaseLock(self):
+        try:
+            os.remove(self.lockPath)
+        except FileNotFoundError:
+            pass
+
+    def _loadIndex(self):
+        try:
+            with open(self.indexPath, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _saveIndex(self, index):
+        tempPath = self.indexPath + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tempPath, self.indexPath)
+
+    def _blobPath(self, sha256):
+        return os.path.join(self.blobDir, sha256)
+
+    def _updateIndex(self, url, entry):
+        self._acquireLock()
+        try:
+            index = self._loadIndex()
+            if entry is None:
+                index.pop(url, None)
+            else:
+                index[url] = entry
+            self._evict(index)
+            self._saveIndex(index)
+        finally:
+            self._releaseLock()
+
+    def _evict(self, index):
+        """Remove least recently used blobs until the cache fits in maxSizeBytes. Must hold the lock."""
+        blobLastUsed = {}
+        for entry in index.values():
+            blobLastUsed[entry['sha256']] = max(blobLastUsed.get(entry['sha256'], 0), entry.get('lastUsed', 0))
+
+        blobs = []
+        for name in os.listdir(self.blobDir):
+            path = self._blobPath(name)
+            # Skip partial downloads (see _lockPartPath()), and their lock and state files
+            if '.part' in name or not os.path.isfile(path):
+                continue
+            blobs.append((blobLastUsed.get(name, 0), os.path.getsize(path), name))
+
+        totalSize = sum(size for _, size, _ in blobs)
+        for lastUsed, size, name in sorted(blobs):
+            if totalSize <= self.maxSizeBytes:
+                break
+            print(f"Evicting {name} ({size} bytes) from download cache")
+            tryRemoveTree(self._blobPath(name))
+            totalSize -= size
+            for url in [url for url, entry in index.items() if entry['sha256'] == name]:
+                del index[url]
+
+    def _lockPartPath(self, url):
+        """
+        Returns the '.part' path to download url to, and the path of its lock file. The same URL always uses the same
+        path, so an interrupted download can be resumed. If another build is already downloading url, a unique path is
+        used instead.
+        """
+        partPath = os.path.join(self.blobDir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.part')
+        lockPath = partPath + '.lock'
+        try:
+            # Locks left behind by a build which crashed
+            if time.time() - os.path.getmtime(lockPath) > 6 * 60 * 60:
+                tryRemoveTree(lockPath)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return partPath, lockPath
+        except FileExistsError:
+            return os.path.join(self.blobDir, f'{os.getpid()}-{time.time_ns()}.part'), None
+
+    def _fetch(self, url, entry):
+        """
+        Fetch url into a new blob, revalidating against entry (if any).
+        Returns the new index entry, or the old entry if the server reported it is unchanged.
+        """
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+
+        # The file keeps its '.part' name, which _evict() ignores, until it is moved to its blob path
+        partPath, lockPath = self._lockPartPath(url)
+        try:
+            result = Globals.DOWNLOADER.downloadPart(url, partPath, headers=headers)
+            if result is None:
+                if entry is None:
+                    raise Exception(f"ERROR: {url} was reported as not modified, but there is no cached copy")
+                print(f"Download cache: {url} not modified, using cached copy")
+                return entry
+
+            blobPath = self._blobPath(result['sha256'])
+            if os.path.exists(blobPath):
+                os.remove(partPath)
+            else:
+                os.replace(partPath, blobPath)
+        finally:
+            if lockPath is None:
+                # Unique paths can't be resumed, so don't leave them behind
+                tryRemoveTree(partPath)
+                tryRemoveTree(partPath + '.state')
+            else:
+                tryRemoveTree(lockPath)
+
+        print(f"Download cache: stored {url} ({result['size']} bytes, sha256 {result['sha256']})")
+        return result
+
+    def fetch(self, url, outputPath, expectedSHA256=None):
+        """
+        Copy the (possibly cached) contents of url to outputPath.
+        The cached file is always re-hashed before use, and is re-downloaded if it is corrupt.
+        """
+        entry = self._loadIndex().get(url)
+        if entry is not None and not os.path.exists(self._blobPath(entry['sha256'])):
+            entry = None
+
+        try:
+            newEntry = entry if entry is not None and not self.revalidate else self._fetch(url, entry)
+        except Exception as e:
+            if entry is None:
+                raise
+            print(f"Warning: Failed to revalidate {url} ({e}), using cached copy")
+            newEntry = entry
+
+        blobPath = self._blobPath(newEntry['sha256'])
+        actualSHA256 = sha256File(blobPath)
+        if actualSHA256 != newEntry['sha256'] or os.path.getsize(blobPath) != newEntry['size']:
+            print(f"Warning: Cached copy of {url} is corrupt, downloading again")
+            tryRemoveTree(blobPath)
+            self._updateIndex(url, None)
+            newEntry = self._fetch(url, None)
+            blobPath = self._blobPath(newEntry['sha256'])
+
+        if expectedSHA256 is not None and newEntry['sha256'] != expectedSHA256.lower():
+            raise Exception(f"ERROR: {url} has sha256 {newEntry['sha256']} but expected {expectedSHA256}")
+
+        removeExistingFile(outputPath)
+        shutil.copyfile(blobPath, outputPath)
+        Globals.METRICS.add(bytesRead=newEntry['size'] * 2, bytesWritten=newEntry['size'], files=1)
+
+        newEntry = dict(newEntry, lastUsed=time.time())
+        self._updateIndex(url, newEntry)
+
+
+def download(url, outputPath=None, expectedSHA256=None):
+    """
+    Download url to outputPath (defaults to the last part of the URL, in the current folder), returning outputPath.
+    If the download cache is enabled, previously downloaded files are revalidated and reused.
+    """
+    if outputPath is None:
+        outputPath = urllib.parse.unquote(url.split('/')[-1])
+
+    url = applyDownloadMirror(url)
+    print(f"Starting download of URL: {url}")
+
+    with Globals.METRICS.stage('download'):
+        removeExistingFile(outputPath)
+        if Globals.DOWNLOAD_CACHE is not None:
+            Globals.DOWNLOAD_CACHE.fetch(url, outputPath, expectedSHA256)
+        else:
+            Globals.DOWNLOADER.download(url, outputPath, expectedSHA256)
+            Globals.METRICS.add(bytesWritten=os.path.getsize(outputPath), files=1)
+
+    return outputPath
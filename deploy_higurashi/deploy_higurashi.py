@@ -1,243 +1,108 @@
 import os
-import stat
-import shutil
 import string
-import subprocess
 import sys
 import argparse
 import time
 import traceback
+import atexit
+import concurrent.futures
+import json
 import glob
-from sys import argv, exit, stdout
 from typing import List
 
-class Globals:
-    SEVEN_ZIP_EXECUTABLE = None
-
-def findWorkingExecutablePath(executable_paths, flags):
-	#type: (List[str], List[str]) -> str
-	"""
-	Try to execute each path in executable_paths to see which one can be called and returns exit code 0
-	The 'flags' argument is any extra flags required to make the executable return 0 exit code
-	:param executable_paths: a list [] of possible executable paths (eg. "./7za", "7z")
-	:param flags: a list [] of any extra flags like "-h" required to make the executable have a 0 exit code
-	:return: the path of the valid executable, or None if no valid executables found
-	"""
-	with open(os.devnull, 'w') as os_devnull:
-		for path in executable_paths:
-			try:
-				if subprocess.call([path] + flags, stdout=os_devnull, stderr=os_devnull) == 0:
-					return path
-			except:
-				pass
-
-	return None
-
-def isWindows():
-    return sys.platform == "win32"
-
-def call(args, **kwargs):
-    print(f"running: {args} kwargs: {kwargs}")
-    retcode = subprocess.call(args, shell=isWindows(), **kwargs)  # use shell on windows
-    if retcode != 0:
-        # don't print args here to avoid leaking secrets
-        raise Exception(f"ERROR: The last call() failed with retcode {retcode}")
-
-def tryRemoveTree(path):
-    attempts = 5
-    for i in range(attempts):
-        try:
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
-            return
-
-        except FileNotFoundError:
-            return
-        except Exception:
-            print(f'Warning: Failed to remove "{path}" attempt {i}/{attempts}')
-            traceback.print_exc()
-
-        time.sleep(1)
-
-
-def sevenZipMakeArchive(input_path, output_filename):
-    tryRemoveTree(output_filename)
-    call([Globals.SEVEN_ZIP_EXECUTABLE, "a", output_filename, input_path])
-
-
-def sevenZipExtract(input_path, outputDir=None):
-    args = [Globals.SEVEN_ZIP_EXECUTABLE, "x", input_path, '-y']
-    if outputDir:
-        args.append('-o' + outputDir)
-
-    call(args)
-
-
-def download(url):
-    print(f"Starting download of URL: {url}")
-    call(['curl', '-OJLf', url])
-
-
-class ChapterInfo:
-    def __init__(self, name, episodeNumber, uiArchiveURL: str, baseName=None, dllFolderName=None):
-        self.name = name
-        self.episodeNumber = episodeNumber
-        self.dataFolderName = f'HigurashiEp{episodeNumber:02}_Data'
-        if uiArchiveURL:
-            self.uiArchiveURL = uiArchiveURL
-            self.uiArchiveName = uiArchiveURL.split('/')[-1]
-        else:
-            self.uiArchiveURL = None
-            self.uiArchiveName = None
-
-        self.baseName = baseName if baseName is not None else self.name
-        self.dllFolderName = dllFolderName if dllFolderName is not None else self.name
-
-def compileScripts(chapter: ChapterInfo):
+from deploy_common import BuildMetrics, ChapterInfo, CompressionPolicy, Globals, writeBuildReport
+from deploy_download import DownloadCache, Downloader
+from deploy_workspace import BackgroundRemover, removeTreeInBackground, Workspace
+from deploy_zip import CompressedBlobStore
+from deploy_chapter import buildChapter, getChapterList, getScriptCompileCache, resolveChapter
+from deploy_plan import appendBuildHistory, planChapter
+from deploy_watch import watchChapter
+from deploy_tune import tuneChapter
+
+
+def evictCaches():
+    """Shrink the caches to their maximum size. Called once the builds are done, so no chapter is still reading them."""
+    if Globals.BLOB_STORE is not None:
+        Globals.BLOB_STORE.evict()
+    if Globals.USE_COMPILE_CACHE:
+        getScriptCompileCache().evict()
+
+
+def setupGlobals(args):
+    """Set up Globals from the command line arguments. Also called by each process of a multi-chapter build, as Globals are not shared between processes."""
+    Globals.CACHE_DIR = args.cacheDir
+    Globals.TREE_REMOVER = BackgroundRemover()
+    Globals.DOWNLOADER = Downloader(args.downloadConnections, timeout=args.downloadTimeout, retries=args.downloadRetries)
+    Globals.USE_COMPILE_CACHE = not args.noCompileCache
+    Globals.COMPILE_CACHE_SIZE_BYTES = args.compileCacheSizeMB * 1024 * 1024
+    if not args.noDownloadCache:
+        Globals.DOWNLOAD_CACHE = DownloadCache(os.path.join(Globals.CACHE_DIR, 'downloads'), args.downloadCacheSizeMB * 1024 * 1024)
+    # The policy given on the command line. Chapters with a profile stored by --tune may use another, see getArchiveSettings().
+    if args.uniformCompression:
+        Globals.COMPRESSION_POLICY = CompressionPolicy.uniform()
+    elif args.compressionPolicy is not None:
+        Globals.COMPRESSION_POLICY = CompressionPolicy.load(args.compressionPolicy)
+    else:
+        Globals.COMPRESSION_POLICY = CompressionPolicy()
+    if not args.noBlobStore:
+        Globals.BLOB_STORE = CompressedBlobStore(os.path.join(Globals.CACHE_DIR, 'compressed_blobs'), args.blobStoreSizeMB * 1024 * 1024)
+
+
+def buildChapterWorker(chapter: ChapterInfo, workspaceRoot, args, concurrentBuilds):
     """
-    Compiles scripts for the given chapter.
-
-    Expects:
-        - HigurashiScriptCompiler.exe placed adjacent to this script (built from the current chapter's engine code)
-        - Associated DLLs (Antlr3.Runtime.dll, System.Core.dll (might not be required, but include to be safe))
+    Entry point for each process of a multi-chapter build.
+    Returns a dict describing the result instead of raising, so that one failed chapter doesn't hide the results of the others.
     """
-    scriptCompilerPath = os.path.abspath(f'bin/ScriptCompiler/HigurashiScriptCompiler.exe')
-
-    if not os.path.exists(scriptCompilerPath):
-        raise Exception(f"Missing {scriptCompilerPath} - if running script manually, you must put it there yourself!")
-
-    baseFolderName = f'{chapter.baseName}_base'
-
-    print(f"\n\n>> Compiling [{chapter.name}] scripts...")
-
-    # - Define the folder where the update scripts are stored, and where they will be compiled to
-    compileSrcFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/Update')
-    compileDestFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts')
-    os.makedirs(compileDestFolder, exist_ok=True)
-
-    # - Copy the Update folder containing the scripts to be compiled to the base folder, so the game can find it
-    shutil.copytree(f'Update', compileSrcFolder, dirs_exist_ok=True)
-
-    # - Remove status file if it exists
-    statusFilePath = f'higu_script_compile_status.txt'
-    if os.path.exists(statusFilePath):
-        os.remove(statusFilePath)
-
-    # Make sure script compiler is executable
-    st = os.stat(scriptCompilerPath)
-    os.chmod(scriptCompilerPath, st.st_mode | stat.S_IEXEC)
-
-    # - Run the game with 'quitaftercompile' as argument
-    # Note: generated artifacts currently exclude the 'bin' folder
-    call([scriptCompilerPath, compileSrcFolder, compileDestFolder])
-
-    # - Check compile status file
-    if not os.path.exists(statusFilePath):
-        raise Exception("Script Compile Failed: Script compilation status file not found")
-
-    with open(statusFilePath, "r") as f:
-        status = f.read().strip()
-        print(f'Game Script Compile Result: {status}')
-        if not status.startswith("Compile OK"):
-            raise Exception(f"Script Compile Failed: Script compilation status indicated status {status}")
+    setupGlobals(args)
 
-    os.remove(statusFilePath)
-
-    # - Copy the CompiledUpdateScripts folder to the expected final build dir
-    shutil.copytree(compileDestFolder, f'temp/{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts', dirs_exist_ok=True)
-
-    # Clean up
-    tryRemoveTree(baseFolderName)
-
-def prepareFiles(dllFolderName, dataFolderName):
-    os.makedirs(f'temp/{dataFolderName}/StreamingAssets', exist_ok=True)
-    os.makedirs(f'temp/{dataFolderName}/Managed', exist_ok=True)
-    os.makedirs(f'temp/{dataFolderName}/Plugins', exist_ok=True)
-
-
-def buildPatch(dataFolderName):
-	# Note: The modded DLL must be generated in a previous build step
-    shutil.copy('bin/Release/Assembly-CSharp.dll', f'temp/{dataFolderName}/Managed/Assembly-CSharp.dll')
-
-    print("Downloading video plugin...")
-    if os.path.exists('AVProVideo.dll'):
-        os.remove('AVProVideo.dll')
-    download('https://github.com/07th-mod/patch-releases/releases/download/developer-v1.0/AVProVideo.dll')
-    tempVideoDLLPath = f'temp/{dataFolderName}/Plugins/AVProVideo.dll'
-    print(f"Moving video plugin to {tempVideoDLLPath}...")
-    shutil.move('AVProVideo.dll', tempVideoDLLPath)
+    # A process may build more than one chapter, so each chapter gets new metrics
+    Globals.METRICS = BuildMetrics()
 
+    startTime = time.perf_counter()
+    result = {'chapter': chapter.name, 'archive': None, 'error': None}
     try:
-        shutil.copy('bin/Release/Assembly-CSharp.version.txt', f'temp/{dataFolderName}/Managed/Assembly-CSharp.version.txt')
-    except:
-        print("Warning: Failed to copy DLL version information file 'Assembly-CSharp.version.txt'")
-
-    rootJSONFiles = glob.glob('*.json')
-
-    # Except for certain ignored files, copy everything in the current directory to the 'temp/Higurashi_Ep0X/StreamingAssets' folder
-    source_folder = '.'
-
-    def ignoreFilter(folderPath, folderContents):
-        # Case is ignored for these paths!
-        ignoreList = [
-            '.git',
-            '.github',
-            '.gitignore',
-            '.gitconfig',
-            'readme.md',
-            'deploy_higurashi.py',
-            'dev',
-            'temp',
-            'output',
-            'src',
-            'bin',
-            'dll',
-            dataFolderName
-        ] #type: list[str]
-
-        ignoreList = [p.lower() for p in ignoreList]
-
-        ignored_children = []
-
-        for child in folderContents:
-            fullPath = os.path.join(folderPath, child)
-            realPath = os.path.realpath(fullPath)
-            relPath = os.path.relpath(realPath, start=source_folder)
-            nPath = os.path.normcase(os.path.normpath(relPath))
-            if nPath.lower() in ignoreList or nPath in rootJSONFiles:
-                ignored_children.append(child)
-
-        for child in ignored_children:
-            print(f' - Ignored [{child}]')
-
-        return ignored_children
-
-    print("Copying files to StreamingAssets folder, but ignoring the following paths:")
-    shutil.copytree(source_folder, f'temp/{dataFolderName}/StreamingAssets', ignore=ignoreFilter, dirs_exist_ok=True)
-
-    # Copy all top level .json files
-    print("Copying top level *.json files...")
-    for jsonFilePath in rootJSONFiles:
-        print(f"Copying {jsonFilePath} to data folder...")
-        shutil.copy(jsonFilePath, f'temp/{dataFolderName}')
-
-
-def makeArchive(chapterName, dataFolderName):
-    # Turns the first letter of the chapter name into uppercase for consistency when uploading a release
-    upperChapter = string.capwords(chapterName, '-')
-
-    # Console arcs archive name is different from chapter name
-    if chapterName == 'console':
-        upperChapter = 'ConsoleArcs'
-
-    os.makedirs(f'output', exist_ok=True)
-    shutil.make_archive(base_name=f'output/{upperChapter}.Voice.and.Graphics.Patch',
-                        format='zip',
-                        root_dir='temp',
-                        base_dir=dataFolderName
-                        )
+        result['archive'], _ = buildChapter(chapter, Workspace(workspaceRoot, args.keepStaging, args.stagingChecksum), args, concurrentBuilds)
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = str(e)
+    finally:
+        if not args.keepStaging:
+            removeTreeInBackground(workspaceRoot)
+        # Worker processes don't run atexit hooks, and the parent may remove 'temp' once this returns
+        Globals.TREE_REMOVER.waitForAll()
+
+    result['seconds'] = time.perf_counter() - startTime
+    result['metrics'] = Globals.METRICS.toDict()
+    return result
+
+
+def buildChaptersInParallel(chapters: List[ChapterInfo], args):
+    """
+    Build several chapters at once, each in a separate process with its own workspace folder inside 'temp'.
+    Returns a list of result dicts (see buildChapterWorker()), in the same order as 'chapters'.
+    """
+    concurrentBuilds = min(args.jobs, len(chapters))
+    print(f">>> Building {len(chapters)} chapters using {concurrentBuilds} processes")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=concurrentBuilds) as executor:
+        futures = [
+            executor.submit(buildChapterWorker, chapter, os.path.join('temp', 'workspaces', chapter.name), args, concurrentBuilds)
+            for chapter in chapters
+        ]
+        results = [future.result() for future in futures]
+
+    if not args.keepStaging:
+        # Leftovers from earlier builds may still be being deleted inside 'temp', see main()
+        Globals.TREE_REMOVER.waitForAll()
+        removeTreeInBackground('temp')
+
+    print("\n>>> Build results:")
+    for result in results:
+        if result['error'] is None:
+            print(f" - [{result['chapter']}] OK in {result['seconds']:.1f}s -> {result['archive']}")
+        else:
+            print(f" - [{result['chapter']}] FAILED in {result['seconds']:.1f}s: {result['error']}")
+
+    return results
 
 
 def main():
@@ -246,85 +111,290 @@ def main():
 
 This script uses 3.8's 'dirs_exist_ok=True' argument for shutil.copy.""")
 
-    argparser = argparse.ArgumentParser(usage='deploy_higurashi.py (onikakushi | watanagashi | tatarigoroshi | himatsubushi | meakashi | tsumihoroboshi | minagoroshi | matsuribayashi | [higurashi-rei/rei] | [hou-pluse/hou] | [higurashi-console-arcs/console])',
+    argparser = argparse.ArgumentParser(usage='deploy_higurashi.py (onikakushi | watanagashi | tatarigoroshi | himatsubushi | meakashi | tsumihoroboshi | minagoroshi | matsuribayashi | [higurashi-rei/rei] | [hou-pluse/hou] | [higurashi-console-arcs/console])... | --all [--jobs N]',
                                         description='This script creates the "script" archive used in the Higurashi mod. It expects to be run from the root of one of the Higurashi mod repositories.')
 
-    argparser.add_argument("chapter", help="The name of the chapter to be deployed.")
+    argparser.add_argument("chapter", nargs='*', help="The name of the chapter to be deployed. Several chapters can be given to build them in parallel.")
+    argparser.add_argument(
+        "--all",
+        dest="allChapters",
+        action='store_true',
+        help='Build every chapter in parallel, each in its own workspace folder',
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Maximum number of chapters to build at the same time when building more than one chapter (default: number of CPUs)',
+    )
     argparser.add_argument(
         "--nocompile",
         dest="noCompile",
         action='store_true',
         help='Skips the script compilation step (archive will not have a CompiledUpdateScripts folder)',
     )
+    argparser.add_argument(
+        "--stage",
+        action='store_true',
+        help='Copy the whole patch into the temp folder before creating the archive, instead of reading files directly from the repository',
+    )
+    argparser.add_argument(
+        "--stage-mode",
+        dest="stageMode",
+        choices=['auto', 'reflink', 'hardlink', 'copy'],
+        default='auto',
+        help='How files are staged with --stage: as reflinks (copy-on-write clones), hardlinks or copies. "auto" uses the first one the filesystem supports. (default: auto)',
+    )
+    argparser.add_argument(
+        "--force",
+        action='store_true',
+        help='Run every stage, even if its inputs have not changed since the last build',
+    )
+    argparser.add_argument(
+        "--plan",
+        action='store_true',
+        help='Print the files which would be included in the archive, with their totals, the estimated archive size and the estimated duration of each stage, without building anything',
+    )
+    argparser.add_argument(
+        "--watch",
+        action='store_true',
+        help='After building, keep watching Update/, bin/Release and the root *.json files, and rebuild the archive whenever they change',
+    )
+    argparser.add_argument(
+        "--watch-interval",
+        dest="watchInterval",
+        type=float,
+        default=1,
+        help='How often --watch checks for changes, in seconds',
+    )
+    argparser.add_argument(
+        "--no-verify",
+        dest="noVerify",
+        action='store_true',
+        help='Skip checking the CRC of every entry in the archive, and that it contains exactly the files of the build',
+    )
+    argparser.add_argument(
+        "--keep-staging",
+        dest="keepStaging",
+        action='store_true',
+        help='Keep the temp folder between builds, and only copy the files which changed into it (deleting files whose source was removed)',
+    )
+    argparser.add_argument(
+        "--staging-checksum",
+        dest="stagingChecksum",
+        action='store_true',
+        help='With --keep-staging, also compare the contents of files with the same size and modification time',
+    )
+    argparser.add_argument(
+        "--zip-workers",
+        dest="zipWorkers",
+        type=int,
+        default=None,
+        help='Number of threads used to compress the release zip (default: number of CPUs, divided between the chapters built at the same time)',
+    )
+    argparser.add_argument(
+        "--volume-size",
+        dest="volumeSizeMB",
+        type=int,
+        default=None,
+        help='Split the release into several independent zips of about this many MB each, with an index mapping each file to its volume',
+    )
+    argparser.add_argument(
+        "--baseline-archive",
+        dest="baselineArchive",
+        default=None,
+        help='Previous *.Voice.and.Graphics.Patch.zip or *.volumes.json (or a folder containing them). Unchanged files are copied from it without being compressed again.',
+    )
+    argparser.add_argument(
+        "--no-compile-cache",
+        dest="noCompileCache",
+        action='store_true',
+        help='Compile every script, instead of reusing the compiled output of unchanged scripts from the compile cache',
+    )
+    argparser.add_argument(
+        "--compile-cache-size",
+        dest="compileCacheSizeMB",
+        type=int,
+        default=512,
+        help='Maximum size of the compile cache in MB. Least recently used scripts are evicted first.',
+    )
+    argparser.add_argument(
+        "--no-download-cache",
+        dest="noDownloadCache",
+        action='store_true',
+        help='Always download files again, instead of reusing them from the download cache',
+    )
+    argparser.add_argument(
+        "--cache-dir",
+        dest="cacheDir",
+        default=Globals.CACHE_DIR,
+        help=f'Folder used to store build caches between runs (default: {Globals.CACHE_DIR}, or set HIGURASHI_CACHE_DIR)',
+    )
+    argparser.add_argument(
+        "--download-cache-size",
+        dest="downloadCacheSizeMB",
+        type=int,
+        default=2048,
+        help='Maximum size of the download cache in MB. Least recently used files are evicted first.',
+    )
+    argparser.add_argument(
+        "--download-connections",
+        dest="downloadConnections",
+        type=int,
+        default=4,
+        help='Number of connections used to download large files in parallel, if the server supports range requests',
+    )
+    argparser.add_argument(
+        "--download-timeout",
+        dest="downloadTimeout",
+        type=float,
+        default=60,
+        help='Timeout in seconds of each download request',
+    )
+    argparser.add_argument(
+        "--download-retries",
+        dest="downloadRetries",
+        type=int,
+        default=5,
+        help='Number of times a failed download request is retried, with exponential backoff',
+    )
+    argparser.add_argument(
+        "--compression-policy",
+        dest="compressionPolicy",
+        help='JSON file with the deflate level of each file extension (0 stores files without compression), eg. {"levels": {".ogg": 0, ".txt": 9}}',
+    )
+    argparser.add_argument(
+        "--uniform-compression",
+        dest="uniformCompression",
+        action='store_true',
+        help='Compress every file at the default level, instead of storing media files and using higher levels for text',
+    )
+    argparser.add_argument(
+        "--tune",
+        action='store_true',
+        help='Instead of building, benchmark a grid of compression settings on a sample of the chapter\'s files, and store the best settings as the compression profile used by later builds',
+    )
+    argparser.add_argument(
+        "--tune-sample-size",
+        dest="tuneSampleSizeMB",
+        type=int,
+        default=64,
+        help='Size of the sample of files used by --tune, in MB',
+    )
+    argparser.add_argument(
+        "--tune-size-tolerance",
+        dest="tuneSizeTolerance",
+        type=float,
+        default=1,
+        help='--tune chooses the fastest settings whose output is at most this many percent larger than the smallest output',
+    )
+    argparser.add_argument(
+        "--tune-max-memory",
+        dest="tuneMaxMemoryMB",
+        type=int,
+        default=None,
+        help='--tune ignores settings which used more than this many MB of memory',
+    )
+    argparser.add_argument(
+        "--no-compression-profile",
+        dest="noCompressionProfile",
+        action='store_true',
+        help='Ignore the compression profile stored by --tune',
+    )
+    argparser.add_argument(
+        "--no-blob-store",
+        dest="noBlobStore",
+        action='store_true',
+        help='Compress every file, instead of reusing files which were already compressed for this or another chapter',
+    )
+    argparser.add_argument(
+        "--blob-store-size",
+        dest="blobStoreSizeMB",
+        type=int,
+        default=8192,
+        help='Maximum size of the compressed blob store in MB. Least recently used blobs are evicted first.',
+    )
 
     args = argparser.parse_args()
 
-    Globals.SEVEN_ZIP_EXECUTABLE = findWorkingExecutablePath(["7za", "7z"], ['-h'])
+    setupGlobals(args)
+    atexit.register(Globals.TREE_REMOVER.waitForAll)
+    if not args.plan:
+        # Multi-chapter builds delete folders inside each chapter's workspace folder in 'temp/workspaces'
+        for folder in ['.', 'temp', os.path.join('temp', 'workspaces')] + sorted(glob.glob(os.path.join('temp', 'workspaces', '*'))):
+            Globals.TREE_REMOVER.removeLeftovers(folder)
 
     # Get Git Tag Environment Variables
     GIT_REF = os.environ.get("GITHUB_REF",  "unknown/unknown/X.Y.Z")    # Github Tag / Version info
     GIT_TAG = GIT_REF.split('/')[-1]
     print(f"--- Starting build for Git Ref: {GIT_REF} Git Tag: {GIT_TAG} ---")
 
-    chapterList = [
-        ChapterInfo("onikakushi",       1, "https://github.com/07th-mod/patch-releases/releases/download/onikakushi-v1.0/Onikakushi-UI_5.2.2f1_win.7z"),
-        ChapterInfo("watanagashi",      2, "https://github.com/07th-mod/patch-releases/releases/download/watanagashi-v1.0/Watanagashi-UI_5.2.2f1_win.7z"),
-        ChapterInfo("tatarigoroshi",    3, "https://github.com/07th-mod/patch-releases/releases/download/tatarigoroshi-v1.0/Tatarigoroshi-UI_5.4.0f1_win.7z"),
-        ChapterInfo("himatsubushi",     4, "https://github.com/07th-mod/patch-releases/releases/download/himatsubushi-v1.0/Himatsubushi-UI_5.4.1f1_win.7z"),
-        ChapterInfo("console",          4, "https://github.com/07th-mod/patch-releases/releases/download/himatsubushi-v1.0/Himatsubushi-UI_5.4.1f1_win.7z", baseName="himatsubushi", dllFolderName="consolearcs"), # Console uses same base archive as Himatsubushi
-        ChapterInfo("meakashi",         5, "https://github.com/07th-mod/patch-releases/releases/download/meakashi-v1.0/Meakashi-UI_5.5.3p3_win.7z"),
-        ChapterInfo("tsumihoroboshi",   6, "https://github.com/07th-mod/patch-releases/releases/download/tsumihoroboshi-v1.0/Tsumihoroboshi-UI_5.5.3p3_win.7z"),
-        ChapterInfo("minagoroshi",      7, "https://github.com/07th-mod/patch-releases/releases/download/minagoroshi-v1.0/Minagoroshi-UI_5.6.7f1_win.7z"),
-        ChapterInfo("matsuribayashi",   8, "https://github.com/07th-mod/patch-releases/releases/download/matsuribayashi-v1.0/Matsuribayashi-UI_2017.2.5_win.7z"),
-        ChapterInfo("rei",              9, "https://github.com/07th-mod/patch-releases/releases/download/rei-v1.0/Rei-UI_2019.4.3_win.7z"),
-        # TODO: Remove UI files from https://07th-mod.com/misc/script_building/hou_base.7z archive, and use mod UI file
-        ChapterInfo("hou",             10, None), #"Hou-UI_2019.4.3_win.7z") # Skip Hou UI for now
-    ]
-
+    chapterList = getChapterList()
     chapterDict = dict((chapter.name, chapter) for chapter in chapterList)
 
-    chapter = chapterDict.get(args.chapter)
+    if args.allChapters:
+        chapters = chapterList
+    else:
+        chapters = [resolveChapter(chapterName, chapterDict) for chapterName in args.chapter]
 
-    # Add special case for chapters where the repo name doesn't match the chapter name
-    if chapter is None:
-        if args.chapter.lower() == 'higurashi-rei':
-            print(f"Converting chapter argument '{args.chapter}' to 'rei'")
-            chapter = chapterDict.get('rei')
+    if len(chapters) == 0:
+        raise Exception(f"Error: No chapter selected\n\n{argparser.usage}")
 
-    if chapter is None:
-        if args.chapter.lower() == 'hou-plus':
-            print(f"Converting chapter argument '{args.chapter}' to 'hou'")
-            chapter = chapterDict.get('hou')
+    if args.watch and len(chapters) > 1:
+        raise Exception("Error: --watch can only be used with a single chapter")
 
-    if chapter is None:
-        if args.chapter.lower() == 'higurashi-console-arcs':
-            print(f"Converting chapter argument '{args.chapter}' to 'console'")
-            chapter = chapterDict.get('console')
+    if args.plan:
+        for chapter in chapters:
+            planChapter(chapter, args)
+        return
 
-    if chapter is None:
-        raise Exception(f"Error: Unknown Chapter '{args.chapter}' Selected\n\n{help}")
+    if args.tune:
+        if len(chapters) > 1:
+            raise Exception("Error: --tune can only be used with a single chapter")
+        tuneChapter(chapters[0], args)
+        return
 
-    # Compile every chapter's scripts before building archives
-    if not args.noCompile:
-        compileScripts(chapter)
+    GITHUB_OUTPUT = os.environ.get("GITHUB_OUTPUT", "github-output-dummy.txt")
+
+    reportPath = 'output/build-report.json'
+
+    if len(chapters) > 1:
+        results = buildChaptersInParallel(chapters, args)
+        evictCaches()
+        summary = writeBuildReport(reportPath, dict((result['chapter'], result['metrics']) for result in results))
+        appendBuildHistory(dict((result['chapter'], result['metrics']) for result in results if result['error'] is None))
 
-    print(f">>> Creating folders and downloading necessary files")
-    prepareFiles(chapter.dllFolderName, chapter.dataFolderName)
+        # Set a Github Actions output "release_name_<chapter>" for each chapter which built successfully
+        with open(GITHUB_OUTPUT, "w") as f:
+            for result in results:
+                if result['error'] is None:
+                    capitalized_name = string.capwords(result['chapter'], '-')
+                    f.write(f"release_name_{result['chapter']}={capitalized_name} Voice and Graphics Patch {GIT_TAG}\n")
+            f.write(f"build_report={reportPath}\n")
+            f.write(f"build_timings={json.dumps(summary, separators=(',', ':'))}\n")
 
-    print(f">>> Building the patch")
-    buildPatch(chapter.dataFolderName)
+        failedChapters = [result['chapter'] for result in results if result['error'] is not None]
+        if failedChapters:
+            raise Exception(f"ERROR: The following chapters failed to build: {failedChapters}")
 
-    print(f">>> Creating Archive")
-    makeArchive(chapter.name, chapter.dataFolderName)
+        return
 
-    print(f">>> Cleaning up the mess")
-    tryRemoveTree('temp')
+    chapter = chapters[0]
+    _, mappings = buildChapter(chapter, Workspace('.', args.keepStaging, args.stagingChecksum), args)
+    evictCaches()
+    summary = writeBuildReport(reportPath, {chapter.name: Globals.METRICS.toDict()})
+    appendBuildHistory({chapter.name: Globals.METRICS.toDict()})
 
     # Set a Github Actions output "release_name" for use by the release step
     capitalized_name = string.capwords(chapter.name, '-')
-    GITHUB_OUTPUT = os.environ.get("GITHUB_OUTPUT", "github-output-dummy.txt")
     with open(GITHUB_OUTPUT, "w") as f:
-        f.write(f"release_name={capitalized_name} Voice and Graphics Patch {GIT_TAG}")
+        f.write(f"release_name={capitalized_name} Voice and Graphics Patch {GIT_TAG}\n")
+        f.write(f"build_report={reportPath}\n")
+        f.write(f"build_timings={json.dumps(summary, separators=(',', ':'))}\n")
+
+    if args.watch:
+        watchChapter(chapter, args, reportPath, mappings)
+
 
 if __name__ == "__main__":
     main()
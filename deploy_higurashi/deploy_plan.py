@@ -0,0 +1,218 @@
+"""Build history, and the --plan dry run which estimates archive sizes and stage times"""
+
+import os
+import time
+import itertools
+import json
+import zlib
+import statistics
+from typing import Dict, List
+
+from deploy_common import ChapterInfo, CompressionPolicy, Globals
+from deploy_workspace import FileEntry, listFilesRecursive
+from deploy_chapter import getArchiveSettings, getRepoMappings
+
+
+BUILD_HISTORY_LENGTH = 100
+
+
+def getBuildHistoryPath():
+    return os.path.join(Globals.CACHE_DIR, 'build_history.jsonl')
+
+
+def appendBuildHistory(chapterReports):
+    """
+    Record the stage timings of each successfully built chapter (chapter name -> BuildMetrics.toDict()) in the build
+    history in the cache folder, which --plan uses to estimate the duration of the next build. Only the last
+    BUILD_HISTORY_LENGTH builds are kept.
+    """
+    records = readBuildHistory()
+    for chapterName, report in chapterReports.items():
+        topLevelStages = [stage for stage in report['stages'] if stage['parent'] is None]
+        inputStage = next((stage for stage in report['stages'] if 'inputBytes' in stage), {})
+        records.append({
+            'createdAt': time.time(),
+            'repo': os.path.abspath('.'),
+            'chapter': chapterName,
+            'inputFiles': inputStage.get('inputFiles'),
+            'inputBytes': inputStage.get('inputBytes'),
+            'totalWallSeconds': report['totalWallSeconds'],
+            'stages': [{'name': stage['name'], 'wallSeconds': stage['wallSeconds'], 'skipped': stage.get('skipped', False)} for stage in topLevelStages],
+        })
+
+    historyPath = getBuildHistoryPath()
+    os.makedirs(os.path.dirname(historyPath), exist_ok=True)
+    tempPath = f'{historyPath}.{os.getpid()}.tmp'
+    with open(tempPath, 'w') as f:
+        for record in records[-BUILD_HISTORY_LENGTH:]:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    os.replace(tempPath, historyPath)
+
+
+def readBuildHistory():
+    """Returns the records written by appendBuildHistory(), oldest first. Unreadable lines are ignored."""
+    records = []
+    try:
+        with open(getBuildHistoryPath(), 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return records
+
+
+# The stages of buildChapter() in the order they run. Stages in the same group run at the same time.
+PLAN_STAGE_GROUPS = [['prepareFiles'], ['compileScripts', 'downloadPlugin', 'buildPatch'], ['collectPatchFiles'], ['makeArchive'], ['verifyArchive'], ['cleanup']]
+
+
+# Stages whose duration grows with the number of files ('inputFiles') or bytes ('inputBytes') in the archive
+PLAN_STAGE_SCALING = {'buildPatch': 'inputFiles', 'collectPatchFiles': 'inputFiles', 'makeArchive': 'inputBytes', 'verifyArchive': 'inputBytes'}
+
+
+PLAN_HISTORY_RUNS = 5
+
+
+# Local file header and central directory record of each zip entry, excluding the file name (which is in both)
+ZIP_ENTRY_OVERHEAD = 30 + 46
+
+
+def describeLevel(level):
+    return 'stored' if level == CompressionPolicy.STORE else f'level {level}'
+
+
+def estimateCompressedSizes(entries: List[FileEntry], policy: CompressionPolicy, samplesPerGroup=8):
+    """
+    Returns (FileEntry, level, estimatedSize) for each entry, applying the ratio of a compressed sample of the first
+    samplesPerGroup files of each (extension, level) to the other files.
+    """
+    levels = []
+    samples: Dict[tuple, List[int]] = {}
+    for entry in entries:
+        sample = None
+        level = policy.levelForExtension(entry.path, entry.size)
+        if level is None:
+            sample = policy.readSample(entry.path, entry.size)
+            level = policy.sampleLevel(sample)
+        levels.append(level)
+
+        key = (CompressionPolicy.extension(entry.path), level)
+        groupSamples = samples.setdefault(key, [0, 0, 0])
+        if level == CompressionPolicy.STORE or entry.size == 0 or groupSamples[2] >= samplesPerGroup:
+            continue
+        if sample is None:
+            sample = policy.readSample(entry.path, entry.size)
+        groupSamples[0] += len(sample)
+        groupSamples[1] += len(zlib.compress(sample, level))
+        groupSamples[2] += 1
+
+    estimates = []
+    for entry, level in zip(entries, levels):
+        sampleBytes, compressedSampleBytes, _ = samples[(CompressionPolicy.extension(entry.path), level)]
+        ratio = compressedSampleBytes / sampleBytes if level != CompressionPolicy.STORE and sampleBytes > 0 else 1
+        estimates.append((entry, level, round(entry.size * ratio)))
+    return estimates
+
+
+def estimateStageSeconds(history, chapterName, planned):
+    """
+    Returns {stage name: (seconds, builds used)}: the median of the chapter's last PLAN_HISTORY_RUNS builds (see
+    appendBuildHistory()), scaled by file or byte count for the stages in PLAN_STAGE_SCALING.
+    """
+    repo = os.path.abspath('.')
+    chapterHistory = [record for record in history if record.get('repo') == repo and record.get('chapter') == chapterName]
+
+    estimates = {}
+    for stageName in itertools.chain.from_iterable(PLAN_STAGE_GROUPS):
+        scaling = PLAN_STAGE_SCALING.get(stageName)
+        for records in (chapterHistory, history):
+            seconds = []
+            for record in reversed(records):
+                stage = next((stage for stage in record['stages'] if stage['name'] == stageName and not stage['skipped']), None)
+                if stage is None:
+                    continue
+                if scaling is None:
+                    seconds.append(stage['wallSeconds'])
+                elif record.get(scaling):
+                    seconds.append(stage['wallSeconds'] * planned[scaling] / record[scaling])
+                if len(seconds) == PLAN_HISTORY_RUNS:
+                    break
+            if seconds:
+                estimates[stageName] = (statistics.median(seconds), len(seconds))
+                break
+    return estimates
+
+
+def planChapter(chapter: ChapterInfo, args):
+    """
+    Print what building the chapter would include, without copying, downloading or compressing anything: the exact list
+    of repository files which go in the archive (from a single walk of the repository, using the same rules as
+    buildPatch()), their totals by type and by folder, the estimated size of the archive, and the estimated duration of
+    each stage, calibrated from earlier builds.
+    """
+    print(f"\n>>> Plan for chapter {chapter.name}")
+    dataFolderName = chapter.dataFolderName
+    repoIndex, mappings = getRepoMappings(chapter)
+
+    files = sorted(((entry, archivePath) for entry, archivePath in mappings if not entry.isDir), key=lambda mapping: mapping[1])
+    estimates = estimateCompressedSizes([entry for entry, _ in files], getArchiveSettings(chapter, args).policy)
+    totalSize = sum(entry.size for entry, _ in files)
+    totalEstimate = sum(estimate for _, _, estimate in estimates)
+    # Folders are also zip entries
+    totalEstimate += sum(ZIP_ENTRY_OVERHEAD + len(archivePath.encode('utf-8')) * 2 for _, archivePath in mappings) + 22
+
+    print(f"\nFiles to be included ({len(files)} files, {totalSize} bytes):")
+    print(f"{'size':>14} {'estimated':>14}  {'compression':<11}  path")
+    for (entry, archivePath), (_, level, estimate) in zip(files, estimates):
+        print(f"{entry.size:>14} {estimate:>14}  {describeLevel(level):<11}  {archivePath}")
+    print(f"Ignored top level paths: {', '.join(repoIndex.ignored)}")
+
+    print("\nGenerated during the build (not included in the totals):")
+    if not args.noCompile:
+        print(f" - {dataFolderName}/StreamingAssets/CompiledUpdateScripts/ (compiled from {len(listFilesRecursive('Update'))} scripts in Update)")
+    print(f" - {dataFolderName}/Plugins/AVProVideo.dll (downloaded)")
+
+    byType: Dict[tuple, List[int]] = {}
+    byFolder: Dict[str, List[int]] = {}
+    for (entry, archivePath), (_, level, estimate) in zip(files, estimates):
+        # Files are grouped by the first two folders inside the data folder, eg. 'StreamingAssets/voice'
+        folder = '/'.join(archivePath.split('/')[1:-1][:2]) or '.'
+        for totals in (byType.setdefault((CompressionPolicy.extension(archivePath) or '(none)', level), [0, 0, 0]), byFolder.setdefault(folder, [0, 0, 0])):
+            totals[0] += 1
+            totals[1] += entry.size
+            totals[2] += estimate
+
+    print("\nBy type:")
+    print(f"{'extension':<12} {'compression':<11} {'files':>8} {'size':>14} {'estimated':>14}")
+    for (extension, level), (count, size, estimate) in sorted(byType.items(), key=lambda item: -item[1][1]):
+        print(f"{extension:<12} {describeLevel(level):<11} {count:>8} {size:>14} {estimate:>14}")
+
+    print(f"\nBy folder (inside {dataFolderName}):")
+    print(f"{'folder':<40} {'files':>8} {'size':>14} {'estimated':>14}")
+    for folder, (count, size, estimate) in sorted(byFolder.items()):
+        print(f"{folder:<40} {count:>8} {size:>14} {estimate:>14}")
+
+    print(f"\nEstimated archive size: {totalEstimate / 1024 / 1024:.1f} MB ({totalSize / 1024 / 1024:.1f} MB of files, excluding generated files)")
+
+    history = readBuildHistory()
+    stageEstimates = estimateStageSeconds(history, chapter.name, {'inputFiles': len(files), 'inputBytes': totalSize})
+    if not stageEstimates:
+        print(f"\nNo earlier builds in {getBuildHistoryPath()} - build the chapter once to estimate the duration of each stage")
+        return
+
+    print("\nEstimated stage durations (median of earlier builds, scaled to the size of this build):")
+    totalSeconds = 0
+    for group in PLAN_STAGE_GROUPS:
+        if args.noVerify and group == ['verifyArchive']:
+            continue
+        for stageName in group:
+            if stageName in stageEstimates:
+                seconds, runs = stageEstimates[stageName]
+                print(f" - {stageName}: {seconds:.2f}s (builds used: {runs})")
+            else:
+                print(f" - {stageName}: unknown (no earlier build ran this stage)")
+        # Stages in the same group run at the same time
+        totalSeconds += max(stageEstimates.get(stageName, (0, 0))[0] for stageName in group)
+    print(f"Estimated total: {totalSeconds:.2f}s (stages which are up to date are skipped, so builds where little changed are faster)")
@@ -0,0 +1,113 @@
+"""A small dependency graph runner for the stages of a build"""
+
+import os
+import concurrent.futures
+import json
+from typing import Dict
+
+from deploy_common import Globals
+
+
+class BuildTask:
+    """
+    One stage of the build for a TaskGraph. 'func' is called with the results of 'dependencies'. The task is skipped,
+    returning 'skippedResult', if 'fingerprint' returns the same string as last time and every path in 'outputs' exists.
+    """
+    def __init__(self, name, func, dependencies=(), fingerprint=None, outputs=(), skippedResult=None):
+        self.name = name
+        self.func = func
+        self.dependencies = list(dependencies)
+        self.fingerprint = fingerprint
+        self.outputs = list(outputs)
+        self.skippedResult = skippedResult
+
+
+class TaskGraph:
+    """
+    Runs BuildTasks on a thread pool, starting each task as soon as all of its dependencies have finished, so that
+    independent stages (eg. script compilation, downloads and staging) overlap.
+    Fingerprints of the tasks are saved to stateFilePath, to skip tasks whose inputs haven't changed on the next run.
+    """
+    def __init__(self, stateFilePath, workers=4, force=False):
+        self.stateFilePath = stateFilePath
+        self.workers = workers
+        self.force = force
+        self.tasks: Dict[str, BuildTask] = {}
+
+    def add(self, task: BuildTask):
+        if task.name in self.tasks:
+            raise Exception(f"ERROR: Task {task.name} was added twice")
+        for dependency in task.dependencies:
+            if dependency not in self.tasks:
+                raise Exception(f"ERROR: Task {task.name} depends on unknown task {dependency} (tasks must be added after their dependencies)")
+        self.tasks[task.name] = task
+
+    def _loadState(self):
+        try:
+            with open(self.stateFilePath, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _saveState(self, state):
+        os.makedirs(os.path.dirname(self.stateFilePath), exist_ok=True)
+        tempPath = self.stateFilePath + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tempPath, self.stateFilePath)
+
+    def forget(self, taskNames):
+        """Forget the fingerprints of the tasks, so they run on the next run, eg. after their outputs were changed outside of the graph"""
+        state = self._loadState()
+        if any(name in state for name in taskNames):
+            for name in taskNames:
+                state.pop(name, None)
+            self._saveState(state)
+
+    def _runTask(self, task: BuildTask, args, previousFingerprint):
+        with Globals.METRICS.stage(task.name) as record:
+            fingerprint = None
+            if task.fingerprint is not None:
+                fingerprint = task.fingerprint(*args)
+                if not self.force and fingerprint == previousFingerprint and all(os.path.exists(path) for path in task.outputs):
+                    print(f">>> Skipping [{task.name}] - inputs are unchanged since the last run")
+                    record['skipped'] = True
+                    return task.skippedResult, fingerprint
+
+            print(f">>> Running [{task.name}]")
+            return task.func(*args), fingerprint
+
+    def run(self):
+        """Run every task, returning a dict of task name -> result. If a task fails, the exception is raised once all running tasks have finished."""
+        state = self._loadState()
+        results = {}
+        futures = {}
+        remaining = list(self.tasks.values())
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while remaining or futures:
+                # Start every task whose dependencies are done
+                for task in list(remaining):
+                    if all(dependency in results for dependency in task.dependencies):
+                        remaining.remove(task)
+                        args = [results[dependency] for dependency in task.dependencies]
+                        futures[executor.submit(self._runTask, task, args, state.get(task.name))] = task
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    try:
+                        results[task.name], fingerprint = future.result()
+                    except BaseException:
+                        # Don't start any more tasks, and forget the task's fingerprint so it always runs next time
+                        remaining.clear()
+                        state.pop(task.name, None)
+                        self._saveState(state)
+                        concurrent.futures.wait(futures)
+                        raise
+
+                    if fingerprint is not None:
+                        state[task.name] = fingerprint
+                    self._saveState(state)
+
+        return results
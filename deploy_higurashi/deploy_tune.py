@@ -0,0 +1,104 @@
+"""Benchmarking compression settings (--tune) and choosing the best ones"""
+
+import os
+import time
+import itertools
+import concurrent.futures
+import json
+import tempfile
+import zipfile
+import tracemalloc
+
+from deploy_common import (
+    ChapterInfo, chooseTunedResult, CompressionPolicy, paretoFrontier, printTuningResults, saveCompressionProfile,
+    stageTuningSample, tryRemoveTree,
+)
+from deploy_workspace import FileIndex, removeTreeInBackground
+from deploy_zip import ParallelZipWriter
+from deploy_chapter import getRepoMappings
+
+
+# The settings tried by tuneChapter(). Each combination is benchmarked.
+ZIP_TUNING_GRID = {
+    'method': ['policy', 'uniform'],
+    'level': [1, 6, 9],
+    'workers': sorted(set([1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1])),
+    'chunkSizeMB': [1, 4, 16],
+}
+
+
+def writeTuningSample(sampleMappings, settings, outputPath):
+    """Zip the sample with one combination of ZIP_TUNING_GRID settings"""
+    policy = CompressionPolicy.forProfile(settings['method'], settings['level'])
+    with zipfile.ZipFile(outputPath, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers']) as executor:
+        ParallelZipWriter(zf, executor, settings['workers'], policy, chunkSize=settings['chunkSizeMB'] * 1024 * 1024).write(sampleMappings)
+
+
+def runZipTuningTrial(sampleMappings, settings, outputPath):
+    """
+    Returns the time, size and peak memory of writeTuningSample(). tracemalloc slows down every allocation, so the peak
+    memory is measured on a second run. It covers the file and chunk buffers, but not zlib's internal state.
+    """
+    startTime = time.perf_counter()
+    writeTuningSample(sampleMappings, settings, outputPath)
+    seconds = time.perf_counter() - startTime
+    size = os.path.getsize(outputPath)
+    tryRemoveTree(outputPath)
+
+    tracemalloc.start()
+    try:
+        writeTuningSample(sampleMappings, settings, outputPath)
+        _, peakMemoryBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        tryRemoveTree(outputPath)
+    return {'settings': settings, 'seconds': round(seconds, 3), 'size': size, 'peakMemoryBytes': peakMemoryBytes}
+
+
+def tuneChapter(chapter: ChapterInfo, args):
+    """
+    Benchmark every combination of ZIP_TUNING_GRID on a representative sample of the chapter's files (see
+    stageTuningSample()), print the Pareto frontier of time, size and peak memory, and store the chosen settings as
+    the compression profile, which later builds use unless a compression policy is given on the command line.
+    """
+    print(f"\n>>> Tuning zip compression for chapter {chapter.name}")
+    _, mappings = getRepoMappings(chapter)
+    files = [(entry.path, archivePath, entry.size) for entry, archivePath in mappings if not entry.isDir]
+
+    # The sample is staged in 'temp', which builds never include in the archive
+    os.makedirs('temp', exist_ok=True)
+    sampleFolder = tempfile.mkdtemp(prefix='tuning-', dir='temp')
+    try:
+        sampleFiles, sampleBytes = stageTuningSample(files, args.tuneSampleSizeMB * 1024 * 1024, sampleFolder)
+        print(f"Sampled {sampleFiles} of {len(files)} files ({sampleBytes} of {sum(size for _, _, size in files)} bytes)")
+        sampleMappings = [(entry, entry.relPath + ('/' if entry.isDir else '')) for entry in FileIndex(sampleFolder).entries]
+
+        results = []
+        grid = list(itertools.product(*ZIP_TUNING_GRID.values()))
+        for i, values in enumerate(grid):
+            settings = dict(zip(ZIP_TUNING_GRID.keys(), values))
+            result = runZipTuningTrial(sampleMappings, settings, os.path.join(sampleFolder, 'trial.zip'))
+            print(f"[{i + 1}/{len(grid)}] {settings}: {result['seconds']:.2f}s, {result['size']} bytes, {result['peakMemoryBytes'] / 1024 / 1024:.1f} MB")
+            results.append(result)
+    finally:
+        removeTreeInBackground(sampleFolder)
+
+    frontier = paretoFrontier(results)
+    maxMemoryBytes = args.tuneMaxMemoryMB * 1024 * 1024 if args.tuneMaxMemoryMB is not None else None
+    chosen = chooseTunedResult(frontier, args.tuneSizeTolerance / 100, maxMemoryBytes)
+    printTuningResults(results, frontier, chosen)
+
+    resultsPath = 'output/compression-tuning.json'
+    os.makedirs(os.path.dirname(resultsPath), exist_ok=True)
+    with open(resultsPath, 'w') as f:
+        json.dump({'chapter': chapter.name, 'sampleFiles': sampleFiles, 'sampleBytes': sampleBytes, 'results': results, 'frontier': frontier, 'chosen': chosen}, f, indent=2)
+
+    profilePath = saveCompressionProfile('zip', chapter.name, {
+        'createdAt': time.time(),
+        'chapter': chapter.name,
+        'sampleBytes': sampleBytes,
+        'settings': chosen['settings'],
+        'measured': dict((key, chosen[key]) for key in ['seconds', 'size', 'peakMemoryBytes']),
+    })
+    print(f"Saved the chosen settings to {profilePath} (all results are in {resultsPath}) - later builds of {chapter.name} use them unless --compression-policy, --uniform-compression or --no-compression-profile is given")
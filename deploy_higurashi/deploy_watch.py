@@ -0,0 +1,261 @@
+"""The --watch mode, which rebuilds a chapter whenever its files change"""
+
+import os
+import argparse
+import time
+import traceback
+import glob
+import json
+
+from deploy_common import BuildMetrics, ChapterInfo, getManifestPath, Globals, sha256File, tryRemoveTree, writeBuildReport
+from deploy_workspace import fileEntryFromPath, listFilesRecursive, Workspace
+from deploy_zip import getFolderArchivePaths, getVolumeIndexPath, replaceZipPart, updateZipPart, verifyZipArchive
+from deploy_chapter import (
+    buildChapter, compileScripts, getArchiveBaseName, getArchiveSettings, getCompileScratchNames, getExtraPatchFiles,
+    getIgnoredRepoPaths, getRepoFileArchivePath, getStageStatePath, matchScriptOutputs, prepareFiles,
+)
+from deploy_tasks import TaskGraph
+from deploy_plan import appendBuildHistory
+
+
+def getWatchedPaths():
+    """The files and folders which --watch mode checks for changes. Root *.json files are globbed again each time, to notice new files."""
+    return ['Update', os.path.join('bin', 'Release')] + sorted(glob.glob('*.json'))
+
+
+def snapshotFiles(paths):
+    """Returns a dict of path -> (size, mtime) of every file in the given files and folders"""
+    snapshot = {}
+    for path in paths:
+        for dirPath, dirNames, fileNames in os.walk(path) if os.path.isdir(path) else [(os.path.dirname(path), [], [os.path.basename(path)])]:
+            for fileName in fileNames:
+                filePath = os.path.join(dirPath, fileName)
+                try:
+                    st = os.stat(filePath)
+                except FileNotFoundError:
+                    continue
+                snapshot[filePath] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+class WatchSession:
+    """
+    What --watch keeps between rebuilds: the (FileEntry, archivePath) mappings of the release zip, by archive path.
+    A change is applied to a copy of the zip by writing only the entries it affects, which replaces the zip once it
+    is verified (see update()). The release is
+    built again with buildChapter() the first time, after a failure, for multi-volume or staged builds, and once
+    more than MAX_DEAD_FRACTION of the zip is replaced entries.
+    """
+    MAX_DEAD_FRACTION = 0.5
+
+    def __init__(self, chapter: ChapterInfo, args, mappings=None):
+        self.chapter = chapter
+        self.args = args
+        self.archivePath = os.path.abspath(getArchiveBaseName(chapter.name) + '.zip')
+        self.mappings = None
+        if mappings is not None:
+            self.mappings = dict((archivePath, entry) for entry, archivePath in mappings)
+        # The bytes of the entries dropped from the zip since it was last written in full
+        self.deadBytes = 0
+
+    def workspace(self):
+        return Workspace('.', self.args.keepStaging, self.args.stagingChecksum)
+
+    def canUpdate(self):
+        if self.mappings is None or self.args.volumeSizeMB is not None or self.args.stage:
+            return False
+        if not os.path.exists(self.archivePath) or not os.path.exists(getManifestPath(self.archivePath)):
+            return False
+        return self.deadBytes <= WatchSession.MAX_DEAD_FRACTION * os.path.getsize(self.archivePath)
+
+    def rebuild(self):
+        self.mappings = None
+        releasePath, mappings = buildChapter(self.chapter, self.workspace(), self.args)
+        self.mappings = dict((archivePath, entry) for entry, archivePath in mappings)
+        self.deadBytes = 0
+        return releasePath
+
+    def _addParentFolders(self, changedEntries, path, archivePath):
+        """Add the folders of a new file which aren't in the zip yet"""
+        for folder in reversed(getFolderArchivePaths(archivePath)):
+            path = os.path.dirname(path)
+            if not path or folder in self.mappings or folder in changedEntries:
+                break
+            changedEntries[folder] = fileEntryFromPath(path, path.replace(os.sep, '/'))
+
+    def _removeEmptyFolders(self, removedPaths, archivePath):
+        """Drop the folders of a removed file whose source folder was removed too"""
+        for folder in reversed(getFolderArchivePaths(archivePath)):
+            entry = self.mappings.get(folder)
+            if entry is None or os.path.isdir(entry.path):
+                break
+            removedPaths.add(folder)
+
+    def _compileChangedScripts(self, workspace: Workspace, scripts, changedEntries, removedPaths):
+        """Compile the changed scripts (relative to 'Update'), replacing the compiled outputs of each script"""
+        chapter = self.chapter
+        compiledFolder = f'{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts'
+        # The outputs are matched against every script, the same way compileScripts() matched them
+        compiledRelPaths = [archivePath[len(compiledFolder) + 1:] for archivePath in self.mappings if archivePath.startswith(compiledFolder + '/') and not archivePath.endswith('/')]
+        outputsByScript = matchScriptOutputs(sorted(set(listFilesRecursive('Update')) | set(scripts)), compiledRelPaths)
+        for relPath in scripts:
+            removedPaths.update(f'{compiledFolder}/{outputRelPath}' for outputRelPath in outputsByScript[relPath])
+
+        existingScripts = [relPath for relPath in scripts if os.path.isfile(os.path.join('Update', relPath))]
+        if existingScripts:
+            workspace.clearTemp()
+            prepareFiles(chapter.dllFolderName, chapter.dataFolderName, workspace)
+            outputFolder = f'{workspace.dataFolder(chapter.dataFolderName)}/StreamingAssets/CompiledUpdateScripts'
+            for relPath in compileScripts(chapter, workspace, existingScripts):
+                archivePath = f'{compiledFolder}/{relPath}'
+                outputPath = os.path.join(outputFolder, relPath)
+                removedPaths.discard(archivePath)
+                changedEntries[archivePath] = fileEntryFromPath(outputPath, relPath)
+                self._addParentFolders(changedEntries, outputPath, archivePath)
+
+        # The compiled outputs only exist during a build, so drop the folders which no longer have any outputs in them
+        remainingPaths = [archivePath for archivePath in set(self.mappings) - removedPaths | set(changedEntries) if archivePath.startswith(compiledFolder + '/')]
+        for folder in remainingPaths:
+            if folder.endswith('/') and not any(archivePath.startswith(folder) and not archivePath.endswith('/') for archivePath in remainingPaths):
+                removedPaths.add(folder)
+
+    def update(self, changedPaths):
+        """
+        Apply the changed files (paths relative to the repository) to the release zip, returning the number of entries
+        written. Changed scripts are compiled again, and files whose size and CRC match the zip are skipped. If the
+        update fails, the release zip is left as it was, and the next change rebuilds it in full.
+        """
+        chapter = self.chapter
+        metrics = Globals.METRICS
+        workspace = self.workspace()
+        rootJSONFiles = glob.glob('*.json')
+        extraFiles = getExtraPatchFiles(rootJSONFiles)
+        ignoredNames = getIgnoredRepoPaths(chapter.dataFolderName, rootJSONFiles, getCompileScratchNames(chapter, workspace))
+        sourceArchivePaths = dict((os.path.normpath(entry.path), archivePath) for archivePath, entry in self.mappings.items())
+
+        changedEntries = {}
+        removedPaths = set()
+        scripts = []
+        for path in changedPaths:
+            if os.path.normpath(path).split(os.sep)[0] == 'Update':
+                scripts.append(os.path.relpath(path, 'Update').replace(os.sep, '/'))
+            archivePath = sourceArchivePaths.get(os.path.normpath(path)) or getRepoFileArchivePath(chapter, path, extraFiles, ignoredNames)
+            if archivePath is None:
+                continue
+            if os.path.isfile(path):
+                changedEntries[archivePath] = fileEntryFromPath(path, path.replace(os.sep, '/'))
+                self._addParentFolders(changedEntries, path, archivePath)
+            elif archivePath in self.mappings:
+                removedPaths.add(archivePath)
+                self._removeEmptyFolders(removedPaths, archivePath)
+
+        try:
+            if scripts and not self.args.noCompile:
+                with metrics.stage('compileScripts'):
+                    self._compileChangedScripts(workspace, scripts, changedEntries, removedPaths)
+
+            # Saving a file without changing it only changes its modification time
+            with open(getManifestPath(self.archivePath), 'r') as f:
+                manifestEntries = dict((manifestEntry['path'], manifestEntry) for manifestEntry in json.load(f)['entries'])
+            for archivePath, entry in list(changedEntries.items()):
+                manifestEntry = manifestEntries.get(archivePath)
+                if manifestEntry is not None and not entry.isDir and manifestEntry['size'] == entry.size and sha256File(entry.path) == manifestEntry['sha256']:
+                    del changedEntries[archivePath]
+                    self.mappings[archivePath] = entry
+
+            if not changedEntries and not removedPaths:
+                print(f"No entries of {self.archivePath} changed")
+                return 0
+
+            settings = getArchiveSettings(chapter, self.args)
+            mappings = [(entry, archivePath) for archivePath, entry in changedEntries.items()]
+            print(f"Updating {len(changedEntries)} entries and removing {len(removedPaths - set(changedEntries))} entries of {self.archivePath}")
+            # The next full build can't skip writing the archive, as the zip won't match its last fingerprint any more
+            TaskGraph(getStageStatePath(chapter)).forget(['makeArchive', 'verifyArchive'])
+            newMappings = dict(self.mappings)
+            for archivePath in removedPaths:
+                newMappings.pop(archivePath, None)
+            newMappings.update(changedEntries)
+
+            # The release zip is only replaced once the updated copy is verified, so a failed update leaves it as it was
+            tempZipPath = self.archivePath + '.part'
+            try:
+                with metrics.stage('makeArchive'):
+                    manifestEntries, deadBytes = updateZipPart(self.archivePath, mappings, removedPaths, settings.workers, settings.policy, settings.chunkSize)
+                if not self.args.noVerify:
+                    with metrics.stage('verifyArchive'):
+                        allMappings = [(entry, archivePath) for archivePath, entry in newMappings.items()]
+                        verifyZipArchive(tempZipPath, allMappings, settings.workers, names=set(changedEntries))
+            except BaseException:
+                tryRemoveTree(tempZipPath)
+                raise
+
+            replaceZipPart(self.archivePath, mappings, manifestEntries)
+            self.mappings = newMappings
+            self.deadBytes += deadBytes
+        except Exception:
+            self.mappings = None
+            raise
+        finally:
+            workspace.clearTemp()
+
+        return len(changedEntries)
+
+
+def watchChapter(chapter: ChapterInfo, args, reportPath, mappings=None):
+    """
+    Rebuild the chapter each time a watched file (see getWatchedPaths()) changes, until interrupted with Ctrl+C.
+    'mappings' are those of the build which was just made, if any.
+
+    Changes are applied to the release zip in place (see WatchSession). When the release has to be built again, only
+    changed scripts are compiled (see ScriptCompileCache), downloads are reused from the download cache without asking
+    the server again, and the previous release is used as the baseline archive, so only changed files are compressed.
+    """
+    watchArgs = argparse.Namespace(**vars(args))
+    # Always compare with the previous build, even if the first build was forced
+    watchArgs.force = False
+    session = WatchSession(chapter, watchArgs, mappings)
+    if watchArgs.baselineArchive is None:
+        watchArgs.baselineArchive = session.archivePath if watchArgs.volumeSizeMB is None else getVolumeIndexPath(session.archivePath)
+    if Globals.DOWNLOAD_CACHE is not None:
+        Globals.DOWNLOAD_CACHE.revalidate = False
+
+    snapshot = snapshotFiles(getWatchedPaths())
+    print(f"\n>>> Watching {', '.join(getWatchedPaths())} for changes (press Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(args.watchInterval)
+            newSnapshot = snapshotFiles(getWatchedPaths())
+            if newSnapshot == snapshot:
+                continue
+
+            # Editors may save a file in several steps, so wait until the files stop changing
+            while True:
+                time.sleep(args.watchInterval)
+                laterSnapshot = snapshotFiles(getWatchedPaths())
+                if laterSnapshot == newSnapshot:
+                    break
+                newSnapshot = laterSnapshot
+
+            changedPaths = sorted(path for path in set(snapshot) | set(newSnapshot) if snapshot.get(path) != newSnapshot.get(path))
+            snapshot = newSnapshot
+            print(f"\n>>> {len(changedPaths)} files changed: {', '.join(changedPaths[:10])}{' ...' if len(changedPaths) > 10 else ''}")
+
+            Globals.METRICS = BuildMetrics()
+            startTime = time.perf_counter()
+            try:
+                if session.canUpdate():
+                    entryCount = session.update(changedPaths)
+                    if Globals.METRICS.stages:
+                        writeBuildReport(reportPath, {chapter.name: Globals.METRICS.toDict()})
+                    print(f">>> Updated {entryCount} entries of {session.archivePath} in {time.perf_counter() - startTime:.2f}s")
+                else:
+                    releasePath = session.rebuild()
+                    writeBuildReport(reportPath, {chapter.name: Globals.METRICS.toDict()})
+                    appendBuildHistory({chapter.name: Globals.METRICS.toDict()})
+                    print(f">>> Rebuilt {releasePath} in {time.perf_counter() - startTime:.2f}s")
+            except Exception:
+                traceback.print_exc()
+                print(f">>> Build failed after {time.perf_counter() - startTime:.2f}s, waiting for more changes...")
+    except KeyboardInterrupt:
+        print(">>> Stopped watching")
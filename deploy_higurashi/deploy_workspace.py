@@ -0,0 +1,336 @@
+"""Per-build workspaces, background folder removal and indexes of the files to archive"""
+
+import os
+import stat
+import shutil
+import time
+import traceback
+import itertools
+import collections
+import threading
+from typing import Dict, List
+
+from deploy_common import ChapterInfo, copyFileCounted, Globals, sha256File, tryRemoveTree
+
+
+class BackgroundRemover:
+    """
+    Deletes folders without making the build wait: remove() renames the folder into a trash folder next to it, and a
+    background thread deletes it. Call waitForAll() before exiting. removeLeftovers() cleans up after killed builds.
+    """
+    TRASH_FOLDER_NAME = '.higurashi_trash'
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.pending: Dict[str, threading.Thread] = {}
+        self.failed: List[str] = []
+
+    def remove(self, path):
+        """Move the folder at path out of the way and start deleting it. Files are removed immediately."""
+        if not os.path.lexists(path):
+            return
+        if os.path.islink(path) or not os.path.isdir(path):
+            tryRemoveTree(path)
+            return
+
+        trashFolder = os.path.join(os.path.dirname(os.path.abspath(path)), BackgroundRemover.TRASH_FOLDER_NAME)
+        # The process ID keeps the name unique when several builds share a folder
+        trashPath = os.path.join(trashFolder, f'{os.path.basename(os.path.abspath(path))}-{os.getpid()}-{next(self.counter)}')
+        try:
+            os.makedirs(trashFolder, exist_ok=True)
+            os.rename(path, trashPath)
+        except OSError as e:
+            print(f'Warning: Failed to move "{path}" to the trash ({e}), deleting it now instead')
+            tryRemoveTree(path)
+            return
+
+        self._startDeleting(trashPath)
+
+    def removeLeftovers(self, parentFolder):
+        """Start deleting anything left in the trash folder of parentFolder by an earlier build which didn't finish its deletions"""
+        trashFolder = os.path.join(parentFolder, BackgroundRemover.TRASH_FOLDER_NAME)
+        try:
+            names = os.listdir(trashFolder)
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            trashPath = os.path.join(os.path.abspath(trashFolder), name)
+            with self.lock:
+                if trashPath in self.pending:
+                    continue
+            print(f'Deleting {trashPath} left over by an earlier build')
+            self._startDeleting(trashPath)
+
+    def waitForAll(self):
+        """Wait for the pending deletions to finish, and report the folders which couldn't be deleted"""
+        with self.lock:
+            threads = list(self.pending.values())
+
+        if threads:
+            print(f">>> Waiting for {len(threads)} folders to finish being deleted in the background...")
+            startTime = time.perf_counter()
+            for thread in threads:
+                thread.join()
+            print(f">>> Background deletion finished in {time.perf_counter() - startTime:.2f}s")
+
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+        for trashPath in failed:
+            print(f'Warning: Failed to delete "{trashPath}" - the next build will try again')
+
+    def _startDeleting(self, trashPath):
+        # Daemon threads, so an interrupted build can still exit. Whatever is left is deleted by the next build.
+        thread = threading.Thread(target=self._deleteTree, args=(trashPath,), name=f'remove {trashPath}', daemon=True)
+        with self.lock:
+            self.pending[trashPath] = thread
+        thread.start()
+
+    def _deleteTree(self, trashPath):
+        try:
+            filePaths = []
+            folderPaths = []
+            for dirPath, dirNames, fileNames in os.walk(trashPath):
+                folderPaths.append(dirPath)
+                filePaths.extend(os.path.join(dirPath, fileName) for fileName in fileNames)
+                # os.walk() doesn't enter symlinked folders, but the links themselves must be removed like files
+                filePaths.extend(os.path.join(dirPath, dirName) for dirName in dirNames if os.path.islink(os.path.join(dirPath, dirName)))
+
+            # Most of the time is spent waiting for the filesystem to update its metadata, which it can do for many files at once
+            threads = [threading.Thread(target=BackgroundRemover._unlinkFiles, args=(filePaths[i::self.workers],), daemon=True) for i in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for folderPath in reversed(folderPaths):
+                try:
+                    os.rmdir(folderPath)
+                except OSError:
+                    pass
+
+            # Anything the fast path couldn't delete (eg. files that were still open on Windows) is retried the slow way
+            if os.path.lexists(trashPath):
+                tryRemoveTree(trashPath)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                del self.pending[trashPath]
+                if os.path.lexists(trashPath):
+                    self.failed.append(trashPath)
+                elif not self.pending:
+                    # Only succeeds once the trash folder is empty, which may not be the case if another build is using it
+                    try:
+                        os.rmdir(os.path.dirname(trashPath))
+                    except OSError:
+                        pass
+
+    @staticmethod
+    def _unlinkFiles(paths):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Read-only files can't be deleted on Windows
+                try:
+                    os.chmod(path, stat.S_IWRITE)
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+
+Globals.TREE_REMOVER = BackgroundRemover()
+
+
+def removeTreeInBackground(path):
+    """Delete the folder at path without waiting for it. See BackgroundRemover."""
+    Globals.TREE_REMOVER.remove(path)
+
+
+class StagingSync:
+    """
+    Keeps a persistent staging folder in sync with its sources, like rsync. sync() only replaces a staged file if its
+    source has changed (compared by size and modification time, and also by SHA-256 if 'checksum' is True), replacing
+    it atomically, and prune() deletes the staged files and folders which weren't synced during this build, because
+    their source no longer exists. Staged files keep the modification time of their source.
+    """
+    def __init__(self, checksum=False):
+        self.checksum = checksum
+        self.lock = threading.Lock()
+        self.syncedPaths = set()
+        self.counts = {'unchanged': 0, 'updated': 0, 'deleted': 0}
+
+    def _record(self, path, count):
+        with self.lock:
+            self.syncedPaths.add(os.path.abspath(path))
+            self.counts[count] += 1
+
+    def isUnchanged(self, src, dst, byContents=False):
+        """If byContents is True, the modification time is ignored, for sources which are always newly written"""
+        try:
+            srcStat = os.stat(src)
+            dstStat = os.stat(dst)
+        except FileNotFoundError:
+            return False
+        if srcStat.st_size != dstStat.st_size or (not byContents and srcStat.st_mtime_ns != dstStat.st_mtime_ns):
+            return False
+        if byContents or self.checksum:
+            return sha256File(src) == sha256File(dst)
+        return True
+
+    def sync(self, src, dst, copyFunction=copyFileCounted, byContents=False):
+        """Copy src to dst with copyFunction, unless dst is already up to date. Can be used as a copytree() copy_function."""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if self.isUnchanged(src, dst, byContents):
+            self._record(dst, 'unchanged')
+            return dst
+
+        # Copy next to the staged file, then swap it in, so the staged file is never partially written
+        tempDst = f'{dst}.{os.getpid()}-{threading.get_ident()}.sync'
+        try:
+            copyFunction(src, tempDst)
+            os.replace(tempDst, dst)
+        except BaseException:
+            tryRemoveTree(tempDst)
+            raise
+        self._record(dst, 'updated')
+        return dst
+
+    def makeDirs(self, path):
+        os.makedirs(path, exist_ok=True)
+        self._record(path, 'unchanged')
+
+    def prune(self, root):
+        """Delete everything in root which wasn't synced since this StagingSync was created (except the parent folders of synced files)"""
+        with self.lock:
+            keepPaths = set(self.syncedPaths)
+        for path in list(keepPaths):
+            parent = os.path.dirname(path)
+            while parent not in keepPaths and parent != os.path.dirname(parent):
+                keepPaths.add(parent)
+                parent = os.path.dirname(parent)
+
+        # Bottom up, so that each folder is emptied before it is checked
+        for dirPath, dirNames, fileNames in os.walk(root, topdown=False):
+            for name in fileNames + dirNames:
+                path = os.path.abspath(os.path.join(dirPath, name))
+                if path not in keepPaths:
+                    tryRemoveTree(path)
+                    self.counts['deleted'] += 1
+
+    def summary(self):
+        return ', '.join(f'{count} {kind}' for kind, count in self.counts.items())
+
+
+class Workspace:
+    """
+    Scratch folders used while building one chapter. The default workspace ('.') uses 'temp' and '{baseName}_base',
+    and a multi-chapter build gives each chapter its own root. keepStaging keeps 'temp' between builds (see StagingSync).
+    """
+    def __init__(self, root='.', keepStaging=False, stagingChecksum=False):
+        self.root = os.path.normpath(root)
+        self.tempDir = os.path.normpath(os.path.join(root, 'temp'))
+        self.staging = StagingSync(stagingChecksum) if keepStaging else None
+
+    def baseFolder(self, chapter: ChapterInfo):
+        return os.path.normpath(os.path.join(self.root, f'{chapter.baseName}_base'))
+
+    def dataFolder(self, dataFolderName):
+        return os.path.join(self.tempDir, dataFolderName)
+
+    def copyFile(self, src, dst, copyFunction=copyFileCounted, byContents=False):
+        """Copy src to dst in the temp folder. Can be used as a copytree() copy_function."""
+        if self.staging is None:
+            return copyFunction(src, dst)
+        return self.staging.sync(src, dst, copyFunction, byContents)
+
+    def makeDirs(self, path):
+        if self.staging is None:
+            os.makedirs(path, exist_ok=True)
+        else:
+            self.staging.makeDirs(path)
+
+    def clearTemp(self):
+        """Remove the temp folder, unless it is kept between builds"""
+        if self.staging is None:
+            removeTreeInBackground(self.tempDir)
+
+
+def listFilesRecursive(folder):
+    """Returns the path of every file in folder, relative to folder, using '/' as the separator"""
+    relPaths = []
+    for dirPath, dirNames, fileNames in os.walk(folder):
+        for fileName in fileNames:
+            relPaths.append(os.path.relpath(os.path.join(dirPath, fileName), folder).replace(os.sep, '/'))
+    return sorted(relPaths)
+
+
+# One entry of a FileIndex. 'relPath' is relative to the indexed folder and always uses '/' as the separator.
+FileEntry = collections.namedtuple('FileEntry', ['path', 'relPath', 'size', 'mtime', 'mode', 'inode', 'isDir'])
+
+
+def fileEntryFromPath(path, relPath=None):
+    st = os.stat(path)
+    return FileEntry(path, relPath if relPath is not None else os.path.basename(path), st.st_size, st.st_mtime, st.st_mode, st.st_ino, stat.S_ISDIR(st.st_mode))
+
+
+class FileIndex:
+    """
+    Index of every file and folder in a folder tree, built with a single os.scandir() walk.
+
+    Top level entries named in ignoreNames (compared case-insensitively) are skipped, along with everything inside
+    them. The same index is then reused to copy, archive or hash the files, instead of walking the tree again.
+    """
+    def __init__(self, root, ignoreNames=()):
+        self.root = root
+        self.ignoreNames = set(os.path.normcase(name).lower() for name in ignoreNames)
+        self.ignored: List[str] = []
+        self.entries: List[FileEntry] = []
+        self._scan(root, '')
+
+    def _scan(self, folderPath, relFolder):
+        with os.scandir(folderPath) as it:
+            dirEntries = sorted(it, key=lambda dirEntry: dirEntry.name)
+
+        for dirEntry in dirEntries:
+            if not relFolder and os.path.normcase(dirEntry.name).lower() in self.ignoreNames:
+                self.ignored.append(dirEntry.name)
+                continue
+
+            # Like shutil.copytree(), symlinks are followed
+            st = dirEntry.stat()
+            relPath = f'{relFolder}{dirEntry.name}'
+            isDir = stat.S_ISDIR(st.st_mode)
+            self.entries.append(FileEntry(dirEntry.path, relPath, 0 if isDir else st.st_size, st.st_mtime, st.st_mode, st.st_ino, isDir))
+            if isDir:
+                self._scan(dirEntry.path, relPath + '/')
+
+    def files(self):
+        return [entry for entry in self.entries if not entry.isDir]
+
+    def totalSize(self):
+        return sum(entry.size for entry in self.entries)
+
+    def toMappings(self, archiveFolder):
+        """Returns (FileEntry, archivePath) mappings placing the indexed files under archiveFolder, including an entry for archiveFolder itself"""
+        mappings = [(fileEntryFromPath(self.root, ''), archiveFolder + '/')]
+        for entry in self.entries:
+            mappings.append((entry, f'{archiveFolder}/{entry.relPath}' + ('/' if entry.isDir else '')))
+        return mappings
+
+    def copyTo(self, destFolder, copyFunction=shutil.copy2, makeDirsFunction=lambda path: os.makedirs(path, exist_ok=True)):
+        for entry in self.entries:
+            destPath = os.path.join(destFolder, entry.relPath)
+            if entry.isDir:
+                makeDirsFunction(destPath)
+            else:
+                copyFunction(entry.path, destPath)
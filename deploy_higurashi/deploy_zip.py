@@ -0,0 +1,913 @@
+"""Parallel zip writing with baseline reuse, verification and multi-volume output"""
+
+import os
+import time
+import hashlib
+import concurrent.futures
+import json
+import zipfile
+import zlib
+import collections
+import threading
+import contextlib
+import struct
+import sys
+from typing import List, Optional
+
+from deploy_common import (
+    CompressionPolicy, CompressionSavings, getManifestPath, Globals, LinkingCopier, sha256File, tryRemoveTree, writeArchiveManifest,
+)
+from deploy_workspace import FileEntry
+
+
+# Default size of the chunks large files are split into for parallel compression (see ParallelZipWriter)
+ZIP_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ZipFileInternals:
+    """
+    The undocumented parts of zipfile which are needed to read and write the compressed bytes of entries directly,
+    and to drop entries from a zip opened in 'a' mode. Nothing else in this module touches them. They are checked
+    when a ZipFile is wrapped, so a Python version which changed them fails with a clear error instead of writing a
+    broken zip.
+    """
+    ZIPFILE_ATTRIBUTES = ['fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify', '_writecheck']
+    MODULE_ATTRIBUTES = ['sizeFileHeader', 'stringFileHeader']
+
+    def __init__(self, zf: zipfile.ZipFile):
+        missing = [name for name in ZipFileInternals.ZIPFILE_ATTRIBUTES if not hasattr(zf, name)]
+        missing += [f'zipfile.{name}' for name in ZipFileInternals.MODULE_ATTRIBUTES if not hasattr(zipfile, name)]
+        if not hasattr(zipfile.ZipInfo, 'FileHeader'):
+            missing.append('zipfile.ZipInfo.FileHeader')
+        if missing:
+            raise Exception(f"ERROR: The zipfile module of Python {sys.version.split()[0]} doesn't have {', '.join(missing)}, which deploy_zip.py needs to write zips")
+        self.zf = zf
+
+    def seek(self, offset):
+        self.zf.fp.seek(offset)
+
+    def read(self, size):
+        return self.zf.fp.read(size)
+
+    def write(self, data):
+        self.zf.fp.write(data)
+
+    def beginEntry(self, zinfo: zipfile.ZipInfo, zip64):
+        """Write the local header of zinfo after the last entry, like ZipFile.open(zinfo, 'w'). Returns the offset of the entry's data."""
+        self.zf.fp.seek(self.zf.start_dir)
+        zinfo.header_offset = self.zf.fp.tell()
+        self.zf._writecheck(zinfo)
+        self.zf._didModify = True
+        self.zf.fp.write(zinfo.FileHeader(zip64))
+        return self.zf.fp.tell()
+
+    def endEntry(self, zinfo: zipfile.ZipInfo, zip64):
+        """Write the local header again, now that the CRC and sizes are known, and add zinfo to the central directory"""
+        self.zf.start_dir = self.zf.fp.tell()
+        self.zf.fp.seek(zinfo.header_offset)
+        self.zf.fp.write(zinfo.FileHeader(zip64))
+        self.zf.fp.seek(self.zf.start_dir)
+        self.zf.filelist.append(zinfo)
+        self.zf.NameToInfo[zinfo.filename] = zinfo
+
+    def removeEntry(self, zinfo: zipfile.ZipInfo):
+        """Drop zinfo from the central directory, which is written again when the zip is closed. Its bytes stay in the zip."""
+        self.zf.filelist.remove(zinfo)
+        del self.zf.NameToInfo[zinfo.filename]
+        self.zf._didModify = True
+
+
+def getZipEntryDataOffset(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo):
+    """Returns the offset of the compressed data of zinfo within the zip file, by reading its local file header"""
+    zfInternals = ZipFileInternals(zf)
+    zfInternals.seek(zinfo.header_offset)
+    header = zfInternals.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+        raise Exception(f"ERROR: Bad local file header for {zinfo.filename} in {zf.filename}")
+    fileNameLength, extraLength = struct.unpack('<HH', header[26:30])
+    return zinfo.header_offset + zipfile.sizeFileHeader + fileNameLength + extraLength
+
+
+def zipInfoFromEntry(entry: FileEntry, archivePath):
+    """Same as zipfile.ZipInfo.from_file(), but using the already known FileEntry instead of calling os.stat() again"""
+    # Zip files can't store dates before 1980
+    dateTime = max(time.localtime(entry.mtime)[0:6], (1980, 1, 1, 0, 0, 0))
+    zinfo = zipfile.ZipInfo(archivePath, dateTime)
+    zinfo.external_attr = (entry.mode & 0xFFFF) << 16
+    if entry.isDir:
+        zinfo.file_size = 0
+        zinfo.external_attr |= 0x10
+    else:
+        zinfo.file_size = entry.size
+    return zinfo
+
+
+class CompressedBlobStore:
+    """
+    Content addressed store of deflate compressed files, shared by every chapter built with the same cache folder.
+    Blobs are '{sha256[:2]}/{sha256}-{compressLevel}': a CRC and size header followed by the raw deflate stream.
+    """
+    HEADER = struct.Struct('<IQ')
+
+    def __init__(self, root, maxSizeBytes):
+        self.root = root
+        self.maxSizeBytes = maxSizeBytes
+
+    def _blobPath(self, sha256, compressLevel):
+        return os.path.join(self.root, sha256[:2], f'{sha256}-{compressLevel}')
+
+    def find(self, sha256, compressLevel):
+        """Returns the path of the blob for a file, or None if the file has not been stored yet"""
+        blobPath = self._blobPath(sha256, compressLevel)
+        try:
+            # Update the modification time, which is used to evict the least recently used blobs
+            os.utime(blobPath)
+        except FileNotFoundError:
+            return None
+        return blobPath
+
+    @staticmethod
+    def readHeader(f):
+        """Returns the (crc, fileSize) of an open blob. Afterwards, f is positioned at the start of the compressed data."""
+        header = f.read(CompressedBlobStore.HEADER.size)
+        if len(header) != CompressedBlobStore.HEADER.size:
+            raise Exception(f"ERROR: Compressed blob {f.name} is truncated")
+        return CompressedBlobStore.HEADER.unpack(header)
+
+    def read(self, sha256, compressLevel):
+        """Returns (compressedData, crc, fileSize) for a stored file, or None if the file has not been stored yet"""
+        blobPath = self.find(sha256, compressLevel)
+        if blobPath is None:
+            return None
+        with open(blobPath, 'rb') as f:
+            crc, fileSize = CompressedBlobStore.readHeader(f)
+            data = f.read()
+        Globals.METRICS.add(bytesRead=len(data))
+        return data, crc, fileSize
+
+    def create(self, sha256, compressLevel):
+        return CompressedBlobWriter(self._blobPath(sha256, compressLevel))
+
+    def store(self, sha256, compressLevel, compressedData, crc, fileSize):
+        with self.create(sha256, compressLevel) as writer:
+            writer.write(compressedData)
+            writer.commit(crc, fileSize)
+
+    def evict(self):
+        """Remove the least recently used blobs until the store fits in maxSizeBytes"""
+        blobs = []
+        for dirPath, _, fileNames in os.walk(self.root):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                # Leftovers from a build which crashed while writing a blob
+                if fileName.endswith('.part') and time.time() - st.st_mtime > 24 * 60 * 60:
+                    tryRemoveTree(path)
+                    continue
+                blobs.append((st.st_mtime, st.st_size, path))
+
+        totalSize = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if totalSize <= self.maxSizeBytes:
+                break
+            tryRemoveTree(path)
+            totalSize -= size
+
+
+class CompressedBlobWriter:
+    """
+    Writes one blob of a CompressedBlobStore. The blob is only added to the store once commit() is called,
+    and close() discards the blob if it wasn't committed.
+    """
+    def __init__(self, blobPath):
+        self.blobPath = blobPath
+        self.partPath = f'{blobPath}.{os.getpid()}-{threading.get_ident()}.part'
+        os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+        self.f = open(self.partPath, 'wb')
+        # Placeholder, filled in by commit()
+        self.f.write(bytes(CompressedBlobStore.HEADER.size))
+
+    def write(self, data):
+        self.f.write(data)
+
+    def commit(self, crc, fileSize):
+        self.f.seek(0)
+        self.f.write(CompressedBlobStore.HEADER.pack(crc, fileSize))
+        self.f.close()
+        os.replace(self.partPath, self.blobPath)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+        tryRemoveTree(self.partPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Result of compressing a file which fits in a single chunk, see ParallelZipWriter._deflateFile()
+CompressedFile = collections.namedtuple('CompressedFile', ['data', 'crc', 'fileSize', 'wasDeduplicated', 'compressLevel', 'sha256'])
+
+
+class ParallelZipWriter:
+    """
+    Writes a standard zip file, compressing members (and chunks of large files, joined with a sync flush like pigz)
+    on a thread pool at the levels chosen by a CompressionPolicy. Entries matching one of the baseline zips or the
+    blob store are copied as already compressed bytes. Files are hashed while they are read, for manifestEntries().
+    """
+    def __init__(self, zf: zipfile.ZipFile, executor: concurrent.futures.Executor, workers, policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE, baselines: Optional[List[zipfile.ZipFile]] = None, blobStore: Optional[CompressedBlobStore] = None):
+        self.zf = zf
+        self.zfInternals = ZipFileInternals(zf)
+        self.executor = executor
+        self.policy = policy or CompressionPolicy.uniform()
+        self.savings = CompressionSavings(lambda data: zlib.compress(data, self.policy.defaultLevel))
+        self.chunkSize = chunkSize
+        self.baselines = baselines or []
+        self.blobStore = blobStore
+        # Limit the number of chunks in memory at once
+        self.maxPendingJobs = workers * 4
+        self.reusedEntries = 0
+        self.reusedBytes = 0
+        self.compressedEntries = 0
+        self.dedupedEntries = 0
+        self.dedupedBytes = 0
+        self.blobWriters: List[CompressedBlobWriter] = []
+        # archivePath -> SHA-256 of the file, archivePath -> offset of the entry's data in the zip, and
+        # archivePath -> compression level of the entry (which the zip itself doesn't record)
+        self.hashes = {}
+        self.dataOffsets = {}
+        self.compressLevels = {}
+
+    @staticmethod
+    def _deflate(data, compressLevel, isLastChunk):
+        if compressLevel == CompressionPolicy.STORE:
+            return data
+        compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if isLastChunk else zlib.Z_SYNC_FLUSH)
+
+    def _deflateFile(self, path, compressLevel):
+        """Returns a CompressedFile. If compressLevel is None, the level is chosen by sampling the file."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        Globals.METRICS.add(bytesRead=len(data))
+        sha256 = hashlib.sha256(data).hexdigest()
+        if compressLevel is None:
+            compressLevel = self.policy.sampleLevel(self.policy.sample(data))
+
+        if compressLevel == CompressionPolicy.STORE:
+            self.savings.addStored(path, len(data), lambda: self.policy.sample(data))
+            return CompressedFile(data, zlib.crc32(data), len(data), False, compressLevel, sha256)
+
+        blobStore = self.blobStore
+        if blobStore is None:
+            return CompressedFile(ParallelZipWriter._deflate(data, compressLevel, True), zlib.crc32(data), len(data), False, compressLevel, sha256)
+
+        stored = blobStore.read(sha256, compressLevel)
+        if stored is not None:
+            compressedData, crc, fileSize = stored
+            return CompressedFile(compressedData, crc, fileSize, True, compressLevel, sha256)
+
+        compressedData = ParallelZipWriter._deflate(data, compressLevel, True)
+        crc = zlib.crc32(data)
+        blobStore.store(sha256, compressLevel, compressedData, crc, len(data))
+        return CompressedFile(compressedData, crc, len(data), False, compressLevel, sha256)
+
+    def _chooseLevel(self, path, fileSize):
+        """The level the policy picks for a file, sampling it if its extension doesn't decide"""
+        compressLevel = self.policy.levelForExtension(path, fileSize)
+        if compressLevel is None:
+            compressLevel = self.policy.sampleLevel(self.policy.readSample(path, fileSize))
+        return compressLevel
+
+    def _loadBaselineManifests(self):
+        """Returns archivePath -> manifest entry for each baseline zip. A baseline without a manifest has no entries."""
+        manifests = []
+        for baseline in self.baselines:
+            try:
+                with open(getManifestPath(baseline.filename), 'r') as f:
+                    manifests.append(dict((entry['path'], entry) for entry in json.load(f)['entries']))
+            except (FileNotFoundError, ValueError, KeyError):
+                print(f"WARNING: {baseline.filename} has no readable manifest, so none of its entries can be reused")
+                manifests.append({})
+        return manifests
+
+    def _findBaselineEntry(self, archivePath, baselineManifests):
+        """Returns (baseline, ZipInfo, manifest entry) of the first baseline zip with an entry at archivePath, or None"""
+        for baseline, manifest in zip(self.baselines, baselineManifests):
+            try:
+                baselineInfo = baseline.getinfo(archivePath)
+            except KeyError:
+                continue
+            manifestEntry = manifest.get(archivePath)
+            return (baseline, baselineInfo, manifestEntry) if manifestEntry is not None else None
+        return None
+
+    def _findReusableEntries(self, mappings):
+        """
+        Returns a dict of archivePath -> (baseline, ZipInfo), for each file with the SHA-256 recorded in the baseline's
+        manifest, whose baseline entry was written with the compression level the policy picks for the file now
+        """
+        if not self.baselines:
+            return {}
+
+        baselineManifests = self._loadBaselineManifests()
+        candidates = {}
+        for entry, archivePath in mappings:
+            found = self._findBaselineEntry(archivePath, baselineManifests)
+            if found is None:
+                continue
+            _, baselineInfo, manifestEntry = found
+            if baselineInfo.is_dir() or baselineInfo.flag_bits & 0x1:
+                continue
+            if baselineInfo.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                continue
+            # Manifests written before the level was recorded can't tell which level an entry was deflated at
+            if 'compressLevel' not in manifestEntry or (manifestEntry['compressLevel'] == CompressionPolicy.STORE) != (baselineInfo.compress_type == zipfile.ZIP_STORED):
+                continue
+            # Skip a manifest which doesn't describe this zip
+            if manifestEntry['crc32'] != baselineInfo.CRC or manifestEntry['compressedSize'] != baselineInfo.compress_size:
+                continue
+            if entry.size != baselineInfo.file_size:
+                continue
+            candidates[archivePath] = (found, self.executor.submit(sha256File, entry.path), self.executor.submit(self._chooseLevel, entry.path, entry.size))
+
+        reusableEntries = {}
+        for archivePath, (found, sha256Future, levelFuture) in candidates.items():
+            baseline, baselineInfo, manifestEntry = found
+            sha256 = sha256Future.result()
+            if sha256 == manifestEntry['sha256'] and levelFuture.result() == manifestEntry['compressLevel']:
+                reusableEntries[archivePath] = (baseline, baselineInfo)
+                self.hashes[archivePath] = sha256
+                self.compressLevels[archivePath] = manifestEntry['compressLevel']
+        return reusableEntries
+
+    def _jobs(self, mappings):
+        """
+        Yields a job for each entry or chunk, in order: ('dir', sourcePath, zinfo), ('copy', zinfo, baseline, baselineInfo),
+        ('blob', zinfo, blobPath) or ('chunk', zinfo, isFirstChunk, isLastChunk, future, crcAndSize, blobWriter).
+        """
+        reusableEntries = self._findReusableEntries(mappings)
+
+        for entry, archivePath in mappings:
+            sourcePath = entry.path
+            zinfo = zipInfoFromEntry(entry, archivePath)
+            if zinfo.is_dir():
+                yield 'dir', sourcePath, zinfo
+                continue
+
+            if archivePath in reusableEntries:
+                yield ('copy', zinfo) + reusableEntries[archivePath]
+                continue
+
+            compressLevel = self.policy.levelForExtension(sourcePath, zinfo.file_size)
+            if zinfo.file_size <= self.chunkSize:
+                yield 'chunk', zinfo, True, True, self.executor.submit(self._deflateFile, sourcePath, compressLevel), None, None
+                continue
+
+            if compressLevel is None:
+                compressLevel = self.policy.sampleLevel(self.policy.readSample(sourcePath, zinfo.file_size))
+            self.compressLevels[archivePath] = compressLevel
+
+            blobWriter = None
+            sha256 = None
+            if compressLevel == CompressionPolicy.STORE:
+                zinfo.compress_type = zipfile.ZIP_STORED
+                self.savings.addStored(sourcePath, zinfo.file_size, lambda: self.policy.readSample(sourcePath, zinfo.file_size))
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                if self.blobStore is not None:
+                    sha256 = sha256File(sourcePath)
+                    self.hashes[archivePath] = sha256
+                    blobPath = self.blobStore.find(sha256, compressLevel)
+                    if blobPath is not None:
+                        yield 'blob', zinfo, blobPath
+                        continue
+                    blobWriter = self.blobStore.create(sha256, compressLevel)
+                    self.blobWriters.append(blobWriter)
+
+            crc = 0
+            fileSize = 0
+            # Hash the file while reading it, unless it was already hashed for the blob store
+            h = hashlib.sha256() if sha256 is None else None
+            with open(sourcePath, 'rb') as f:
+                data = f.read(self.chunkSize)
+                isFirstChunk = True
+                while True:
+                    nextData = f.read(self.chunkSize)
+                    isLastChunk = len(nextData) == 0
+                    crc = zlib.crc32(data, crc)
+                    if h is not None:
+                        h.update(data)
+                        if isLastChunk:
+                            self.hashes[archivePath] = h.hexdigest()
+                    fileSize += len(data)
+                    Globals.METRICS.add(bytesRead=len(data))
+                    future = self.executor.submit(ParallelZipWriter._deflate, data, compressLevel, isLastChunk)
+                    yield 'chunk', zinfo, isFirstChunk, isLastChunk, future, (crc, fileSize) if isLastChunk else None, blobWriter
+                    if isLastChunk:
+                        break
+
+                    isFirstChunk = False
+                    data = nextData
+
+    def _beginEntry(self, zinfo, zip64):
+        # Mirrors what ZipFile.open(zinfo, 'w') does, except the data written is already compressed
+        self.zip64 = zip64
+        self.compressSize = 0
+        self.dataOffsets[zinfo.filename] = self.zfInternals.beginEntry(zinfo, zip64)
+
+    def _writeData(self, data):
+        self.zfInternals.write(data)
+        self.compressSize += len(data)
+
+    def _endEntry(self, zinfo, crc, fileSize):
+        zinfo.CRC = crc
+        zinfo.file_size = fileSize
+        zinfo.compress_size = self.compressSize
+        if not self.zip64 and (fileSize > zipfile.ZIP64_LIMIT or self.compressSize > zipfile.ZIP64_LIMIT):
+            raise Exception(f"ERROR: {zinfo.filename} changed size while it was being compressed")
+
+        self.zfInternals.endEntry(zinfo, self.zip64)
+
+    def _copyBaselineEntry(self, zinfo, baseline: zipfile.ZipFile, baselineInfo):
+        zinfo.compress_type = baselineInfo.compress_type
+        # Keep the deflate option bits, but not the data descriptor bit, as the sizes are written in the header
+        zinfo.flag_bits = baselineInfo.flag_bits & 0x6
+        zinfo.CRC = baselineInfo.CRC
+        zinfo.file_size = baselineInfo.file_size
+        zinfo.compress_size = baselineInfo.compress_size
+        self._beginEntry(zinfo, zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+        baselineInternals = ZipFileInternals(baseline)
+        baselineInternals.seek(getZipEntryDataOffset(baseline, baselineInfo))
+        remaining = baselineInfo.compress_size
+        while remaining > 0:
+            data = baselineInternals.read(min(remaining, self.chunkSize))
+            if not data:
+                raise Exception(f"ERROR: Baseline zip {baseline.filename} is truncated")
+            self._writeData(data)
+            remaining -= len(data)
+            Globals.METRICS.add(bytesRead=len(data))
+
+        self._endEntry(zinfo, baselineInfo.CRC, baselineInfo.file_size)
+        self.reusedEntries += 1
+        self.reusedBytes += baselineInfo.compress_size
+
+    def _copyBlob(self, zinfo, blobPath):
+        with open(blobPath, 'rb') as f:
+            crc, fileSize = CompressedBlobStore.readHeader(f)
+            compressSize = os.fstat(f.fileno()).st_size - CompressedBlobStore.HEADER.size
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.flag_bits = 0x00
+            zinfo.CRC = crc
+            zinfo.file_size = fileSize
+            zinfo.compress_size = compressSize
+            self._beginEntry(zinfo, fileSize > zipfile.ZIP64_LIMIT or compressSize > zipfile.ZIP64_LIMIT)
+            for data in iter(lambda: f.read(self.chunkSize), b''):
+                self._writeData(data)
+                Globals.METRICS.add(bytesRead=len(data))
+
+        self._endEntry(zinfo, crc, fileSize)
+        self._addDeduplicated(fileSize)
+
+    def _addDeduplicated(self, fileSize):
+        self.dedupedEntries += 1
+        self.dedupedBytes += fileSize
+        Globals.METRICS.add(dedupedBytes=fileSize)
+
+    def _writeJob(self, job):
+        kind = job[0]
+        if kind == 'dir':
+            _, sourcePath, zinfo = job
+            self.zf.write(sourcePath, zinfo.filename)
+            return
+
+        if kind == 'copy':
+            _, zinfo, baseline, baselineInfo = job
+            self._copyBaselineEntry(zinfo, baseline, baselineInfo)
+            return
+
+        if kind == 'blob':
+            _, zinfo, blobPath = job
+            self._copyBlob(zinfo, blobPath)
+            return
+
+        _, zinfo, isFirstChunk, isLastChunk, future, crcAndSize, blobWriter = job
+        wasDeduplicated = False
+        if crcAndSize is None and isLastChunk:
+            compressedFile: CompressedFile = future.result()
+            data, crc, fileSize, wasDeduplicated = compressedFile.data, compressedFile.crc, compressedFile.fileSize, compressedFile.wasDeduplicated
+            zinfo.compress_type = zipfile.ZIP_STORED if compressedFile.compressLevel == CompressionPolicy.STORE else zipfile.ZIP_DEFLATED
+            self.hashes[zinfo.filename] = compressedFile.sha256
+            self.compressLevels[zinfo.filename] = compressedFile.compressLevel
+        else:
+            data = future.result()
+
+        if isFirstChunk:
+            zinfo.flag_bits = 0x00
+            zinfo.compress_size = 0
+            zinfo.CRC = 0
+            self._beginEntry(zinfo, zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT)
+
+        self._writeData(data)
+        if blobWriter is not None:
+            blobWriter.write(data)
+
+        if not isLastChunk:
+            return
+
+        if crcAndSize is not None:
+            crc, fileSize = crcAndSize
+            if blobWriter is not None:
+                blobWriter.commit(crc, fileSize)
+
+        self._endEntry(zinfo, crc, fileSize)
+        if wasDeduplicated:
+            self._addDeduplicated(fileSize)
+        else:
+            self.compressedEntries += 1
+
+    def manifestEntries(self):
+        """Returns a manifest entry for each file written to the zip, in the order they appear in the zip"""
+        entries = []
+        for zinfo in self.zf.infolist():
+            if zinfo.is_dir():
+                continue
+            entries.append({
+                'path': zinfo.filename,
+                'size': zinfo.file_size,
+                'sha256': self.hashes[zinfo.filename],
+                'crc32': zinfo.CRC,
+                'headerOffset': zinfo.header_offset,
+                'dataOffset': self.dataOffsets[zinfo.filename],
+                'compressedSize': zinfo.compress_size,
+                'compressType': 'stored' if zinfo.compress_type == zipfile.ZIP_STORED else 'deflated',
+                'compressLevel': self.compressLevels.get(zinfo.filename),
+            })
+        return entries
+
+    def write(self, mappings):
+        pendingJobs = collections.deque()
+        try:
+            for job in self._jobs(mappings):
+                pendingJobs.append(job)
+                if len(pendingJobs) >= self.maxPendingJobs:
+                    self._writeJob(pendingJobs.popleft())
+
+            while pendingJobs:
+                self._writeJob(pendingJobs.popleft())
+        finally:
+            # Remove the partial blobs of any large files which weren't written
+            for blobWriter in self.blobWriters:
+                blobWriter.close()
+
+        if self.baselines:
+            print(f"Reused {self.reusedEntries} unchanged entries ({self.reusedBytes} compressed bytes) from {', '.join(baseline.filename for baseline in self.baselines)}, compressed {self.compressedEntries} new or changed files")
+        if self.blobStore is not None:
+            print(f"Deduplicated {self.dedupedEntries} entries ({self.dedupedBytes} bytes) using the compressed blob store, compressed {self.compressedEntries} files")
+
+        savings = self.savings.toDict()
+        Globals.METRICS.annotate(compression=savings)
+        if savings['storedFiles'] > 0:
+            print(f"Stored {savings['storedFiles']} incompressible files ({savings['storedBytes']} bytes) without compression: "
+                  f"saved an estimated {savings['estimatedCpuSecondsSaved']:.2f}s of CPU time, with an estimated size difference of {savings['estimatedSizeDifferenceBytes']:+d} bytes")
+
+
+def writeZipPart(mappings, outputPath, workers=None, baselinePaths=(), policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE):
+    """
+    Write a zip of each (FileEntry, archivePath) mapping to outputPath + '.part' and return its manifest entries.
+    Unchanged files are copied from the baselinePaths zips. Archive paths ending in '/' are folders.
+    """
+    workers = workers or os.cpu_count() or 1
+    tempOutputPath = outputPath + '.part'
+    try:
+        with contextlib.ExitStack() as stack:
+            baselines = [stack.enter_context(zipfile.ZipFile(baselinePath, 'r')) for baselinePath in baselinePaths]
+            zf = stack.enter_context(zipfile.ZipFile(tempOutputPath, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True))
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+            writer = ParallelZipWriter(zf, executor, workers, policy, chunkSize=chunkSize, baselines=baselines, blobStore=Globals.BLOB_STORE)
+            writer.write(sorted(mappings, key=lambda mapping: mapping[1]))
+    except BaseException:
+        tryRemoveTree(tempOutputPath)
+        raise
+    return writer.manifestEntries()
+
+
+def replaceZipPart(outputPath, mappings, manifestEntries):
+    """Move a zip written by writeZipPart() to outputPath, and write its manifest"""
+    os.replace(outputPath + '.part', outputPath)
+    writeArchiveManifest(outputPath, manifestEntries)
+    Globals.METRICS.add(bytesWritten=os.path.getsize(outputPath), files=sum(1 for _, archivePath in mappings if not archivePath.endswith('/')))
+
+
+def writeZipArchive(mappings, outputPath, workers=None, baselinePaths=(), policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE):
+    """
+    Write a zip of each (FileEntry, archivePath) mapping to outputPath (through a temporary file) and its manifest.
+    Unchanged files are copied from the baselinePaths zips (see getBaselineZipPaths()).
+    """
+    manifestEntries = writeZipPart(mappings, outputPath, workers, baselinePaths, policy, chunkSize)
+    replaceZipPart(outputPath, mappings, manifestEntries)
+    return outputPath
+
+
+def updateZipPart(zipPath, mappings, removedPaths, workers=None, policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE):
+    """
+    Write an updated copy of a zip written by writeZipArchive() to zipPath + '.part', leaving the zip untouched until
+    replaceZipPart() is called. The copy is a reflink where the filesystem supports it. The entries at removedPaths
+    and at the archive paths of the mappings are dropped from its central directory, the mappings are written after
+    the last entry, and the central directory is written again. The bytes of dropped entries stay in the zip until it
+    is written in full again. Returns the manifest entries of the updated zip, and the number of bytes dropped.
+    """
+    workers = workers or os.cpu_count() or 1
+    with open(getManifestPath(zipPath), 'r') as f:
+        manifestEntries = dict((entry['path'], entry) for entry in json.load(f)['entries'])
+
+    tempZipPath = zipPath + '.part'
+    deadBytes = 0
+    try:
+        LinkingCopier('reflink')(zipPath, tempZipPath)
+        with zipfile.ZipFile(tempZipPath, 'a', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            droppedPaths = set(removedPaths) | set(archivePath for _, archivePath in mappings)
+            zfInternals = ZipFileInternals(zf)
+            for zinfo in [zinfo for zinfo in zf.infolist() if zinfo.filename in droppedPaths]:
+                zfInternals.removeEntry(zinfo)
+                deadBytes += getZipEntryDataOffset(zf, zinfo) - zinfo.header_offset + zinfo.compress_size
+
+            writer = ParallelZipWriter(zf, executor, workers, policy, chunkSize=chunkSize, blobStore=Globals.BLOB_STORE)
+            for zinfo in zf.infolist():
+                if not zinfo.is_dir():
+                    writer.hashes[zinfo.filename] = manifestEntries[zinfo.filename]['sha256']
+                    writer.dataOffsets[zinfo.filename] = manifestEntries[zinfo.filename]['dataOffset']
+                    writer.compressLevels[zinfo.filename] = manifestEntries[zinfo.filename].get('compressLevel')
+            writer.write(sorted(mappings, key=lambda mapping: mapping[1]))
+    except BaseException:
+        tryRemoveTree(tempZipPath)
+        raise
+    return writer.manifestEntries(), deadBytes
+
+
+def updateZipArchive(zipPath, mappings, removedPaths, workers=None, policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE):
+    """Update a zip written by writeZipArchive() (see updateZipPart()), returning the number of bytes dropped"""
+    manifestEntries, deadBytes = updateZipPart(zipPath, mappings, removedPaths, workers, policy, chunkSize)
+    replaceZipPart(zipPath, mappings, manifestEntries)
+    return deadBytes
+
+
+def verifyZipEntries(zipPath, names, chunkSize=1024 * 1024):
+    """
+    Decompress the given entries of a zip, checking their CRC, without writing anything to disk.
+    Returns a list of errors.
+    """
+    errors = []
+    with zipfile.ZipFile(zipPath, 'r') as zf:
+        for name in names:
+            try:
+                zinfo = zf.getinfo(name)
+                size = 0
+                # ZipExtFile checks the CRC once the whole entry has been read
+                with zf.open(zinfo, 'r') as f:
+                    for chunk in iter(lambda: f.read(chunkSize), b''):
+                        size += len(chunk)
+                Globals.METRICS.add(bytesRead=zinfo.compress_size)
+                if size != zinfo.file_size:
+                    errors.append(f"{name}: decompressed to {size} bytes, but the zip says {zinfo.file_size} bytes")
+            except (zipfile.BadZipFile, zlib.error, EOFError, OSError) as e:
+                errors.append(f"{name}: {e}")
+    return errors
+
+
+def verifyZipArchive(zipPath, mappings, workers=None, names=None):
+    """
+    Check that the zip contains exactly the entries in mappings (a list of (FileEntry, archivePath)), with the expected
+    sizes, and that every entry (or only the entries in 'names') decompresses with the correct CRC. Entries are checked
+    in parallel, streaming through the zip on 'workers' threads. Raises an exception describing every problem found.
+    """
+    workers = workers or os.cpu_count() or 1
+    expectedEntries = dict((archivePath, entry) for entry, archivePath in mappings)
+    errors = []
+    with zipfile.ZipFile(zipPath, 'r') as zf:
+        infos = zf.infolist()
+
+    nameCounts = collections.Counter(zinfo.filename for zinfo in infos)
+    zipNames = set(nameCounts)
+    for name in sorted(name for name, count in nameCounts.items() if count > 1):
+        errors.append(f"{name}: appears more than once in the zip")
+    for name in sorted(set(expectedEntries) - zipNames):
+        errors.append(f"{name}: missing from the zip")
+    for name in sorted(zipNames - set(expectedEntries)):
+        errors.append(f"{name}: in the zip, but not part of the build")
+
+    fileNames = []
+    for zinfo in infos:
+        entry = expectedEntries.get(zinfo.filename)
+        if entry is None or zinfo.is_dir():
+            continue
+        if zinfo.file_size != entry.size:
+            errors.append(f"{zinfo.filename}: is {zinfo.file_size} bytes in the zip, but {entry.size} bytes on disk")
+        if names is None or zinfo.filename in names:
+            fileNames.append(zinfo.filename)
+
+    # Split the entries into one group per thread, so each thread streams through its own handle to the zip
+    groups = [fileNames[i::workers] for i in range(workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for groupErrors in executor.map(lambda group: verifyZipEntries(zipPath, group), groups):
+            errors.extend(groupErrors)
+
+    if errors:
+        raise Exception(f"ERROR: Verification of {zipPath} failed with {len(errors)} problems:\n" + '\n'.join(f' - {error}' for error in errors))
+
+    print(f"Verified {len(fileNames)} files in {zipPath}")
+
+
+def getVolumePath(archivePath, volumeNumber, volumeCount):
+    """eg. 'output/Onikakushi.Voice.and.Graphics.Patch.zip' -> 'output/Onikakushi.Voice.and.Graphics.Patch.vol01.zip'"""
+    base, extension = os.path.splitext(archivePath)
+    return f'{base}.vol{volumeNumber:0{max(2, len(str(volumeCount)))}}{extension}'
+
+
+def getVolumeIndexPath(archivePath):
+    return os.path.splitext(archivePath)[0] + '.volumes.json'
+
+
+def getFolderArchivePaths(archivePath):
+    """eg. 'a/b/c.txt' -> ['a/', 'a/b/']"""
+    parts = archivePath.rstrip('/').split('/')[:-1]
+    return ['/'.join(parts[:i]) + '/' for i in range(1, len(parts) + 1)]
+
+
+def splitIntoVolumes(mappings, maxVolumeBytes):
+    """
+    Split (FileEntry, archivePath) mappings into volumes containing at most maxVolumeBytes of files (before
+    compression). Files are assigned in archive path order, so the files of a folder stay together, and a file larger
+    than maxVolumeBytes gets a volume of its own. Each volume also gets the entries of its files' folders, so that it
+    can be extracted on its own. Empty folders are put in the first volume.
+    """
+    folderMappings = dict((archivePath, (entry, archivePath)) for entry, archivePath in mappings if archivePath.endswith('/'))
+    fileMappings = sorted((mapping for mapping in mappings if not mapping[1].endswith('/')), key=lambda mapping: mapping[1])
+
+    volumeFiles = [[]]
+    volumeSize = 0
+    for entry, archivePath in fileMappings:
+        if volumeFiles[-1] and volumeSize + entry.size > maxVolumeBytes:
+            volumeFiles.append([])
+            volumeSize = 0
+        volumeFiles[-1].append((entry, archivePath))
+        volumeSize += entry.size
+
+    volumeFolders = []
+    for files in volumeFiles:
+        volumeFolders.append(set(folder for _, archivePath in files for folder in getFolderArchivePaths(archivePath) if folder in folderMappings))
+
+    usedFolders = set().union(*volumeFolders)
+    for folder in set(folderMappings) - usedFolders:
+        volumeFolders[0].add(folder)
+        volumeFolders[0].update(parent for parent in getFolderArchivePaths(folder) if parent in folderMappings)
+
+    return [[folderMappings[folder] for folder in sorted(folders)] + files for folders, files in zip(volumeFolders, volumeFiles)]
+
+
+def writeVolumeIndex(archivePath, maxVolumeBytes, volumePaths, volumes):
+    """
+    Write the index of a multi-volume release, which lists each volume and maps each file to the volume containing it,
+    so that installers can download the volumes in parallel, or only the volumes containing the files they need.
+    """
+    indexPath = getVolumeIndexPath(archivePath)
+    files = {}
+    volumeInfos = []
+    for volumeNumber, (volumePath, mappings) in enumerate(zip(volumePaths, volumes), start=1):
+        volumeInfos.append({
+            'name': os.path.basename(volumePath),
+            'manifest': os.path.basename(getManifestPath(volumePath)),
+            'size': os.path.getsize(volumePath),
+            'files': sum(1 for _, archivePath in mappings if not archivePath.endswith('/')),
+        })
+        for _, archivePath in mappings:
+            if not archivePath.endswith('/'):
+                files[archivePath] = volumeNumber
+
+    tempIndexPath = indexPath + '.part'
+    with open(tempIndexPath, 'w') as f:
+        json.dump({
+            'archive': os.path.basename(archivePath),
+            'volumeSize': maxVolumeBytes,
+            'volumes': volumeInfos,
+            'files': files,
+        }, f, indent=1)
+    os.replace(tempIndexPath, indexPath)
+    return indexPath
+
+
+def readVolumeIndex(indexPath):
+    try:
+        with open(indexPath, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def getVolumeIndexFiles(indexPath):
+    """Returns the paths of the volumes and their manifests listed in a volume index, or [] if it can't be read"""
+    index = readVolumeIndex(indexPath)
+    if index is None:
+        return []
+    folder = os.path.dirname(indexPath)
+    return [os.path.join(folder, volume[key]) for volume in index['volumes'] for key in ('name', 'manifest')]
+
+
+def getBaselineZipPaths(baselinePath):
+    """
+    The zips to copy unchanged files from, for a baseline which is a zip or the index of a multi-volume release.
+    If a baseline zip doesn't exist, the volumes listed by the index next to it are used, as the previous release may
+    have been split into volumes. Returns [] if there are none.
+    """
+    indexPath = baselinePath if baselinePath.endswith('.volumes.json') else getVolumeIndexPath(baselinePath)
+    if baselinePath == indexPath or not os.path.exists(baselinePath):
+        index = readVolumeIndex(indexPath)
+        if index is None:
+            return []
+        volumePaths = [os.path.join(os.path.dirname(indexPath), volume['name']) for volume in index['volumes']]
+        return [path for path in volumePaths if os.path.exists(path)]
+    return [baselinePath]
+
+
+def writeZipVolumes(mappings, archivePath, maxVolumeBytes, workers=None, baselinePaths=(), policy: Optional[CompressionPolicy] = None, chunkSize=ZIP_CHUNK_SIZE):
+    """
+    Write the mappings as a multi-volume release: several independent zips of at most about maxVolumeBytes each
+    (see splitIntoVolumes()), and an index mapping each file to its volume (see writeVolumeIndex()).
+    The volumes are written at the same time, sharing the 'workers' threads between them. Each volume copies unchanged
+    files from the baseline zips containing any of its files. The baselines may be the previous volumes, so the new
+    volumes only replace them once they have all been written. Returns the path of the index.
+    """
+    workers = workers or os.cpu_count() or 1
+    volumes = splitIntoVolumes(mappings, maxVolumeBytes)
+    volumePaths = [getVolumePath(archivePath, volumeNumber, len(volumes)) for volumeNumber in range(1, len(volumes) + 1)]
+    concurrentVolumes = min(len(volumes), workers)
+    workersPerVolume = max(1, workers // concurrentVolumes)
+    print(f"Writing {len(volumes)} volumes of up to {maxVolumeBytes} bytes, {concurrentVolumes} at a time")
+
+    baselineNames = []
+    for baselinePath in baselinePaths:
+        with zipfile.ZipFile(baselinePath, 'r') as zf:
+            baselineNames.append((baselinePath, set(zf.namelist())))
+
+    def getVolumeBaselinePaths(volumeMappings):
+        archivePaths = set(archivePath for _, archivePath in volumeMappings if not archivePath.endswith('/'))
+        return [baselinePath for baselinePath, names in baselineNames if not archivePaths.isdisjoint(names)]
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrentVolumes) as executor:
+            futures = [
+                executor.submit(writeZipPart, volumeMappings, volumePath, workersPerVolume, getVolumeBaselinePaths(volumeMappings), policy, chunkSize)
+                for volumeMappings, volumePath in zip(volumes, volumePaths)
+            ]
+            volumeManifests = [future.result() for future in futures]
+    except BaseException:
+        for volumePath in volumePaths:
+            tryRemoveTree(volumePath + '.part')
+        raise
+
+    for volumeMappings, volumePath, manifestEntries in zip(volumes, volumePaths, volumeManifests):
+        replaceZipPart(volumePath, volumeMappings, manifestEntries)
+
+    indexPath = writeVolumeIndex(archivePath, maxVolumeBytes, volumePaths, volumes)
+    Globals.METRICS.annotate(volumes=len(volumes))
+    return indexPath
+
+
+def verifyZipVolumes(indexPath, mappings, workers=None):
+    """
+    Check a multi-volume release: the index must assign every file of the build to the volume it should be in, and each
+    volume is checked with verifyZipArchive(). Raises an exception describing every problem found.
+    """
+    index = readVolumeIndex(indexPath)
+    if index is None:
+        raise Exception(f"ERROR: Verification of {indexPath} failed: the volume index is missing or can't be read")
+
+    # The volumes are split deterministically, so splitting the build's files again gives the expected contents
+    volumes = splitIntoVolumes(mappings, index['volumeSize'])
+    expectedFiles = dict((archivePath, volumeNumber) for volumeNumber, volumeMappings in enumerate(volumes, start=1)
+                         for _, archivePath in volumeMappings if not archivePath.endswith('/'))
+    errors = []
+    if len(index['volumes']) != len(volumes):
+        errors.append(f"the index lists {len(index['volumes'])} volumes, but the build has {len(volumes)} volumes")
+    for archivePath in sorted(set(expectedFiles) | set(index['files'])):
+        if index['files'].get(archivePath) != expectedFiles.get(archivePath):
+            errors.append(f"{archivePath}: the index says it is in volume {index['files'].get(archivePath)}, but it should be in volume {expectedFiles.get(archivePath)}")
+
+    if not errors:
+        folder = os.path.dirname(indexPath)
+        for volume, volumeMappings in zip(index['volumes'], volumes):
+            try:
+                verifyZipArchive(os.path.join(folder, volume['name']), volumeMappings, workers)
+            except Exception as e:
+                errors.append(str(e))
+
+    if errors:
+        raise Exception(f"ERROR: Verification of {indexPath} failed with {len(errors)} problems:\n" + '\n'.join(f' - {error}' for error in errors))
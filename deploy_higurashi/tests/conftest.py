@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The deploy modules are imported from the folder above, like deploy_higurashi.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deploy_common import BuildMetrics, Globals
+
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    """The modules record their work in Globals.METRICS, which the deploy scripts set up in main()"""
+    monkeypatch.setattr(Globals, 'METRICS', BuildMetrics())
+    return Globals.METRICS
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from deploy_chapter import matchScriptOutputs, ScriptCompileCache
+
+
+@pytest.fixture
+def compilerFolder(tmp_path):
+    folder = tmp_path / 'ScriptCompiler'
+    folder.mkdir()
+    (folder / 'HigurashiScriptCompiler.exe').write_bytes(b'compiler')
+    return folder
+
+
+def test_match_script_outputs_by_full_name():
+    scripts = ['foo.txt', 'foo.bar.txt', 'sub/Foo.txt']
+    outputs = ['foo.mg', 'foo.bar.mg', 'sub/Foo.mg', 'sub/foo.mg', 'other.mg']
+
+    assert matchScriptOutputs(scripts, outputs) == {
+        'foo.txt': ['foo.mg'],
+        'foo.bar.txt': ['foo.bar.mg'],
+        # No script matches 'sub/foo' exactly, and ignoring case it only matches one
+        'sub/Foo.txt': ['sub/Foo.mg', 'sub/foo.mg'],
+    }
+
+
+def test_match_script_outputs_rejects_ambiguous_case():
+    with pytest.raises(Exception, match='onik_001.mg'):
+        matchScriptOutputs(['Onik_001.txt', 'ONIK_001.txt'], ['onik_001.mg'])
+
+
+def test_compile_cache_ignores_empty_entries(tmp_path, compilerFolder):
+    cache = ScriptCompileCache(str(tmp_path / 'cache'), str(compilerFolder), maxSizeBytes=1024 * 1024)
+    (tmp_path / 'Update').mkdir()
+    (tmp_path / 'Update' / 'onik_001.txt').write_bytes(b'script')
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'out' / 'onik_001.mg').write_bytes(b'compiled')
+    key = cache.scriptKey(str(tmp_path / 'Update'), 'onik_001.txt')
+
+    # An entry without outputs, as stored by older versions
+    os.makedirs(cache._entryPath(key))
+    assert not cache.contains(key)
+    assert cache.restore(key, str(tmp_path / 'restored')) is None
+
+    os.rmdir(cache._entryPath(key))
+    cache.store(key, str(tmp_path / 'out'), ['onik_001.mg'])
+    assert cache.restore(key, str(tmp_path / 'restored')) == ['onik_001.mg']
+    assert (tmp_path / 'restored' / 'onik_001.mg').read_bytes() == b'compiled'
+
+
+def test_compile_cache_evicts_least_recently_used(tmp_path, compilerFolder):
+    cache = ScriptCompileCache(str(tmp_path / 'cache'), str(compilerFolder), maxSizeBytes=2500)
+    (tmp_path / 'Update').mkdir()
+    (tmp_path / 'out').mkdir()
+    keys = {}
+    for i, name in enumerate(['a', 'b', 'c']):
+        (tmp_path / 'Update' / f'{name}.txt').write_bytes(name.encode())
+        (tmp_path / 'out' / f'{name}.mg').write_bytes(bytes(1000))
+        keys[name] = cache.scriptKey(str(tmp_path / 'Update'), f'{name}.txt')
+        cache.store(keys[name], str(tmp_path / 'out'), [f'{name}.mg'])
+        os.utime(cache._entryPath(keys[name]), (i, i))
+    # Using a again makes b the least recently used
+    cache.restore(keys['a'], str(tmp_path / 'restored'))
+
+    cache.evict()
+
+    assert [cache.contains(keys[name]) for name in ['a', 'b', 'c']] == [True, False, True]
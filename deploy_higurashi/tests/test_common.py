@@ -0,0 +1,38 @@
+import os
+import sys
+import threading
+
+import pytest
+
+from deploy_common import call
+
+BUSY_SCRIPT = 'import time\nend = time.process_time() + 0.5\nwhile time.process_time() < end: pass'
+IDLE_SCRIPT = 'import time\ntime.sleep(1)'
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason='the CPU time of subprocesses is only measured on Unix')
+def test_subprocess_cpu_time_is_recorded_per_stage(metrics):
+    # The idle stage's subprocess runs while the busy stage's does, and must not be charged for its CPU time
+    def runStage(name, script):
+        with metrics.stage(name):
+            call([sys.executable, '-c', script])
+
+    threads = [threading.Thread(target=runStage, args=('busy', BUSY_SCRIPT)), threading.Thread(target=runStage, args=('idle', IDLE_SCRIPT))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stages = dict((stage['name'], stage) for stage in metrics.toDict()['stages'])
+    assert stages['busy']['childCpuSeconds'] >= 0.5
+    assert stages['idle']['childCpuSeconds'] < 0.25
+    assert stages['busy']['subprocesses'][0]['cpuSeconds'] == stages['busy']['childCpuSeconds']
+    assert metrics.toDict()['totalCpuSeconds'] >= stages['busy']['childCpuSeconds'] + stages['idle']['childCpuSeconds']
+
+
+def test_call_raises_on_failure(metrics):
+    with metrics.stage('failing'):
+        with pytest.raises(Exception, match='retcode 3'):
+            call([sys.executable, '-c', 'import sys; sys.exit(3)'])
+
+    assert metrics.stages[0]['subprocesses'][0]['retcode'] == 3
@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import deploy_download
+from benchmark_deploy import LocalDownloadServer, QuietRequestHandler
+from deploy_common import Globals
+from deploy_download import DownloadCache, Downloader
+
+
+class TruncatingWriter:
+    """Passes the first 'limit' bytes through to wfile, and drops the rest, like a connection which was cut"""
+    def __init__(self, wfile, limit):
+        self.wfile = wfile
+        self.remaining = limit
+
+    def write(self, data):
+        data = data[:max(0, self.remaining)]
+        self.remaining -= len(data)
+        return self.wfile.write(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    @property
+    def closed(self):
+        return self.wfile.closed
+
+
+class RecordingRequestHandler(QuietRequestHandler):
+    """
+    Records each request as (method, headers), sends an ETag (answering If-None-Match with 304), and cuts the body
+    of the first 'dropCount' GET responses short after 'dropAfterBytes' bytes.
+    """
+    requests = []
+    dropCount = 0
+    dropAfterBytes = 0
+
+    def etag(self):
+        with open(self.translate_path(self.path), 'rb') as f:
+            return '"' + hashlib.sha256(f.read()).hexdigest()[:16] + '"'
+
+    def end_headers(self):
+        if os.path.isfile(self.translate_path(self.path)):
+            self.send_header('ETag', self.etag())
+        super().end_headers()
+        if self.command == 'GET' and type(self).dropCount > 0:
+            type(self).dropCount -= 1
+            self.wfile = TruncatingWriter(self.wfile, type(self).dropAfterBytes)
+            self.close_connection = True
+
+    def notModified(self):
+        if os.path.isfile(self.translate_path(self.path)) and self.headers.get('If-None-Match') == self.etag():
+            self.send_response(304)
+            self.end_headers()
+            return True
+        return False
+
+    def do_HEAD(self):
+        type(self).requests.append(('HEAD', dict(self.headers)))
+        if not self.notModified():
+            super().do_HEAD()
+
+    def do_GET(self):
+        type(self).requests.append(('GET', dict(self.headers)))
+        if not self.notModified():
+            super().do_GET()
+
+
+@pytest.fixture
+def serveFolder(tmp_path):
+    folder = tmp_path / 'serve'
+    folder.mkdir()
+    return folder
+
+
+@pytest.fixture
+def handler():
+    """A RecordingRequestHandler subclass of its own, so each test starts with no requests"""
+    return type('TestRequestHandler', (RecordingRequestHandler,), {'requests': []})
+
+
+@pytest.fixture
+def server(serveFolder, handler):
+    with LocalDownloadServer(str(serveFolder), handler) as server:
+        yield server
+
+
+@pytest.fixture
+def downloader(monkeypatch):
+    downloader = Downloader(connections=4, minSegmentSize=1024, timeout=10, retries=3, backoffSeconds=0.01)
+    monkeypatch.setattr(Globals, 'DOWNLOADER', downloader)
+    return downloader
+
+
+@pytest.fixture
+def cache(tmp_path, downloader):
+    return DownloadCache(str(tmp_path / 'cache'), maxSizeBytes=1024 * 1024)
+
+
+def writeServedFile(serveFolder, name, size, seed=0):
+    data = bytes((i * 31 + seed * 7 + i // 251) % 256 for i in range(size))
+    (serveFolder / name).write_bytes(data)
+    return data
+
+
+def requestsOf(handler, method):
+    return [headers for requestMethod, headers in handler.requests if requestMethod == method]
+
+
+def test_cache_revalidates_with_etag(tmp_path, serveFolder, server, handler, cache):
+    data = writeServedFile(serveFolder, 'file.bin', 1000)
+    outputPath = str(tmp_path / 'file.bin')
+
+    cache.fetch(f'{server.url}/file.bin', outputPath)
+    cache.fetch(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    heads = requestsOf(handler, 'HEAD')
+    assert len(heads) == 2
+    assert 'If-None-Match' not in heads[0]
+    assert heads[1]['If-None-Match'] == '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+    # The second fetch was answered with 304, so the file was only downloaded once
+    assert len(requestsOf(handler, 'GET')) == 1
+
+
+def test_cache_revalidates_with_last_modified(tmp_path, serveFolder, downloader, cache):
+    data = writeServedFile(serveFolder, 'file.bin', 1000)
+    outputPath = str(tmp_path / 'file.bin')
+    gets = []
+
+    class LastModifiedRequestHandler(QuietRequestHandler):
+        """Only sends Last-Modified, which SimpleHTTPRequestHandler checks against If-Modified-Since"""
+        def do_GET(self):
+            gets.append(dict(self.headers))
+            super().do_GET()
+
+    with LocalDownloadServer(str(serveFolder), LastModifiedRequestHandler) as server:
+        cache.fetch(f'{server.url}/file.bin', outputPath)
+        entry = cache._loadIndex()[f'{server.url}/file.bin']
+        assert entry['lastModified'] is not None and entry['etag'] is None
+        cache.fetch(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    assert len(gets) == 1
+
+
+def test_cache_downloads_changed_file_again(tmp_path, serveFolder, server, handler, cache):
+    writeServedFile(serveFolder, 'file.bin', 1000)
+    outputPath = str(tmp_path / 'file.bin')
+    cache.fetch(f'{server.url}/file.bin', outputPath)
+
+    data = writeServedFile(serveFolder, 'file.bin', 1000, seed=1)
+    cache.fetch(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    assert len(requestsOf(handler, 'GET')) == 2
+
+
+def test_download_rejects_hash_mismatch(tmp_path, serveFolder, server, downloader):
+    writeServedFile(serveFolder, 'file.bin', 3000)
+    outputPath = str(tmp_path / 'file.bin')
+
+    with pytest.raises(Exception, match='sha256'):
+        downloader.download(f'{server.url}/file.bin', outputPath, expectedSHA256='0' * 64)
+
+    assert not os.path.exists(outputPath)
+    assert not os.path.exists(outputPath + '.part')
+
+
+def test_cache_rejects_hash_mismatch(tmp_path, serveFolder, server, cache):
+    writeServedFile(serveFolder, 'file.bin', 3000)
+    outputPath = str(tmp_path / 'file.bin')
+
+    with pytest.raises(Exception, match='sha256'):
+        cache.fetch(f'{server.url}/file.bin', outputPath, expectedSHA256='0' * 64)
+
+    assert not os.path.exists(outputPath)
+
+
+def test_cache_evicts_least_recently_used(tmp_path, serveFolder, server, downloader):
+    cache = DownloadCache(str(tmp_path / 'cache'), maxSizeBytes=2500)
+    for i, name in enumerate(['a.bin', 'b.bin', 'c.bin']):
+        writeServedFile(serveFolder, name, 1000, seed=i)
+    urls = dict((name, f'{server.url}/{name}') for name in ['a.bin', 'b.bin', 'c.bin'])
+
+    cache.fetch(urls['a.bin'], str(tmp_path / 'a.bin'))
+    cache.fetch(urls['b.bin'], str(tmp_path / 'b.bin'))
+    # Using a.bin again makes b.bin the least recently used
+    cache.fetch(urls['a.bin'], str(tmp_path / 'a.bin'))
+    cache.fetch(urls['c.bin'], str(tmp_path / 'c.bin'))
+
+    index = cache._loadIndex()
+    assert set(index) == {urls['a.bin'], urls['c.bin']}
+    blobs = [name for name in os.listdir(cache.blobDir) if '.part' not in name]
+    assert sorted(blobs) == sorted(entry['sha256'] for entry in index.values())
+    assert sum(os.path.getsize(os.path.join(cache.blobDir, name)) for name in blobs) <= 2500
+
+
+def test_download_splits_into_ranges(tmp_path, serveFolder, server, handler, downloader):
+    data = writeServedFile(serveFolder, 'file.bin', 10000)
+    outputPath = str(tmp_path / 'file.bin')
+
+    result = downloader.download(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    assert result['sha256'] == hashlib.sha256(data).hexdigest()
+    ranges = sorted(headers['Range'] for headers in requestsOf(handler, 'GET'))
+    assert ranges == ['bytes=0-2499', 'bytes=2500-4999', 'bytes=5000-7499', 'bytes=7500-9999']
+    assert not os.path.exists(outputPath + '.part.state')
+
+
+def test_download_resumes_from_part_file(tmp_path, serveFolder, server, handler, downloader):
+    data = writeServedFile(serveFolder, 'file.bin', 10000)
+    outputPath = str(tmp_path / 'file.bin')
+    partPath = outputPath + '.part'
+
+    # An interrupted download, which finished the first and last segments
+    info = downloader._probe(f'{server.url}/file.bin', {})
+    with open(partPath, 'wb') as f:
+        f.write(data[:2500] + bytes(5000) + data[7500:])
+    with open(partPath + '.state', 'w') as f:
+        json.dump({'size': info['size'], 'etag': info['etag'], 'lastModified': info['lastModified'], 'completedSegments': [[0, 2499], [7500, 9999]]}, f)
+    handler.requests.clear()
+
+    downloader.download(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    ranges = sorted(headers['Range'] for headers in requestsOf(handler, 'GET'))
+    assert ranges == ['bytes=2500-4999', 'bytes=5000-7499']
+    assert not os.path.exists(partPath) and not os.path.exists(partPath + '.state')
+
+
+def test_download_ignores_state_of_changed_file(tmp_path, serveFolder, server, handler, downloader):
+    data = writeServedFile(serveFolder, 'file.bin', 10000)
+    outputPath = str(tmp_path / 'file.bin')
+    partPath = outputPath + '.part'
+    with open(partPath, 'wb') as f:
+        f.write(bytes(10000))
+    with open(partPath + '.state', 'w') as f:
+        json.dump({'size': 10000, 'etag': '"old"', 'lastModified': None, 'completedSegments': [[0, 2499]]}, f)
+
+    downloader.download(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    assert len(requestsOf(handler, 'GET')) == 4
+
+
+def test_download_retries_dropped_connection(tmp_path, serveFolder, server, handler, downloader, monkeypatch):
+    data = writeServedFile(serveFolder, 'file.bin', 3000)
+    outputPath = str(tmp_path / 'file.bin')
+    delays = []
+    monkeypatch.setattr(deploy_download.time, 'sleep', delays.append)
+    handler.dropCount = 2
+    handler.dropAfterBytes = 1000
+    downloader.connections = 1
+    downloader.minSegmentSize = 4096
+
+    downloader.download(f'{server.url}/file.bin', outputPath)
+
+    with open(outputPath, 'rb') as f:
+        assert f.read() == data
+    # Each retry continues from the last byte received, after an exponential backoff
+    ranges = [headers['Range'] for headers in requestsOf(handler, 'GET')]
+    assert ranges == ['bytes=0-2999', 'bytes=1000-2999', 'bytes=2000-2999']
+    assert delays == [downloader.backoffSeconds, downloader.backoffSeconds * 2]
+
+
+def test_download_gives_up_after_retries(tmp_path, serveFolder, server, handler, downloader, monkeypatch):
+    writeServedFile(serveFolder, 'file.bin', 3000)
+    outputPath = str(tmp_path / 'file.bin')
+    monkeypatch.setattr(deploy_download.time, 'sleep', lambda seconds: None)
+    handler.dropCount = downloader.retries + 1
+    handler.dropAfterBytes = 0
+    downloader.connections = 1
+    downloader.minSegmentSize = 4096
+
+    with pytest.raises(Exception):
+        downloader.download(f'{server.url}/file.bin', outputPath)
+
+    assert not os.path.exists(outputPath)
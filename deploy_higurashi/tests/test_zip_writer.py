@@ -0,0 +1,261 @@
+import json
+import os
+import random
+import struct
+import zipfile
+import zlib
+
+import pytest
+
+from deploy_common import CompressionPolicy, getManifestPath, Globals, sha256File
+from deploy_workspace import FileIndex
+from deploy_zip import CompressedBlobStore, getZipEntryDataOffset, updateZipArchive, verifyZipArchive, writeZipArchive
+
+# Small chunks, so that the larger test files are compressed in several chunks
+CHUNK_SIZE = 4096
+
+
+@pytest.fixture(autouse=True)
+def noBlobStore(monkeypatch):
+    monkeypatch.setattr(Globals, 'BLOB_STORE', None)
+
+
+@pytest.fixture
+def patchFolder(tmp_path):
+    """A folder like a chapter's patch: scripts, a large text file, incompressible media, an empty file and folder"""
+    folder = tmp_path / 'patch'
+    rng = random.Random(0)
+    files = {
+        'Update/onik_000.txt': b''.join(b'OutputLine(NULL, "line %d", NULL, "line %d", Line_Normal);\n' % (i, i) for i in range(200)),
+        'Update/sub/onik_001.txt': b'PlaySE(4, "wa_038", 128, 64);\n' * 50,
+        'Managed/Assembly-CSharp.dll': bytes(rng.getrandbits(8) // 16 for _ in range(CHUNK_SIZE * 3 + 123)),
+        'SE/sound.ogg': bytes(rng.getrandbits(8) for _ in range(CHUNK_SIZE * 2 + 1)),
+        'CG/image.png': bytes(rng.getrandbits(8) for _ in range(1000)),
+        'empty.json': b'',
+    }
+    for relPath, data in files.items():
+        path = folder / relPath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (folder / 'EmptyFolder').mkdir()
+    return folder
+
+
+def getMappings(folder):
+    return FileIndex(str(folder)).toMappings('HigurashiEp01_Data')
+
+
+def assertZipMatches(zipPath, mappings):
+    """The zip passes testzip(), and contains exactly the mapped files and folders with the same contents"""
+    with zipfile.ZipFile(zipPath, 'r') as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(archivePath for _, archivePath in mappings)
+        for entry, archivePath in mappings:
+            if entry.isDir:
+                assert zf.getinfo(archivePath).is_dir()
+            else:
+                with open(entry.path, 'rb') as f:
+                    assert zf.read(archivePath) == f.read(), archivePath
+
+    with open(getManifestPath(zipPath), 'r') as f:
+        manifestEntries = dict((entry['path'], entry) for entry in json.load(f)['entries'])
+    for entry, archivePath in mappings:
+        if not entry.isDir:
+            assert manifestEntries[archivePath]['sha256'] == sha256File(entry.path), archivePath
+
+
+def readRawEntries(zipPath):
+    """Returns archivePath -> the compressed bytes of each entry"""
+    with zipfile.ZipFile(zipPath, 'r') as zf, open(zipPath, 'rb') as f:
+        rawEntries = {}
+        for zinfo in zf.infolist():
+            f.seek(getZipEntryDataOffset(zf, zinfo))
+            rawEntries[zinfo.filename] = f.read(zinfo.compress_size)
+        return rawEntries
+
+
+@pytest.mark.parametrize('policy', [CompressionPolicy.uniform(), CompressionPolicy(), CompressionPolicy.uniform(CompressionPolicy.STORE)], ids=['uniform', 'policy', 'store'])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_zip_round_trip(tmp_path, patchFolder, policy, workers):
+    mappings = getMappings(patchFolder)
+    zipPath = str(tmp_path / 'patch.zip')
+
+    writeZipArchive(mappings, zipPath, workers, policy=policy, chunkSize=CHUNK_SIZE)
+
+    assertZipMatches(zipPath, mappings)
+    verifyZipArchive(zipPath, mappings, workers)
+    assert not os.path.exists(zipPath + '.part')
+
+
+def test_zip_stores_media_with_policy(tmp_path, patchFolder):
+    mappings = getMappings(patchFolder)
+    zipPath = str(tmp_path / 'patch.zip')
+
+    writeZipArchive(mappings, zipPath, 2, policy=CompressionPolicy(), chunkSize=CHUNK_SIZE)
+
+    with zipfile.ZipFile(zipPath, 'r') as zf:
+        assert zf.getinfo('HigurashiEp01_Data/SE/sound.ogg').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('HigurashiEp01_Data/CG/image.png').compress_type == zipfile.ZIP_STORED
+        scriptInfo = zf.getinfo('HigurashiEp01_Data/Update/onik_000.txt')
+        assert scriptInfo.compress_type == zipfile.ZIP_DEFLATED and scriptInfo.compress_size < scriptInfo.file_size
+
+
+def test_zip_round_trip_with_blob_store(tmp_path, patchFolder, monkeypatch):
+    monkeypatch.setattr(Globals, 'BLOB_STORE', CompressedBlobStore(str(tmp_path / 'blobs'), 1024 * 1024 * 1024))
+    mappings = getMappings(patchFolder)
+
+    # The second zip is written from the blobs stored by the first
+    for name in ['first.zip', 'second.zip']:
+        writeZipArchive(mappings, str(tmp_path / name), 2, chunkSize=CHUNK_SIZE)
+        assertZipMatches(str(tmp_path / name), mappings)
+    assert readRawEntries(str(tmp_path / 'first.zip')) == readRawEntries(str(tmp_path / 'second.zip'))
+
+
+def test_zip_reuses_baseline_entries(tmp_path, patchFolder, capsys):
+    baselinePath = str(tmp_path / 'baseline.zip')
+    writeZipArchive(getMappings(patchFolder), baselinePath, 2, chunkSize=CHUNK_SIZE)
+    baselineEntries = readRawEntries(baselinePath)
+
+    # Change a script (keeping its size, so only its hash tells it apart), and add a file
+    scriptPath = patchFolder / 'Update' / 'onik_000.txt'
+    data = scriptPath.read_bytes()
+    scriptPath.write_bytes(data[:-2] + b'X\n')
+    (patchFolder / 'Update' / 'onik_002.txt').write_bytes(b'new script\n')
+    mappings = getMappings(patchFolder)
+    zipPath = str(tmp_path / 'patch.zip')
+    capsys.readouterr()
+
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], chunkSize=CHUNK_SIZE)
+
+    assertZipMatches(zipPath, mappings)
+    verifyZipArchive(zipPath, mappings, 2)
+    entries = readRawEntries(zipPath)
+    changedPaths = {'HigurashiEp01_Data/Update/onik_000.txt', 'HigurashiEp01_Data/Update/onik_002.txt'}
+    reusedPaths = [entry for entry, archivePath in mappings if not entry.isDir and archivePath not in changedPaths]
+    for _, archivePath in mappings:
+        if archivePath not in changedPaths:
+            assert entries[archivePath] == baselineEntries[archivePath], archivePath
+    assert entries['HigurashiEp01_Data/Update/onik_000.txt'] != baselineEntries['HigurashiEp01_Data/Update/onik_000.txt']
+    assert f"Reused {len(reusedPaths)} unchanged entries" in capsys.readouterr().out
+
+
+def test_zip_reuses_only_entries_compressed_as_policy_picks(tmp_path, patchFolder, capsys):
+    baselinePath = str(tmp_path / 'baseline.zip')
+    writeZipArchive(getMappings(patchFolder), baselinePath, 2, policy=CompressionPolicy.uniform(), chunkSize=CHUNK_SIZE)
+    mappings = getMappings(patchFolder)
+    zipPath = str(tmp_path / 'patch.zip')
+    capsys.readouterr()
+
+    # The policy stores media, which the baseline deflated, and keeps the same level for everything else
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], policy=CompressionPolicy.forProfile('policy', zlib.Z_DEFAULT_COMPRESSION), chunkSize=CHUNK_SIZE)
+
+    assertZipMatches(zipPath, mappings)
+    with zipfile.ZipFile(zipPath, 'r') as zf:
+        assert zf.getinfo('HigurashiEp01_Data/SE/sound.ogg').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('HigurashiEp01_Data/CG/image.png').compress_type == zipfile.ZIP_STORED
+    fileCount = sum(1 for entry, _ in mappings if not entry.isDir)
+    assert f"Reused {fileCount - 2} unchanged entries" in capsys.readouterr().out
+
+    # A different level reuses nothing
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], policy=CompressionPolicy.uniform(9), chunkSize=CHUNK_SIZE)
+    assert "Reused 0 unchanged entries" in capsys.readouterr().out
+
+
+def test_zip_reuses_entries_by_manifest_hash(tmp_path, patchFolder, capsys):
+    baselinePath = str(tmp_path / 'baseline.zip')
+    mappings = getMappings(patchFolder)
+    writeZipArchive(mappings, baselinePath, 2, chunkSize=CHUNK_SIZE)
+    fileCount = sum(1 for entry, _ in mappings if not entry.isDir)
+
+    # Entries are matched by the SHA-256 in the baseline's manifest, not by their size and CRC
+    with open(getManifestPath(baselinePath), 'r') as f:
+        manifest = json.load(f)
+    manifest['entries'][0]['sha256'] = '0' * 64
+    with open(getManifestPath(baselinePath), 'w') as f:
+        json.dump(manifest, f)
+    zipPath = str(tmp_path / 'patch.zip')
+    capsys.readouterr()
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], chunkSize=CHUNK_SIZE)
+    assertZipMatches(zipPath, mappings)
+    assert f"Reused {fileCount - 1} unchanged entries" in capsys.readouterr().out
+
+    # Without a manifest, nothing can be reused
+    os.remove(getManifestPath(baselinePath))
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], chunkSize=CHUNK_SIZE)
+    assertZipMatches(zipPath, mappings)
+    assert "Reused 0 unchanged entries" in capsys.readouterr().out
+
+
+def test_zip_update_in_place(tmp_path, patchFolder):
+    zipPath = str(tmp_path / 'patch.zip')
+    mappings = getMappings(patchFolder)
+    writeZipArchive(mappings, zipPath, 2, chunkSize=CHUNK_SIZE)
+
+    (patchFolder / 'Update' / 'sub' / 'onik_001.txt').write_bytes(b'changed\n')
+    (patchFolder / 'CG' / 'image.png').unlink()
+    newMappings = getMappings(patchFolder)
+    changed = [(entry, archivePath) for entry, archivePath in newMappings if archivePath == 'HigurashiEp01_Data/Update/sub/onik_001.txt']
+
+    deadBytes = updateZipArchive(zipPath, changed, ['HigurashiEp01_Data/CG/image.png'], 2, chunkSize=CHUNK_SIZE)
+
+    assert deadBytes > 1000
+    assertZipMatches(zipPath, newMappings)
+    verifyZipArchive(zipPath, newMappings, 2)
+
+
+def test_zip_update_failure_keeps_zip(tmp_path, patchFolder):
+    zipPath = str(tmp_path / 'patch.zip')
+    mappings = getMappings(patchFolder)
+    writeZipArchive(mappings, zipPath, 2, chunkSize=CHUNK_SIZE)
+    with open(zipPath, 'rb') as f:
+        data = f.read()
+
+    # The file is removed after it was indexed, so the update fails while writing it
+    changed = [(entry, archivePath) for entry, archivePath in mappings if archivePath == 'HigurashiEp01_Data/Update/sub/onik_001.txt']
+    (patchFolder / 'Update' / 'sub' / 'onik_001.txt').unlink()
+    with pytest.raises(FileNotFoundError):
+        updateZipArchive(zipPath, changed, [], 2, chunkSize=CHUNK_SIZE)
+
+    with open(zipPath, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(zipPath + '.part')
+
+
+def test_zip64(tmp_path, patchFolder, monkeypatch, capsys):
+    # With a small limit, the larger entries, their offsets and the central directory need the ZIP64 extensions
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 2000)
+    monkeypatch.setattr(zipfile, 'ZIP_FILECOUNT_LIMIT', 4)
+    baselinePath = str(tmp_path / 'baseline.zip')
+    zipPath = str(tmp_path / 'patch.zip')
+    mappings = getMappings(patchFolder)
+
+    writeZipArchive(mappings, baselinePath, 2, policy=CompressionPolicy(), chunkSize=CHUNK_SIZE)
+    # Every entry is copied from the baseline, then one is replaced in place
+    writeZipArchive(mappings, zipPath, 2, baselinePaths=[baselinePath], policy=CompressionPolicy(), chunkSize=CHUNK_SIZE)
+    assert "Reused 6 unchanged entries" in capsys.readouterr().out
+    (patchFolder / 'SE' / 'sound.ogg').write_bytes(bytes(range(256)) * 20)
+    changed = [(entry, archivePath) for entry, archivePath in getMappings(patchFolder) if archivePath == 'HigurashiEp01_Data/SE/sound.ogg']
+    updateZipArchive(zipPath, changed, [], 2, policy=CompressionPolicy(), chunkSize=CHUNK_SIZE)
+
+    for path in [baselinePath, zipPath]:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # The ZIP64 end of central directory record
+        assert b'PK\x06\x06' in data
+        with zipfile.ZipFile(path, 'r') as zf:
+            largeInfo = zf.getinfo('HigurashiEp01_Data/Managed/Assembly-CSharp.dll')
+            # The ZIP64 extra field, which holds the sizes and offsets which don't fit in 32 bits
+            assert struct.unpack('<H', largeInfo.extra[:2])[0] == 0x0001
+    mappings = getMappings(patchFolder)
+    assertZipMatches(zipPath, mappings)
+    verifyZipArchive(zipPath, mappings, 2)
+
+
+def test_zip_fails_without_zipfile_internals(tmp_path, patchFolder, monkeypatch):
+    monkeypatch.delattr(zipfile.ZipInfo, 'FileHeader')
+    zipPath = str(tmp_path / 'patch.zip')
+
+    with pytest.raises(Exception, match='zipfile.ZipInfo.FileHeader'):
+        writeZipArchive(getMappings(patchFolder), zipPath, 2, chunkSize=CHUNK_SIZE)
+
+    assert not os.path.exists(zipPath) and not os.path.exists(zipPath + '.part')
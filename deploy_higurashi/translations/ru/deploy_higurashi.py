@@ -1,247 +1,321 @@
 import os
 from pathlib import Path
-import stat
-import shutil
-import string
 import subprocess
 import sys
 import argparse
 import time
 import traceback
-import glob
-from sys import argv, exit, stdout
+import itertools
+import concurrent.futures
+import json
+import tempfile
+import importlib.util
 from typing import List
 
-class Globals:
-    SEVEN_ZIP_EXECUTABLE = None
-
-def findWorkingExecutablePath(executable_paths, flags):
-	#type: (List[str], List[str]) -> str
-	"""
-	Try to execute each path in executable_paths to see which one can be called and returns exit code 0
-	The 'flags' argument is any extra flags required to make the executable return 0 exit code
-	:param executable_paths: a list [] of possible executable paths (eg. "./7za", "7z")
-	:param flags: a list [] of any extra flags like "-h" required to make the executable have a 0 exit code
-	:return: the path of the valid executable, or None if no valid executables found
-	"""
-	with open(os.devnull, 'w') as os_devnull:
-		for path in executable_paths:
-			try:
-				if subprocess.call([path] + flags, stdout=os_devnull, stderr=os_devnull) == 0:
-					return path
-			except:
-				pass
-
-	return None
-
-def isWindows():
-    return sys.platform == "win32"
-
-def call(args, **kwargs):
-    print(f"running: {args} kwargs: {kwargs}")
-    retcode = subprocess.call(args, shell=isWindows(), **kwargs)  # use shell on windows
-    if retcode != 0:
-        # don't print args here to avoid leaking secrets
-        raise Exception(f"ERROR: The last call() failed with retcode {retcode}")
-
-def tryRemoveTree(path):
-    attempts = 5
-    for i in range(attempts):
-        try:
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
-            return
-
-        except FileNotFoundError:
-            return
-        except Exception:
-            print(f'Warning: Failed to remove "{path}" attempt {i}/{attempts}')
-            traceback.print_exc()
-
-        time.sleep(1)
-
-
-def sevenZipMakeArchive(input_path, output_filename):
-    tryRemoveTree(output_filename)
-    call([Globals.SEVEN_ZIP_EXECUTABLE, "a", "-md=512m", output_filename, input_path, ])
-
-
-def sevenZipExtract(input_path, outputDir=None, filter=None):
-    args = [Globals.SEVEN_ZIP_EXECUTABLE, "x", input_path, '-y']
-    if filter is not None:
-         args.append(filter)
-
-    if outputDir:
-        args.append('-o' + outputDir)
-
-    call(args)
-
-
-def download(url):
-    print(f"Starting download of URL: {url}")
-    call(['curl', '-OJLf', url])
-
-
-class ChapterInfo:
-    def __init__(self, name, episodeNumber, uiArchiveURL: str, baseName=None, dllFolderName=None):
-        self.name = name
-        self.episodeNumber = episodeNumber
-        self.dataFolderName = f'HigurashiEp{episodeNumber:02}_Data'
-        if uiArchiveURL:
-            self.uiArchiveURL = uiArchiveURL
-            self.uiArchiveName = uiArchiveURL.split('/')[-1]
-        else:
-            self.uiArchiveURL = None
-            self.uiArchiveName = None
-
-        self.baseName = baseName if baseName is not None else self.name
-        self.dllFolderName = dllFolderName if dllFolderName is not None else self.name
-
-# def compileScripts(chapter: ChapterInfo):
-#     """
-#     Compiles scripts for the given chapter.
-
-#     Expects:
-#         - HigurashiScriptCompiler.exe placed adjacent to this script (built from the current chapter's engine code)
-#         - Associated DLLs (Antlr3.Runtime.dll, System.Core.dll (might not be required, but include to be safe))
-#     """
-#     scriptCompilerPath = os.path.abspath(f'bin/ScriptCompiler/HigurashiScriptCompiler.exe')
-
-#     if not os.path.exists(scriptCompilerPath):
-#         raise Exception(f"Missing {scriptCompilerPath} - if running script manually, you must put it there yourself!")
-
-#     baseFolderName = f'{chapter.baseName}_base'
-
-#     print(f"\n\n>> Compiling [{chapter.name}] scripts...")
-
-#     # - Define the folder where the update scripts are stored, and where they will be compiled to
-#     compileSrcFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/Update')
-#     compileDestFolder = os.path.abspath(f'{baseFolderName}/{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts')
-#     os.makedirs(compileDestFolder, exist_ok=True)
-
-#     # - Copy the Update folder containing the scripts to be compiled to the base folder, so the game can find it
-#     shutil.copytree(f'Update', compileSrcFolder, dirs_exist_ok=True)
-
-#     # - Remove status file if it exists
-#     statusFilePath = f'higu_script_compile_status.txt'
-#     if os.path.exists(statusFilePath):
-#         os.remove(statusFilePath)
-
-#     # Make sure script compiler is executable
-#     st = os.stat(scriptCompilerPath)
-#     os.chmod(scriptCompilerPath, st.st_mode | stat.S_IEXEC)
-
-#     # - Run the game with 'quitaftercompile' as argument
-#     # Note: generated artifacts currently exclude the 'bin' folder
-#     call([scriptCompilerPath, compileSrcFolder, compileDestFolder])
-
-#     # - Check compile status file
-#     if not os.path.exists(statusFilePath):
-#         raise Exception("Script Compile Failed: Script compilation status file not found")
-
-#     with open(statusFilePath, "r") as f:
-#         status = f.read().strip()
-#         print(f'Game Script Compile Result: {status}')
-#         if not status.startswith("Compile OK"):
-#             raise Exception(f"Script Compile Failed: Script compilation status indicated status {status}")
-
-#     os.remove(statusFilePath)
-
-#     # - Copy the CompiledUpdateScripts folder to the expected final build dir
-#     shutil.copytree(compileDestFolder, f'temp/{chapter.dataFolderName}/StreamingAssets/CompiledUpdateScripts', dirs_exist_ok=True)
-
-#     # Clean up
-#     tryRemoveTree(baseFolderName)
-
-# def prepareFiles(dllFolderName, dataFolderName):
-#     os.makedirs(f'temp/{dataFolderName}/StreamingAssets', exist_ok=True)
-#     os.makedirs(f'temp/{dataFolderName}/Managed', exist_ok=True)
-#     os.makedirs(f'temp/{dataFolderName}/Plugins', exist_ok=True)
-
-
-# def buildPatch(dataFolderName):
-# 	# Note: The modded DLL must be generated in a previous build step
-#     shutil.copy('bin/Release/Assembly-CSharp.dll', f'temp/{dataFolderName}/Managed/Assembly-CSharp.dll')
-
-#     print("Downloading video plugin...")
-#     if os.path.exists('AVProVideo.dll'):
-#         os.remove('AVProVideo.dll')
-#     download('https://github.com/07th-mod/patch-releases/releases/download/developer-v1.0/AVProVideo.dll')
-#     tempVideoDLLPath = f'temp/{dataFolderName}/Plugins/AVProVideo.dll'
-#     print(f"Moving video plugin to {tempVideoDLLPath}...")
-#     shutil.move('AVProVideo.dll', tempVideoDLLPath)
-
-#     try:
-#         shutil.copy('bin/Release/Assembly-CSharp.version.txt', f'temp/{dataFolderName}/Managed/Assembly-CSharp.version.txt')
-#     except:
-#         print("Warning: Failed to copy DLL version information file 'Assembly-CSharp.version.txt'")
-
-#     rootJSONFiles = glob.glob('*.json')
-
-#     # Except for certain ignored files, copy everything in the current directory to the 'temp/Higurashi_Ep0X/StreamingAssets' folder
-#     source_folder = '.'
+# The shared deploy_*.py modules are in the deploy_higurashi folder two levels up, so this script is run from a copy of
+# the higurashi_release repository (see ru_workflow_example.yml) - or from a folder the modules were copied into
+SHARED_MODULES_FOLDER = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.append(SHARED_MODULES_FOLDER)
+if importlib.util.find_spec('deploy_common') is None:
+    raise Exception(f"ERROR: The shared deploy_*.py modules were not found next to this script or in {SHARED_MODULES_FOLDER} - run it from a copy of the whole higurashi_release repository")
+
+from deploy_common import (
+    BuildMetrics, chooseTunedResult, CompressionPolicy, getManifestPath, Globals, isWindows, LinkingCopier,
+    loadCompressionProfile, paretoFrontier, printTuningResults, saveCompressionProfile, stageTuningSample, tryRemoveTree,
+    writeArchiveManifest, writeBuildReport,
+)
+from deploy_download import download, DownloadCache, Downloader
+from deploy_archive import (
+    ArchiveBackend, getArchiveBackendClass, getSevenZipExecutable, LayeredFileView, openArchive, startHashingFiles,
+    verifyArchiveContents,
+)
+
+
+DATA_DIR_TO_FINAL_PATH = {
+    'HigurashiEp01_Data' : 'onikakushi_ru_windows.7z',
+    'HigurashiEp02_Data' : 'watanagashi_ru_windows.7z',
+    'HigurashiEp03_Data' : 'Tatarigoroshi_ru_windows.7z',
+    'HigurashiEp04_Data' : 'Himatsubushi_ru_windows.7z',
+    'HigurashiEp05_Data' : 'Meakashi.Patch.RU.7z',
+    'HigurashiEp06_Data' : 'Tsumihoroboshi_ru_windows.7z',
+    'HigurashiEp07_Data' : 'Minagoroshi_ru_windows.7z',
+    'HigurashiEp08_Data' : 'Matsuribayashi_ru_windows.7z',
+    'HigurashiEp09_Data' : 'Rei.Patch.RU.7z', # Currently not used
+    'HigurashiEp10_Data' : 'Hou.Patch.RU.7z', # Currently not used
+}
+
+
+TRANSLATION_FOLDER = 'output/translation'
+
+
+def setupGlobals(args):
+    """Set up Globals from the command line arguments. Also called by each process of a batch build, as Globals are not shared between processes."""
+    Globals.CACHE_DIR = args.cacheDir
+    Globals.DOWNLOADER = Downloader(args.downloadConnections, timeout=args.downloadTimeout, retries=args.downloadRetries)
+    if not args.noDownloadCache:
+        Globals.DOWNLOAD_CACHE = DownloadCache(os.path.join(Globals.CACHE_DIR, 'downloads'), args.downloadCacheSizeMB * 1024 * 1024)
+    if args.uniformCompression:
+        Globals.COMPRESSION_POLICY = None
+    elif args.compressionPolicy is not None:
+        Globals.COMPRESSION_POLICY = CompressionPolicy.load(args.compressionPolicy)
+    else:
+        Globals.COMPRESSION_POLICY = CompressionPolicy()
+
+
+def indexTranslationSubtrees(translationArchive: ArchiveBackend):
+    """
+    Returns the number of files in each output/translation/HigurashiEpXX_Data folder of the translation archive, by
+    data folder name. The archive's member list is kept by the backend, so it is only read once for every chapter.
+    """
+    counts = {}
+    for member in translationArchive.listMembers():
+        parts = member.name.split('/')
+        if member.isDir or len(parts) < 4 or '/'.join(parts[:2]) != TRANSLATION_FOLDER:
+            continue
+        counts[parts[2]] = counts.get(parts[2], 0) + 1
+    return counts
+
+
+def extractTranslations(translationArchive: ArchiveBackend, datadirnames, scratchFolder):
+    """
+    Extract the translated files of every data folder into scratchFolder, with a single pass over the translation
+    archive, and return the folder containing their HigurashiEpXX_Data folders
+    """
+    prefixes = [f'{TRANSLATION_FOLDER}/{datadirname}' for datadirname in datadirnames]
+    print(f"Extracting {', '.join(prefixes)} from {translationArchive.path} into {scratchFolder}")
+    translationArchive.extract(scratchFolder, prefixes)
+    return os.path.join(scratchFolder, *TRANSLATION_FOLDER.split('/'))
+
+
+def getTranslationView(datadir: Path, translationArchive: ArchiveBackend, translationIndex, translationRoot=None):
+    """
+    Overlay the chapter's files from translation.7z on the repo's HigurashiEpXX_Data folder. Translated files
+    replace the repo's files with the same path in the archive, but nothing in the repository is moved or overwritten.
+    If the translations were already extracted (see extractTranslations()), they are read from translationRoot instead.
+    """
+    datadirname = datadir.name
+    if translationIndex.get(datadirname, 0) == 0:
+        raise Exception(f"ERROR: {translationArchive.path} has no files in {TRANSLATION_FOLDER}/{datadirname}")
+
+    ui_datadir_path = f'{TRANSLATION_FOLDER}/{datadirname}'
+    view = LayeredFileView()
+    view.addFolder(datadirname, str(datadir.parent))
+    if translationRoot is None:
+        translatedCount = view.addArchive(translationArchive, ui_datadir_path, datadirname)
+        source = f'{ui_datadir_path} in {translationArchive.path}'
+    else:
+        translatedCount = view.addFolder(datadirname, translationRoot)
+        source = os.path.join(translationRoot, datadirname)
+    Globals.METRICS.annotate(translatedFiles=translatedCount, overriddenFiles=len(view.overridden))
+    print(f"Overlaying {translatedCount} files from {source} on {datadir} ({len(view.overridden)} files replaced)")
+    return view
+
+
+def buildTranslatedChapter(datadir: Path, translationArchive: ArchiveBackend, translationIndex, args, translationRoot=None):
+    """
+    Create the release archive for one HigurashiEpXX_Data folder, overlaid with its translated files from the
+    translation archive (see indexTranslationSubtrees()), and return the path of the archive
+    """
+    metrics = Globals.METRICS
+    datadirname = datadir.name
+    # Each data folder has its own settings stored by --tune
+    profile = None if args.noCompressionProfile or args.tune else loadCompressionProfile('7z', datadirname)
+    Globals.SEVEN_ZIP_ARGS = getSevenZipSettingsArgs(profile['settings']) if profile is not None else None
+    with metrics.stage('mergeTranslation'):
+        view = getTranslationView(datadir, translationArchive, translationIndex, translationRoot)
 
-#     def ignoreFilter(folderPath, folderContents):
-#         # Case is ignored for these paths!
-#         ignoreList = [
-#             '.git',
-#             '.github',
-#             '.gitignore',
-#             '.gitconfig',
-#             'readme.md',
-#             'deploy_higurashi.py',
-#             'dev',
-#             'temp',
-#             'output',
-#             'src',
-#             'bin',
-#             'dll',
-#             dataFolderName
-#         ] #type: list[str]
-
-#         ignoreList = [p.lower() for p in ignoreList]
-
-#         ignored_children = []
-
-#         for child in folderContents:
-#             fullPath = os.path.join(folderPath, child)
-#             realPath = os.path.realpath(fullPath)
-#             relPath = os.path.relpath(realPath, start=source_folder)
-#             nPath = os.path.normcase(os.path.normpath(relPath))
-#             if nPath.lower() in ignoreList or nPath in rootJSONFiles:
-#                 ignored_children.append(child)
-
-#         for child in ignored_children:
-#             print(f' - Ignored [{child}]')
-
-#         return ignored_children
-
-#     print("Copying files to StreamingAssets folder, but ignoring the following paths:")
-#     shutil.copytree(source_folder, f'temp/{dataFolderName}/StreamingAssets', ignore=ignoreFilter, dirs_exist_ok=True)
-
-#     # Copy all top level .json files
-#     print("Copying top level *.json files...")
-#     for jsonFilePath in rootJSONFiles:
-#         print(f"Copying {jsonFilePath} to data folder...")
-#         shutil.copy(jsonFilePath, f'temp/{dataFolderName}')
-
-
-# def makeArchive(chapterName, dataFolderName):
-#     # Turns the first letter of the chapter name into uppercase for consistency when uploading a release
-#     upperChapter = string.capwords(chapterName, '-')
-
-#     # Console arcs archive name is different from chapter name
-#     if chapterName == 'console':
-#         upperChapter = 'ConsoleArcs'
-
-#     os.makedirs(f'output', exist_ok=True)
-#     shutil.make_archive(base_name=f'output/{upperChapter}.Voice.and.Graphics.Patch',
-#                         format='zip',
-#                         root_dir='temp',
-#                         base_dir=dataFolderName
-#                         )
+    # Create final archive in the 'release' folder
+    output_archive_name = f'release/{DATA_DIR_TO_FINAL_PATH[datadirname]}'
+    print(f'Creating archive {output_archive_name} from folder {datadir} and the translation')
+    with metrics.stage('makeArchive'), concurrent.futures.ThreadPoolExecutor() as executor:
+        hashedFiles = startHashingFiles(view, executor)
+        outputArchive = getArchiveBackendClass(output_archive_name).create(output_archive_name, view, Globals.COMPRESSION_POLICY)
+        metrics.add(bytesWritten=os.path.getsize(output_archive_name))
+
+        # 7z archives are solid, so files don't have their own offset in the archive
+        sha256 = dict((archivePath, future.result()) for archivePath, _, future in hashedFiles)
+        sha256.update(view.sha256)
+        writeArchiveManifest(output_archive_name, [{
+            'path': file.archivePath,
+            'size': file.size,
+            'sha256': sha256[file.archivePath],
+        } for file in sorted(view.files.values(), key=lambda file: file.archivePath)])
+
+    if not args.noVerify:
+        with metrics.stage('verifyArchive'):
+            try:
+                verifyArchiveContents(outputArchive, view)
+            except Exception:
+                # Remove the bad archive, so it can't be released by mistake
+                tryRemoveTree(output_archive_name)
+                tryRemoveTree(getManifestPath(output_archive_name))
+                raise
+
+    return output_archive_name
+
+
+def buildTranslatedChapterWorker(datadir: Path, translationArchive: ArchiveBackend, translationIndex, translationRoot, args):
+    """
+    Entry point for each process of a batch build.
+    Returns a dict describing the result instead of raising, so that one failed chapter doesn't hide the results of the others.
+    """
+    setupGlobals(args)
+
+    # A process may build more than one chapter, so each chapter gets new metrics
+    Globals.METRICS = BuildMetrics()
+
+    startTime = time.perf_counter()
+    result = {'chapter': datadir.name, 'archive': None, 'error': None}
+    try:
+        result['archive'] = buildTranslatedChapter(datadir, translationArchive, translationIndex, args, translationRoot)
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] = str(e)
+
+    result['seconds'] = time.perf_counter() - startTime
+    result['metrics'] = Globals.METRICS.toDict()
+    return result
+
+
+def buildTranslatedChaptersInParallel(datadirs: List[Path], translationArchive: ArchiveBackend, translationIndex, args):
+    """
+    Build the archives of several data folders at once, each in a separate process. The translation archive is
+    downloaded and listed once, and the translated files of every chapter are extracted from it in a single pass
+    (7z archives are solid, so streaming each chapter's files would decompress the archive once per chapter).
+    Returns a list of result dicts (see buildTranslatedChapterWorker()), in the same order as 'datadirs'.
+    """
+    os.makedirs('release', exist_ok=True)
+    scratchFolder = os.path.abspath(tempfile.mkdtemp(prefix='.translation-', dir='release'))
+    try:
+        with Globals.METRICS.stage('extractTranslation'):
+            translationRoot = extractTranslations(translationArchive, [datadir.name for datadir in datadirs], scratchFolder)
+
+        print(f">>> Building {len(datadirs)} chapters using {args.jobs} processes")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(buildTranslatedChapterWorker, datadir, translationArchive, translationIndex, translationRoot, args)
+                for datadir in datadirs
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        tryRemoveTree(scratchFolder)
+
+    print("\n>>> Build results:")
+    for result in results:
+        if result['error'] is None:
+            print(f" - [{result['chapter']}] OK in {result['seconds']:.1f}s -> {result['archive']}")
+        else:
+            print(f" - [{result['chapter']}] FAILED in {result['seconds']:.1f}s: {result['error']}")
+
+    return results
+
+
+# The settings tried by tuneTranslatedChapter(). Each combination is benchmarked.
+SEVEN_ZIP_TUNING_GRID = {
+    'method': ['LZMA2', 'LZMA'],
+    'level': [1, 5, 9],
+    'dictionarySize': ['16m', '64m', '512m'],
+    'solidBlockSize': ['off', '64m', 'on'],
+    'threads': sorted(set([1, os.cpu_count() or 1])),
+}
+
+
+def getSevenZipSettingsArgs(settings):
+    """The 7z arguments for a combination of SEVEN_ZIP_TUNING_GRID settings"""
+    return [f"-m0={settings['method']}", f"-mx={settings['level']}", f"-md={settings['dictionarySize']}", f"-ms={settings['solidBlockSize']}", f"-mmt={settings['threads']}"]
+
+
+# Runs a command and prints its CPU time and peak memory. ru_maxrss of RUSAGE_CHILDREN is the largest of every child
+# the process ever waited for, so a separate process with the command as its only child is needed to measure it.
+MEASURE_CHILD_SCRIPT = """
+import json, resource, subprocess, sys
+before = resource.getrusage(resource.RUSAGE_CHILDREN)
+returncode = subprocess.run(sys.argv[1:], stdout=subprocess.DEVNULL).returncode
+after = resource.getrusage(resource.RUSAGE_CHILDREN)
+cpuSeconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+print(json.dumps({'returncode': returncode, 'cpuSeconds': cpuSeconds, 'maxrss': after.ru_maxrss}))
+"""
+
+
+def runSevenZipTuningTrial(sampleFolder, listPath, settings, outputPath):
+    """
+    Compress the files in listPath (relative to sampleFolder) with one combination of SEVEN_ZIP_TUNING_GRID settings,
+    returning its time, size, CPU time and the peak memory of the 7z process (only measurable on Unix, otherwise None)
+    """
+    tryRemoveTree(outputPath)
+    args = [getSevenZipExecutable(), "a"] + getSevenZipSettingsArgs(settings) + ["-scsUTF-8", outputPath, f'@{listPath}']
+    usage = {'returncode': None, 'cpuSeconds': None, 'maxrss': None}
+    startTime = time.perf_counter()
+    if isWindows():
+        usage['returncode'] = subprocess.run(args, stdout=subprocess.DEVNULL, cwd=sampleFolder, shell=True).returncode
+    else:
+        completed = subprocess.run([sys.executable, '-c', MEASURE_CHILD_SCRIPT] + args, stdout=subprocess.PIPE, cwd=sampleFolder, check=True)
+        usage = json.loads(completed.stdout)
+    seconds = time.perf_counter() - startTime
+    if usage['returncode'] != 0:
+        raise Exception(f"ERROR: 7z failed with retcode {usage['returncode']} using {getSevenZipSettingsArgs(settings)}")
+
+    peakMemoryBytes = None
+    if usage['maxrss'] is not None:
+        # ru_maxrss is in KB on Linux, and in bytes on Mac
+        peakMemoryBytes = usage['maxrss'] * (1 if sys.platform == 'darwin' else 1024)
+    size = os.path.getsize(outputPath)
+    tryRemoveTree(outputPath)
+    return {'settings': settings, 'seconds': round(seconds, 3), 'cpuSeconds': usage['cpuSeconds'], 'size': size, 'peakMemoryBytes': peakMemoryBytes}
+
+
+def tuneTranslatedChapter(datadir: Path, translationArchive: ArchiveBackend, translationIndex, args):
+    """
+    Benchmark every combination of SEVEN_ZIP_TUNING_GRID on a representative sample of the chapter's files (see
+    stageTuningSample()), print the Pareto frontier of time, size and peak memory, and store the chosen settings as the
+    compression profile, which later builds of the data folder use.
+    """
+    print(f"\n>>> Tuning 7z compression for {datadir.name}")
+    view = getTranslationView(datadir, translationArchive, translationIndex)
+
+    os.makedirs('release', exist_ok=True)
+    scratchFolder = os.path.abspath(tempfile.mkdtemp(prefix='.tuning-', dir='release'))
+    try:
+        view = view.materialize(os.path.join(scratchFolder, 'layers'), LinkingCopier())
+        files = [(file.diskPath(), file.archivePath, file.size) for file in view.files.values()]
+
+        sampleFolder = os.path.join(scratchFolder, 'sample')
+        sampleFiles, sampleBytes = stageTuningSample(files, args.tuneSampleSizeMB * 1024 * 1024, sampleFolder)
+        print(f"Sampled {sampleFiles} of {len(files)} files ({sampleBytes} of {sum(size for _, _, size in files)} bytes)")
+        listPath = os.path.join(scratchFolder, 'filelist.txt')
+        with open(listPath, 'w', encoding='utf-8') as f:
+            for dirPath, dirNames, fileNames in os.walk(sampleFolder):
+                for fileName in fileNames:
+                    f.write(os.path.relpath(os.path.join(dirPath, fileName), sampleFolder) + '\n')
+
+        results = []
+        grid = list(itertools.product(*SEVEN_ZIP_TUNING_GRID.values()))
+        for i, values in enumerate(grid):
+            settings = dict(zip(SEVEN_ZIP_TUNING_GRID.keys(), values))
+            result = runSevenZipTuningTrial(sampleFolder, listPath, settings, os.path.join(scratchFolder, 'trial.7z'))
+            peakMemory = 'unknown' if result['peakMemoryBytes'] is None else f"{result['peakMemoryBytes'] / 1024 / 1024:.1f} MB"
+            print(f"[{i + 1}/{len(grid)}] {settings}: {result['seconds']:.2f}s, {result['size']} bytes, {peakMemory}")
+            results.append(result)
+    finally:
+        tryRemoveTree(scratchFolder)
+
+    frontier = paretoFrontier(results)
+    maxMemoryBytes = args.tuneMaxMemoryMB * 1024 * 1024 if args.tuneMaxMemoryMB is not None else None
+    chosen = chooseTunedResult(frontier, args.tuneSizeTolerance / 100, maxMemoryBytes)
+    printTuningResults(results, frontier, chosen)
+
+    resultsPath = 'release/compression-tuning.json'
+    with open(resultsPath, 'w') as f:
+        json.dump({'chapter': datadir.name, 'sampleFiles': sampleFiles, 'sampleBytes': sampleBytes, 'results': results, 'frontier': frontier, 'chosen': chosen}, f, indent=2)
+
+    profilePath = saveCompressionProfile('7z', datadir.name, {
+        'createdAt': time.time(),
+        'chapter': datadir.name,
+        'sampleBytes': sampleBytes,
+        'settings': chosen['settings'],
+        'measured': dict((key, chosen[key]) for key in ['seconds', 'size', 'peakMemoryBytes']),
+    })
+    print(f"Saved the chosen settings to {profilePath} (all results are in {resultsPath}) - later builds of {datadir.name} use them unless --no-compression-profile is given")
 
 
 def main():
@@ -250,67 +324,183 @@ def main():
 
 This script uses 3.8's 'dirs_exist_ok=True' argument for shutil.copy.""")
 
-    Globals.SEVEN_ZIP_EXECUTABLE = findWorkingExecutablePath(["7za", "7z"], ['-h'])
+    argparser = argparse.ArgumentParser(description='This script creates the Russian translation release archive. It expects to be run from the root of a Higurashi mod repository containing exactly one HigurashiEpXX_Data folder, or to be given the HigurashiEpXX_Data folders of several chapters.')
+    argparser.add_argument("datadir", nargs='*', help="HigurashiEpXX_Data folders to build (eg. from several chapter repositories). Several folders are built in parallel, sharing one download of translation.7z. (default: the HigurashiEpXX_Data folder in the current folder)")
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Maximum number of chapters to build at the same time when building more than one chapter (default: number of CPUs)',
+    )
+    argparser.add_argument(
+        "--no-download-cache",
+        dest="noDownloadCache",
+        action='store_true',
+        help='Always download files again, instead of reusing them from the download cache',
+    )
+    argparser.add_argument(
+        "--cache-dir",
+        dest="cacheDir",
+        default=Globals.CACHE_DIR,
+        help=f'Folder used to store build caches between runs (default: {Globals.CACHE_DIR}, or set HIGURASHI_CACHE_DIR)',
+    )
+    argparser.add_argument(
+        "--download-cache-size",
+        dest="downloadCacheSizeMB",
+        type=int,
+        default=2048,
+        help='Maximum size of the download cache in MB. Least recently used files are evicted first.',
+    )
+    argparser.add_argument(
+        "--download-connections",
+        dest="downloadConnections",
+        type=int,
+        default=4,
+        help='Number of connections used to download large files in parallel, if the server supports range requests',
+    )
+    argparser.add_argument(
+        "--download-timeout",
+        dest="downloadTimeout",
+        type=float,
+        default=60,
+        help='Timeout in seconds of each download request',
+    )
+    argparser.add_argument(
+        "--download-retries",
+        dest="downloadRetries",
+        type=int,
+        default=5,
+        help='Number of times a failed download request is retried, with exponential backoff',
+    )
+    argparser.add_argument(
+        "--no-verify",
+        dest="noVerify",
+        action='store_true',
+        help='Skip testing the archive with 7z, and checking that it contains exactly the files of the build',
+    )
+    argparser.add_argument(
+        "--compression-policy",
+        dest="compressionPolicy",
+        help='JSON file with the compression level of each file extension (0 stores files without compression), eg. {"levels": {".ogg": 0, ".txt": 9}}. In a .7z release, the files stored by the policy are added without compression, and every other file with the 7z settings',
+    )
+    argparser.add_argument(
+        "--tune",
+        action='store_true',
+        help='Instead of building, benchmark a grid of 7z settings on a sample of the chapter\'s files, and store the best settings as the compression profile used by later builds',
+    )
+    argparser.add_argument(
+        "--tune-sample-size",
+        dest="tuneSampleSizeMB",
+        type=int,
+        default=16,
+        help='Size of the sample of files used by --tune, in MB',
+    )
+    argparser.add_argument(
+        "--tune-size-tolerance",
+        dest="tuneSizeTolerance",
+        type=float,
+        default=1,
+        help='--tune chooses the fastest settings whose output is at most this many percent larger than the smallest output',
+    )
+    argparser.add_argument(
+        "--tune-max-memory",
+        dest="tuneMaxMemoryMB",
+        type=int,
+        default=None,
+        help='--tune ignores settings which used more than this many MB of memory',
+    )
+    argparser.add_argument(
+        "--no-compression-profile",
+        dest="noCompressionProfile",
+        action='store_true',
+        help='Ignore the compression profile stored by --tune',
+    )
+    argparser.add_argument(
+        "--uniform-compression",
+        dest="uniformCompression",
+        action='store_true',
+        help='Compress every file with the same settings, instead of storing media files and using higher levels for text',
+    )
+
+    args = argparser.parse_args()
+
+    setupGlobals(args)
 
     # Get Git Tag Environment Variables
     GIT_REF = os.environ.get("GITHUB_REF",  "unknown/unknown/X.Y.Z")    # Github Tag / Version info
     GIT_TAG = GIT_REF.split('/')[-1]
     print(f"--- Starting build for Git Ref: {GIT_REF} Git Tag: {GIT_TAG} ---")
 
-    currentFolder = Path('.')
-    datadirs = list(currentFolder.glob('HigurashiEp*_Data'))
-    if(len(datadirs) == 0):
-         raise Exception("HigurashiEpXX_Data folder not found - need exactly one data dir")
-    if(len(datadirs) > 1):
-         raise Exception("More than one HigurashiEpXX_Data folder not found - need exactly one data dir")
+    if args.datadir:
+        datadirs = [Path(datadir) for datadir in args.datadir]
+    else:
+        currentFolder = Path('.')
+        datadirs = list(currentFolder.glob('HigurashiEp*_Data'))
+        if(len(datadirs) == 0):
+             raise Exception("HigurashiEpXX_Data folder not found - need exactly one data dir")
+        if(len(datadirs) > 1):
+             raise Exception("More than one HigurashiEpXX_Data folder not found - need exactly one data dir")
+
+    for datadir in datadirs:
+        if not datadir.is_dir():
+            raise Exception(f"ERROR: Data folder {datadir} not found")
+        if datadir.name not in DATA_DIR_TO_FINAL_PATH:
+            raise Exception(f"ERROR: Don't know the release name of {datadir} - expected a folder like HigurashiEp01_Data")
+    datadirnames = [datadir.name for datadir in datadirs]
+    duplicates = sorted(set(name for name in datadirnames if datadirnames.count(name) > 1))
+    if duplicates:
+        raise Exception(f"ERROR: Each chapter can only be built once, but {duplicates} were given more than once")
+
+    # Download the global translation UI file, and list its contents once for every chapter
+    all_ru_translation_archive_url = 'https://github.com/07th-mod/ui-editing-scripts/releases/download/russian_v1.0.0_all/translation.7z'
+    translationArchivePath = download(all_ru_translation_archive_url)
+    translationArchive = openArchive(translationArchivePath)
+    with Globals.METRICS.stage('indexTranslation'):
+        translationIndex = indexTranslationSubtrees(translationArchive)
+    print(f"Found translations for {', '.join(f'{name} ({count} files)' for name, count in sorted(translationIndex.items()))} in {translationArchivePath}")
+
+    if args.tune:
+        if len(datadirs) > 1:
+            raise Exception("Error: --tune can only be used with a single data folder")
+        tuneTranslatedChapter(datadirs[0], translationArchive, translationIndex, args)
+        return
+
+    reportPath = 'release/build-report.json'
+    GITHUB_OUTPUT = os.environ.get("GITHUB_OUTPUT", "github-output-dummy.txt")
 
-    # The name of the data directory for this chapter, for example 'HigurashiEp01_Data'
-    datadirname = datadirs[0].name
+    if len(datadirs) > 1:
+        results = buildTranslatedChaptersInParallel(datadirs, translationArchive, translationIndex, args)
+        chapterReports = {'translation': Globals.METRICS.toDict()}
+        chapterReports.update((result['chapter'], result['metrics']) for result in results)
+        summary = writeBuildReport(reportPath, chapterReports)
 
-    print(f"Generating release for {datadirname}")
+        # Set a Github Actions output "release_archive_<data dir>" for each chapter which built successfully
+        with open(GITHUB_OUTPUT, "w") as f:
+            f.write(f"release_name={GIT_TAG}\n") # For now release name is just the tag, like v1.1.0
+            for result in results:
+                if result['error'] is None:
+                    f.write(f"release_archive_{result['chapter']}={result['archive']}\n")
+            f.write(f"build_report={reportPath}\n")
+            f.write(f"build_timings={json.dumps(summary, separators=(',', ':'))}\n")
 
-    # Download the global translation UI file
-    all_ru_translation_archive_url = 'https://github.com/07th-mod/ui-editing-scripts/releases/download/russian_v1.0.0_all/translation.7z'
-    tryRemoveTree('translation.7z')
-    download(all_ru_translation_archive_url)
-
-    ui_datadir_path = f'output/translation/{datadirname}'
-    sevenZipExtract('translation.7z', filter=ui_datadir_path)
-
-    # Merge HigurashiEpXX_Data folder from translation.7z into repo HigurashiEpXX_Data folder
-    # shutil.move(ui_datadir_path, '.', exi)
-    for fileOrFolder in Path(ui_datadir_path).glob("*"):
-        finalPath = os.path.join(datadirname, fileOrFolder.name)
-        if os.path.exists(finalPath):
-            print(f"Removing {finalPath} (overwrite) as it already exists!")
-            os.remove(finalPath)
-
-        print(f"Moving {fileOrFolder} to {datadirname}")
-        shutil.move(fileOrFolder, datadirname)
-
-    dataDirToFinalPath = {
-        'HigurashiEp01_Data' : 'onikakushi_ru_windows.7z',
-        'HigurashiEp02_Data' : 'watanagashi_ru_windows.7z',
-        'HigurashiEp03_Data' : 'Tatarigoroshi_ru_windows.7z',
-        'HigurashiEp04_Data' : 'Himatsubushi_ru_windows.7z',
-        'HigurashiEp05_Data' : 'Meakashi.Patch.RU.7z',
-        'HigurashiEp06_Data' : 'Tsumihoroboshi_ru_windows.7z',
-        'HigurashiEp07_Data' : 'Minagoroshi_ru_windows.7z',
-        'HigurashiEp08_Data' : 'Matsuribayashi_ru_windows.7z',
-        'HigurashiEp09_Data' : 'Rei.Patch.RU.7z', # Currently not used
-        'HigurashiEp10_Data' : 'Hou.Patch.RU.7z', # Currently not used
-    }
+        failedChapters = [result['chapter'] for result in results if result['error'] is not None]
+        if failedChapters:
+            raise Exception(f"ERROR: The following chapters failed to build: {failedChapters}")
 
-    # Create final archive in the 'release' folder
-    output_archive_name = f'release/{dataDirToFinalPath[datadirname]}'
-    print(f'Creating archive {output_archive_name} from folder {datadirname}')
-    sevenZipMakeArchive(datadirname, output_archive_name)
+        return
+
+    datadir = datadirs[0]
+    print(f"Generating release for {datadir.name}")
+    buildTranslatedChapter(datadir, translationArchive, translationIndex, args)
+
+    summary = writeBuildReport(reportPath, {datadir.name: Globals.METRICS.toDict()})
 
     # Set a Github Actions output "release_name" for use by the release step
-    capitalized_name = string.capwords(datadirname, '-')
-    GITHUB_OUTPUT = os.environ.get("GITHUB_OUTPUT", "github-output-dummy.txt")
     with open(GITHUB_OUTPUT, "w") as f:
-        f.write(f"release_name={GIT_TAG}") # For now release name is just the tag, like v1.1.0
+        f.write(f"release_name={GIT_TAG}\n") # For now release name is just the tag, like v1.1.0
+        f.write(f"build_report={reportPath}\n")
+        f.write(f"build_timings={json.dumps(summary, separators=(',', ':'))}\n")
+
 
 if __name__ == "__main__":
     main()